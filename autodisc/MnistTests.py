@@ -2,13 +2,15 @@
 # Testing scripts for MNIST experiments #
 #########################################
 
+import os
 import numpy as np
 import theano
 import theano.tensor as T
 
 from DexNet import DEX_NET
-from load_data import load_udm, load_udm_ss, load_mnist
+from load_data import load_udm, load_udm_ss, load_mnist, save_udm_arrays
 import NetTrainers as NT
+import SweepRunner as SR
 
 def init_biases(NET, b_init=0.0):
     # Initialize biases in each hidden layer of each proto-network.
@@ -53,7 +55,8 @@ def train_dex(NET, sgd_params, datasets):
         datasets=datasets)
     return
 
-def batch_test_ss_mlp(test_count=10, su_count=1000):
+def batch_test_ss_mlp(test_count=10, su_count=1000, test_nums=None, \
+                      dataset='data/mnist.pkl.gz'):
     """Run multiple semisupervised learning tests."""
     # Set some reasonable sgd parameters
     sgd_params = {}
@@ -82,7 +85,10 @@ def batch_test_ss_mlp(test_count=10, su_count=1000):
     x_in = T.matrix('x_in')
 
     # Run tests with different sorts of regularization
-    for test_num in range(test_count):
+    result_tags = []
+    if test_nums is None:
+        test_nums = range(test_count)
+    for test_num in test_nums:
         # Run test with EAR regularization on unsupervised examples
         sgd_params['result_tag'] = "ss_ear_s{0:d}_t{1:d}".format(su_count, test_num)
         mlp_params['ear_type'] = 2
@@ -90,15 +96,16 @@ def batch_test_ss_mlp(test_count=10, su_count=1000):
         # Initialize a random number generator for this test
         rng = np.random.RandomState(test_num)
         # Load some data to train/validate/test with
-        dataset = 'data/mnist.pkl.gz'
         datasets = load_udm_ss(dataset, su_count, rng, zero_mean=True)
         # Construct the DEX_NET object that we will be training
         NET = DEX_NET(rng=rng, input=x_in, params=mlp_params)
         init_biases(NET, b_init=0.1)
         train_ss_mlp(NET, sgd_params, rng, su_count, datasets)
-    return
+        result_tags.append(sgd_params['result_tag'])
+    return result_tags
 
-def batch_test_ss_mlp_gentle(test_count=10, su_count=1000):
+def batch_test_ss_mlp_gentle(test_count=10, su_count=1000, test_nums=None, \
+                             dataset='data/mnist.pkl.gz'):
     """Setup basic test for semisupervised EAR-regularized MLP."""
 
     # Set some reasonable sgd parameters
@@ -126,14 +133,16 @@ def batch_test_ss_mlp_gentle(test_count=10, su_count=1000):
     mlp_params['lam_l2a'] = 1e-2
     mlp_params['use_bias'] = 1
 
-    for test_num in range(test_count):
+    result_tags = []
+    if test_nums is None:
+        test_nums = range(test_count)
+    for test_num in test_nums:
         rng_seed = test_num
         sgd_params['result_tag'] = "ss_ear_gentle_s{0:d}_t{1:d}".format(su_count, test_num)
 
         # Initialize a random number generator for this test
         rng = np.random.RandomState(rng_seed)
         # Load some data to train/validate/test with
-        dataset = 'data/mnist.pkl.gz'
         datasets = load_udm_ss(dataset, su_count, rng, zero_mean=False)
 
         # Construct the DEX_NET object that we will be training
@@ -169,9 +178,11 @@ def batch_test_ss_mlp_gentle(test_count=10, su_count=1000):
         sgd_params['start_rate'] = 0.05
         NET.set_ear_lam(3.0)
         train_ss_mlp(NET, sgd_params, rng, su_count, datasets)
-    return
+        result_tags.append(sgd_params['result_tag'])
+    return result_tags
 
-def batch_test_ss_mlp_pt(test_count=10, su_count=1000):
+def batch_test_ss_mlp_pt(test_count=10, su_count=1000, test_nums=None, \
+                         dataset='data/mnist.pkl.gz'):
     """Setup basic test for semisupervised EAR-regularized MLP."""
 
     # Set some reasonable sgd parameters
@@ -198,14 +209,16 @@ def batch_test_ss_mlp_pt(test_count=10, su_count=1000):
     mlp_params['lam_l2a'] = 0.0
     mlp_params['use_bias'] = 1
 
-    for test_num in range(test_count):
+    result_tags = []
+    if test_nums is None:
+        test_nums = range(test_count)
+    for test_num in test_nums:
         rng_seed = test_num
         sgd_params['result_tag'] = "test_{0:d}".format(test_num)
 
         # Initialize a random number generator for this test
         rng = np.random.RandomState(rng_seed)
         # Load some data to train/validate/test with
-        dataset = 'data/mnist.pkl.gz'
         datasets = load_udm(dataset, zero_mean=False)
 
         # Construct the DEX_NET object that we will be training
@@ -223,7 +236,6 @@ def batch_test_ss_mlp_pt(test_count=10, su_count=1000):
         train_dex(NET, sgd_params, datasets)
 
         # Load some data to train/validate/test with
-        dataset = 'data/mnist.pkl.gz'
         datasets = load_udm_ss(dataset, su_count, rng, zero_mean=False)
         # Run semisupervised training on the given MLP
         sgd_params['batch_size'] = 100
@@ -254,7 +266,8 @@ def batch_test_ss_mlp_pt(test_count=10, su_count=1000):
         sgd_params['start_rate'] = 0.01
         NET.set_ear_lam(3.0)
         train_ss_mlp(NET, sgd_params, rng, su_count, datasets)
-    return
+        result_tags.append(sgd_params['result_tag'])
+    return result_tags
 
 def test_dropout_ala_original():
     """Run standard dropout training on MNIST with parameters to reproduce
@@ -299,6 +312,39 @@ def test_dropout_ala_original():
     train_mlp(NET, sgd_params, datasets)
     return
 
+def sweep_ss_mlp(test_name='batch_test_ss_mlp', test_count=10, su_counts=[100], \
+                 worker_count=4, sweep_dir=None):
+    """Run one of the batch_test_ss_mlp* tests as a parallel sweep.
+
+    Each (su_count, test_num) pair becomes a trial, run in its own process
+    through SweepRunner, with up to worker_count trials running at once. The
+    MNIST data is unpacked once into sweep_dir/data, and read from there by
+    all of the trials. When all trials are done, their results files get summed
+    up in sweep_dir/results_table.txt.
+    """
+    if sweep_dir is None:
+        sweep_dir = "sweep_{0:s}".format(test_name)
+    data_dir = save_udm_arrays('data/mnist.pkl.gz', \
+            os.path.join(sweep_dir, 'data'))
+    trials = []
+    for su_count in su_counts:
+        for test_num in range(test_count):
+            trials.append({'test_count': 1, 'su_count': su_count, \
+                           'test_nums': [test_num], 'dataset': data_dir})
+    trial_tags = SR.run_sweep('MnistTests', test_name, trials, sweep_dir, \
+            worker_count=worker_count)
+    # Get the final results file for each trial, or a stand-in for failures
+    result_files = []
+    for (trial_num, tags) in enumerate(trial_tags):
+        if tags is None:
+            result_files.append("trial_{0:d}_failed".format(trial_num))
+        else:
+            result_files.extend(["results_mlp_{0:s}.txt".format(t) for t in tags])
+    table = SR.results_table(result_files, \
+            table_file=os.path.join(sweep_dir, 'results_table.txt'))
+    print(table)
+    return table
+
 if __name__ == '__main__':
 
     # Run standard dropout with parameters to reproduce Hinton et. al
@@ -319,6 +365,9 @@ if __name__ == '__main__':
     #batch_test_ss_mlp_pt(test_count=10, su_count=1000)
     #batch_test_ss_mlp_pt(test_count=10, su_count=3000)
 
+    # Run multiple tests as a parallel sweep, with a table of the results
+    #sweep_ss_mlp('batch_test_ss_mlp_pt', test_count=30, su_counts=[100], worker_count=4)
+
 
 
 
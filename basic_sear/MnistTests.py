@@ -2,14 +2,16 @@
 # Testing scripts for MNIST experiments #
 #########################################
 
+import os
 import numpy as np
 import theano
 import theano.tensor as T
 import theano.tensor.shared_randomstreams
 
 from FrankeNet import SS_DEV_NET
-from load_data import load_udm, load_udm_ss, load_mnist
+from load_data import load_udm, load_udm_ss, load_mnist, save_udm_arrays
 import NetTrainers as NT
+import SweepRunner as SR
 
 def init_biases(NET, b_init=0.0):
     # Initialize biases in each net layer (except final layer).
@@ -21,11 +23,11 @@ def init_biases(NET, b_init=0.0):
         layer.b.set_value(b_const)
     return
 
-def train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count=1000):
+def train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count=1000, \
+                 dataset='data/mnist.pkl.gz', trainer=None):
     """Run semisupervised DEV-regularized test."""
 
     # Load some data to train/validate/test with
-    dataset = 'data/mnist.pkl.gz'
     datasets = load_udm_ss(dataset, su_count, rng)
 
     # Tell the net that it's semisupervised, which will force it to use only
@@ -33,11 +35,12 @@ def train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count=1000):
     NET.is_semisupervised = 1
 
     # Run training on the given NET
-    NT.train_ss_mlp(NET=NET, \
+    trainer = NT.train_ss_mlp(NET=NET, \
         mlp_params=mlp_params, \
         sgd_params=sgd_params, \
-        datasets=datasets)
-    return
+        datasets=datasets, \
+        trainer=trainer)
+    return trainer
 
 def train_mlp(NET, mlp_params, sgd_params):
     """Run mlp training test."""
@@ -59,11 +62,11 @@ def train_mlp(NET, mlp_params, sgd_params):
         datasets=datasets)
     return
 
-def train_dae(NET, dae_layer, mlp_params, sgd_params):
+def train_dae(NET, dae_layer, mlp_params, sgd_params, \
+              dataset='data/mnist.pkl.gz'):
     """Run DAE training test."""
 
     # Load some data to train/validate/test with
-    dataset = 'data/mnist.pkl.gz'
     datasets = load_udm(dataset)
 
     # Run denoising autoencoder training on the given layer of NET
@@ -74,7 +77,8 @@ def train_dae(NET, dae_layer, mlp_params, sgd_params):
         datasets=datasets)
     return
 
-def batch_test_ss_mlp(test_count=10, su_count=1000):
+def batch_test_ss_mlp(test_count=10, su_count=1000, test_nums=None, \
+                      dataset='data/mnist.pkl.gz'):
     """Run multiple semisupervised learning tests."""
     # Set some reasonable sgd parameters
     sgd_params = {}
@@ -98,8 +102,14 @@ def batch_test_ss_mlp(test_count=10, su_count=1000):
     # Goofy symbolic sacrament to Theano
     x_in = T.matrix('x_in')
 
-    # Run tests with different sorts of regularization
-    for test_num in range(test_count):
+    # Run tests with different sorts of regularization, all of them using the
+    # model compiled for the first test
+    NET = None
+    trainer = None
+    result_tags = []
+    if test_nums is None:
+        test_nums = range(test_count)
+    for test_num in test_nums:
         """
         # Run test with no droppish regularization
         sgd_params['result_tag'] = "ss_raw_s{0:d}_t{1:d}".format(test_num, su_count)
@@ -111,7 +121,7 @@ def batch_test_ss_mlp(test_count=10, su_count=1000):
         NET = SS_DEV_NET(rng=rng, input=x_in, params=mlp_params)
         init_biases(NET, b_init=0.1)
         rng = np.random.RandomState(test_num)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
+        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count, dataset)
         # Run test with standard dropout on supervised examples
         sgd_params['result_tag'] = "ss_sde_s{0:d}_t{1:d}".format(test_num, su_count)
         sgd_params['mlp_type'] = 'sde'
@@ -121,7 +131,7 @@ def batch_test_ss_mlp(test_count=10, su_count=1000):
         NET = SS_DEV_NET(rng=rng, input=x_in, params=mlp_params)
         init_biases(NET, b_init=0.1)
         rng = np.random.RandomState(test_num)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
+        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count, dataset)
         """
         # Run test with DEV regularization on unsupervised examples
         sgd_params['result_tag'] = "ss_dev_s{0:d}_t{1:d}".format(test_num, su_count)
@@ -130,14 +140,21 @@ def batch_test_ss_mlp(test_count=10, su_count=1000):
         mlp_params['dev_lams'] = [0.1, 0.1, 2.0]
         # Initialize a random number generator for this test
         rng = np.random.RandomState(test_num)
-        # Construct the SS_DEV_NET object that we will be training
-        NET = SS_DEV_NET(rng=rng, input=x_in, params=mlp_params)
-        init_biases(NET, b_init=0.1)
+        # Construct an SS_DEV_NET with the initial params for this test. After
+        # the first test, these get copied into the already-compiled net (if
+        # its random streams can be reseeded).
+        trial_NET = SS_DEV_NET(rng=rng, input=x_in, params=mlp_params)
+        init_biases(trial_NET, b_init=0.1)
+        if (NET is None) or (not NT.copy_net_params(NET, trial_NET)):
+            NET = trial_NET
         rng = np.random.RandomState(test_num)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
-    return
+        trainer = train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count, \
+                dataset, trainer)
+        result_tags.append(sgd_params['result_tag'])
+    return result_tags
 
-def batch_test_ss_mlp_gentle(test_count=10, su_count=1000):
+def batch_test_ss_mlp_gentle(test_count=10, su_count=1000, test_nums=None, \
+                             dataset='data/mnist.pkl.gz'):
     """Run multiple semisupervised learning tests."""
     # Set some reasonable sgd parameters
     sgd_params = {}
@@ -162,7 +179,10 @@ def batch_test_ss_mlp_gentle(test_count=10, su_count=1000):
     x_in = T.matrix('x_in')
 
     # Run tests with different sorts of regularization
-    for test_num in range(test_count):
+    result_tags = []
+    if test_nums is None:
+        test_nums = range(test_count)
+    for test_num in test_nums:
         rng_seed = test_num
         # Initialize a random number generator for this test
         rng = np.random.RandomState(rng_seed)
@@ -177,30 +197,32 @@ def batch_test_ss_mlp_gentle(test_count=10, su_count=1000):
         sgd_params['epochs'] = 5
         NET.set_dev_lams([0.0, 0.0, 0.0])
         rng = np.random.RandomState(rng_seed)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
+        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count, dataset)
         # Train with more DEV regularization
         sgd_params['epochs'] = 10
         NET.set_dev_lams([0.02, 0.02, 0.02])
         rng = np.random.RandomState(rng_seed)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
+        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count, dataset)
         # Train with more DEV regularization
         sgd_params['epochs'] = 10
         NET.set_dev_lams([0.04, 0.04, 0.04])
         rng = np.random.RandomState(rng_seed)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
+        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count, dataset)
         # Train with more DEV regularization
         sgd_params['epochs'] = 10
         NET.set_dev_lams([0.06, 0.06, 0.06])
         rng = np.random.RandomState(rng_seed)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
+        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count, dataset)
         # Train with most DEV regularization
         sgd_params['epochs'] = 100
         NET.set_dev_lams([0.1, 0.1, 0.2])
         rng = np.random.RandomState(rng_seed)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
-    return
+        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count, dataset)
+        result_tags.append(sgd_params['result_tag'])
+    return result_tags
 
-def batch_test_ss_mlp_pt(test_count=10, su_count=1000):
+def batch_test_ss_mlp_pt(test_count=10, su_count=1000, test_nums=None, \
+                         dataset='data/mnist.pkl.gz'):
     """Setup basic test for semisupervised DEV-regularized MLP."""
 
     # Set some reasonable sgd parameters
@@ -223,7 +245,10 @@ def batch_test_ss_mlp_pt(test_count=10, su_count=1000):
     mlp_params['lam_l2a'] = 1e-3
     mlp_params['use_bias'] = 1
 
-    for test_num in range(test_count):
+    result_tags = []
+    if test_nums is None:
+        test_nums = range(test_count)
+    for test_num in test_nums:
         rng_seed = test_num
         sgd_params['result_tag'] = "test_{0:d}".format(test_num)
 
@@ -247,7 +272,7 @@ def batch_test_ss_mlp_pt(test_count=10, su_count=1000):
             print("==================================================")
             print("Pretraining hidden layer {0:d}".format(i+1))
             print("==================================================")
-            train_dae(NET, i, mlp_params, sgd_params)
+            train_dae(NET, i, mlp_params, sgd_params, dataset)
 
         # Run semisupervised training on the given MLP
         sgd_params['batch_size'] = 100
@@ -258,24 +283,25 @@ def batch_test_ss_mlp_pt(test_count=10, su_count=1000):
         sgd_params['epochs'] = 5
         NET.set_dev_lams([0.01, 0.01, 0.01])
         rng = np.random.RandomState(rng_seed)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
+        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count, dataset)
         # Train with more DEV regularization
         sgd_params['top_only'] = False
         sgd_params['epochs'] = 10
         NET.set_dev_lams([0.02, 0.02, 0.02])
         rng = np.random.RandomState(rng_seed)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
+        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count, dataset)
         # Train with more DEV regularization
         sgd_params['epochs'] = 10
         NET.set_dev_lams([0.05, 0.05, 0.08])
         rng = np.random.RandomState(rng_seed)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
+        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count, dataset)
         # Train with most DEV regularization
         sgd_params['epochs'] = 500
         NET.set_dev_lams([0.1, 0.1, 0.2])
         rng = np.random.RandomState(rng_seed)
-        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count)
-    return
+        train_ss_mlp(NET, mlp_params, sgd_params, rng, su_count, dataset)
+        result_tags.append(sgd_params['result_tag'])
+    return result_tags
 
 def test_dropout_ala_original():
     """Run standard dropout training on MNIST with parameters to reproduce
@@ -314,6 +340,39 @@ def test_dropout_ala_original():
     train_mlp(NET, mlp_params, sgd_params)
     return
 
+def sweep_ss_mlp(test_name='batch_test_ss_mlp', test_count=10, su_counts=[100], \
+                 worker_count=4, sweep_dir=None):
+    """Run one of the batch_test_ss_mlp* tests as a parallel sweep.
+
+    Each (su_count, test_num) pair becomes a trial, run in its own process
+    through SweepRunner, with up to worker_count trials running at once. The
+    MNIST data is unpacked once into sweep_dir/data, and read from there by
+    all of the trials. When all trials are done, their results files get summed
+    up in sweep_dir/results_table.txt.
+    """
+    if sweep_dir is None:
+        sweep_dir = "sweep_{0:s}".format(test_name)
+    data_dir = save_udm_arrays('data/mnist.pkl.gz', \
+            os.path.join(sweep_dir, 'data'))
+    trials = []
+    for su_count in su_counts:
+        for test_num in range(test_count):
+            trials.append({'test_count': 1, 'su_count': su_count, \
+                           'test_nums': [test_num], 'dataset': data_dir})
+    trial_tags = SR.run_sweep('MnistTests', test_name, trials, sweep_dir, \
+            worker_count=worker_count)
+    # Get the final results file for each trial, or a stand-in for failures
+    result_files = []
+    for (trial_num, tags) in enumerate(trial_tags):
+        if tags is None:
+            result_files.append("trial_{0:d}_failed".format(trial_num))
+        else:
+            result_files.extend(["results_mlp_{0:s}.txt".format(t) for t in tags])
+    table = SR.results_table(result_files, \
+            table_file=os.path.join(sweep_dir, 'results_table.txt'))
+    print(table)
+    return table
+
 if __name__ == '__main__':
 
     # Run standard dropout with parameters to reproduce Hinton et. al
@@ -334,6 +393,9 @@ if __name__ == '__main__':
     #batch_test_ss_mlp_pt(test_count=10, su_count=1000)
     #batch_test_ss_mlp_pt(test_count=10, su_count=3000)
 
+    # Run multiple tests as a parallel sweep, with a table of the results
+    #sweep_ss_mlp('batch_test_ss_mlp_pt', test_count=30, su_counts=[100], worker_count=4)
+
 
 
 
@@ -0,0 +1,193 @@
+##################################################################
+# Code for running independent training trials in parallel, each #
+# in a fresh python process with its own theano compile dir, and #
+# for collecting their results files into a single table.        #
+##################################################################
+
+# basic python
+import os
+import sys
+import json
+import time
+import subprocess
+import numpy as np
+
+# NOTE: this module must not import theano. Each trial runs in its own child
+# process, and theano reads its compile dir from THEANO_FLAGS when it first
+# gets imported, so the child has to be started with its flags already set.
+
+def _theano_flags(base_compiledir):
+    """
+    Get THEANO_FLAGS for a child process, with base_compiledir added on to
+    any flags set for this process.
+    """
+    flags = os.environ.get('THEANO_FLAGS', '')
+    flags = [f for f in flags.split(',') if not \
+            (f.strip().startswith('base_compiledir') or (f.strip() == ''))]
+    flags.append("base_compiledir={0:s}".format(base_compiledir))
+    return ",".join(flags)
+
+def _run_trial():
+    """
+    Entry point for a child process. Call module.func(**kwargs), with module,
+    func, kwargs and the output file name given in sys.argv, then write the
+    returned value to the output file as JSON.
+    """
+    module_name, func_name, kwargs, out_file = sys.argv[1:5]
+    module = __import__(module_name)
+    func = getattr(module, func_name)
+    result = func(**json.loads(kwargs))
+    f_handle = open(out_file, 'w')
+    json.dump(result, f_handle)
+    f_handle.close()
+    return
+
+def run_sweep(module_name, func_name, trials, sweep_dir, worker_count=4, \
+              poll_time=1.0):
+    """
+    Run module_name.func_name(**trial) for each dict in trials, using a pool
+    of worker_count child processes.
+
+    Worker slot i compiles into sweep_dir/theano_w<i>, which is reused by all
+    trials run in that slot, so workers don't fight over theano's compile
+    lock and later trials in a slot get cache hits. Output of trial k goes to
+    sweep_dir/trial_<k>.log, and the value it returned to trial_<k>.json.
+
+    Returns a list with, for each trial, the value it returned (or None, if
+    it failed).
+    """
+    if not os.path.exists(sweep_dir):
+        os.makedirs(sweep_dir)
+    sweep_dir = os.path.abspath(sweep_dir)
+    pending = list(enumerate(trials))
+    running = {}
+    returns = {}
+    t0 = time.time()
+    while (len(pending) > 0) or (len(running) > 0):
+        # start trials in any free worker slots
+        free_slots = [i for i in range(worker_count) if not (i in running)]
+        for slot in free_slots:
+            if len(pending) == 0:
+                break
+            trial_num, trial = pending.pop(0)
+            env = dict(os.environ)
+            env['THEANO_FLAGS'] = _theano_flags( \
+                    os.path.join(sweep_dir, "theano_w{0:d}".format(slot)))
+            log_file = open(os.path.join(sweep_dir, \
+                    "trial_{0:d}.log".format(trial_num)), 'w')
+            out_file = os.path.join(sweep_dir, \
+                    "trial_{0:d}.json".format(trial_num))
+            args = [sys.executable, '-c', \
+                    'import SweepRunner; SweepRunner._run_trial()', \
+                    module_name, func_name, json.dumps(trial), out_file]
+            proc = subprocess.Popen(args, env=env, stdout=log_file, \
+                    stderr=subprocess.STDOUT)
+            running[slot] = (trial_num, proc, log_file, out_file)
+            print("trial {0:d}: started in worker {1:d}, {2:s}".format( \
+                    trial_num, slot, str(trial)))
+        # check for finished trials
+        time.sleep(poll_time)
+        for slot in list(running.keys()):
+            trial_num, proc, log_file, out_file = running[slot]
+            if proc.poll() is None:
+                continue
+            log_file.close()
+            del running[slot]
+            if (proc.returncode == 0) and os.path.isfile(out_file):
+                f_handle = open(out_file, 'r')
+                returns[trial_num] = json.load(f_handle)
+                f_handle.close()
+                status = "done"
+            else:
+                returns[trial_num] = None
+                status = "FAILED (exit code {0:d}, see {1:s})".format( \
+                        proc.returncode, log_file.name)
+            print("trial {0:d}: {1:s}, {2:.1f}s into sweep".format( \
+                    trial_num, status, (time.time() - t0)))
+    return [returns[i] for i in range(len(trials))]
+
+def read_results_file(f_name):
+    """
+    Read a results file written by one of the NetTrainers. Lines of the form
+    "key: value" go into a dict of settings, and lines of numbers go into a
+    matrix with one row per epoch.
+    """
+    settings = {}
+    rows = []
+    f_handle = open(f_name, 'r')
+    for line in f_handle:
+        line = line.strip()
+        if line == '':
+            continue
+        try:
+            rows.append([float(v) for v in line.split()])
+        except ValueError:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                settings[key.strip()] = value.strip()
+    f_handle.close()
+    # drop a partly written last row, if the trial died mid-write
+    if (len(rows) > 1) and (len(rows[-1]) != len(rows[0])):
+        rows = rows[:-1]
+    return settings, np.asarray(rows)
+
+def results_table(result_files, table_file=None, valid_col=1, test_col=2):
+    """
+    Summarize a bunch of results files in one table, with a row per file
+    giving the number of epochs, the best validation error, the test error at
+    the epoch with best validation error, and the final test error. The last
+    two rows give the mean and std of each column.
+
+    The table is returned as a string, and also written to table_file (if
+    given). Missing or empty files get a row of NaNs.
+    """
+    names = []
+    stats = []
+    for f_name in result_files:
+        names.append(os.path.basename(f_name))
+        if os.path.isfile(f_name):
+            settings, rows = read_results_file(f_name)
+        else:
+            rows = np.zeros((0,))
+        if (rows.ndim < 2) or (rows.shape[0] == 0) or \
+                (rows.shape[1] <= max(valid_col, test_col)):
+            stats.append([np.nan for i in range(4)])
+            continue
+        best_idx = np.argmin(rows[:,valid_col])
+        stats.append([rows.shape[0], rows[best_idx,valid_col], \
+                      rows[best_idx,test_col], rows[-1,test_col]])
+    stats = np.asarray(stats).reshape((-1, 4))
+    name_len = max([len(n) for n in names] + [10])
+    row_fmt = "{0:" + str(name_len) + "s} {1:>7s} {2:>11s} {3:>11s} {4:>11s}\n"
+    num_fmt = "{0:" + str(name_len) + "s} {1:7.0f} {2:11.4f} {3:11.4f} {4:11.4f}\n"
+    table = row_fmt.format('results', 'epochs', 'best_valid', \
+            'test@best', 'final_test')
+    for (name, row) in zip(names, stats):
+        table = table + num_fmt.format(name, *row)
+    if len(names) > 0:
+        ok_rows = stats[np.isfinite(stats[:,0])]
+        if ok_rows.shape[0] > 0:
+            table = table + num_fmt.format('mean', *np.mean(ok_rows, axis=0))
+            table = table + num_fmt.format('std', *np.std(ok_rows, axis=0))
+    if not (table_file is None):
+        f_handle = open(table_file, 'w')
+        f_handle.write(table)
+        f_handle.close()
+    return table
+
+if __name__=="__main__":
+    # check the results table on some fake results files
+    import tempfile
+    tmp_dir = tempfile.mkdtemp()
+    f_names = []
+    for i in range(3):
+        f_name = os.path.join(tmp_dir, "results_mlp_t{0:d}.txt".format(i))
+        f_handle = open(f_name, 'w')
+        f_handle.write("mlp_type: dev\nlam_l2a: 0.0010\n")
+        for e in range(10):
+            f_handle.write("{0:.2f} {1:.2f} {2:.2f} 0.1 0.2 0.3\n".format( \
+                    10.0-e, 5.0+abs(e-5), 6.0+abs(e-4)))
+        f_handle.close()
+        f_names.append(f_name)
+    f_names.append(os.path.join(tmp_dir, "results_mlp_missing.txt"))
+    print(results_table(f_names))
@@ -11,6 +11,118 @@ import theano.printing
 
 import utils as utils
 
+def _net_params(NET):
+    """
+    Get a list of all the params in NET, without repeats, in a fixed order.
+    """
+    params = []
+    for attr in ['mlp_params', 'proto_params', 'dae_params']:
+        for p in getattr(NET, attr, []):
+            for sub_p in (p if isinstance(p, list) else [p]):
+                if not any([(sub_p is q) for q in params]):
+                    params.append(sub_p)
+    return params
+
+def eval_batch_size(NET, X, sgd_params):
+    """
+    Get the number of rows per batch for evaluating NET on the observations
+    in the shared matrix X.
+
+    This is sgd_params['eval_batch_size'], if given (eval_batch_size=100 gives
+    the old fixed-size batches). Otherwise, batches are made as large as
+    possible while keeping their activations in roughly sgd_params['eval_mem']
+    bytes (default: 64MB). The activations for a row are guessed to take four
+    times the space of a row of X plus the outputs of every weight matrix in
+    NET, to allow for clones and temporaries.
+    """
+    samples = X.get_value(borrow=True).shape[0]
+    if ('eval_batch_size' in sgd_params):
+        return int(max(1, min(samples, sgd_params['eval_batch_size'])))
+    eval_mem = sgd_params.get('eval_mem', 2**26)
+    row_size = X.get_value(borrow=True).shape[1]
+    for param in _net_params(NET):
+        p_shape = param.get_value(borrow=True).shape
+        if (len(p_shape) == 2):
+            row_size = row_size + p_shape[1]
+    row_bytes = 4 * row_size * np.dtype(theano.config.floatX).itemsize
+    return int(max(100, min(samples, (eval_mem / row_bytes))))
+
+def _weight_metrics(batch_metrics, rows):
+    """
+    Scale the per-row mean metrics in batch_metrics (all but the first, which
+    is an error count) by the batch's row count, so that summing them over
+    batches and dividing by the total row count gives an unbiased mean.
+    """
+    return [batch_metrics[0]] + [(rows * float(bm)) for bm in batch_metrics[1:]]
+
+class EarlyStopper(object):
+    """
+    Decides when to evaluate a net during training and when to give up on
+    it, based on its validation score (lower is better). If restore_best is
+    set, the values of params at the epoch with the best score are kept in
+    memory.
+
+    Settings are read from sgd_params:
+        eval_freq: evaluate every this many epochs (default: 1)
+        patience: stop after this many epochs without a new best score
+                  (default: None, for no early stopping)
+        min_delta: how much a score has to beat the best score by to count
+                   as a new best (default: 0)
+        restore_best: whether to put the best param values back into the net
+                      when training ends (default: False)
+    """
+    def __init__(self, params, sgd_params):
+        self.params = params
+        self.n_epochs = sgd_params['epochs']
+        self.eval_freq = max(1, int(sgd_params.get('eval_freq', 1)))
+        self.patience = sgd_params.get('patience', None)
+        self.min_delta = sgd_params.get('min_delta', 0.0)
+        self.restore_best = sgd_params.get('restore_best', False)
+        self.best_score = np.inf
+        self.best_epoch = 0
+        self.best_values = None
+        return
+
+    def should_eval(self, epoch):
+        """
+        Check whether to evaluate after the given epoch.
+        """
+        return ((epoch % self.eval_freq) == 0) or (epoch >= self.n_epochs)
+
+    def update(self, epoch, score):
+        """
+        Record the validation score for the given epoch. Returns True if it's
+        a new best, in which case the current param values get snapshotted
+        (if restore_best is set).
+        """
+        if (score < (self.best_score - self.min_delta)):
+            self.best_score = score
+            self.best_epoch = epoch
+            if self.restore_best:
+                self.best_values = [p.get_value(borrow=False) \
+                                    for p in self.params]
+            return True
+        return False
+
+    def should_stop(self, epoch):
+        """
+        Check whether we've run out of patience, as of the given epoch.
+        """
+        if (self.patience is None):
+            return False
+        return ((epoch - self.best_epoch) >= self.patience)
+
+    def finish(self):
+        """
+        Put the best param values back into the net, if restore_best is set.
+        """
+        if self.restore_best and not (self.best_values is None):
+            for (param, value) in zip(self.params, self.best_values):
+                param.set_value(value)
+            print("restored params from epoch {0:d}, with score {1:.4f}".format( \
+                    self.best_epoch, self.best_score))
+        return
+
 def train_mlp(
         NET,
         sgd_params,
@@ -43,10 +155,14 @@ def train_mlp(
     Xte, Yte = (datasets[2][0], T.cast(datasets[2][1], 'int32'))
     va_samples = Xva.get_value(borrow=True).shape[0]
     te_samples = Xte.get_value(borrow=True).shape[0]
-    va_batches = int(np.ceil(va_samples / 100.))
-    te_batches = int(np.ceil(te_samples / 100.))
-    va_bidx = [[i*100, min(va_samples, (i+1)*100)] for i in range(va_batches)]
-    te_bidx = [[i*100, min(te_samples, (i+1)*100)] for i in range(te_batches)]
+    va_bsize = eval_batch_size(NET, Xva, sgd_params)
+    te_bsize = eval_batch_size(NET, Xte, sgd_params)
+    va_batches = int(np.ceil(va_samples / float(va_bsize)))
+    te_batches = int(np.ceil(te_samples / float(te_bsize)))
+    va_bidx = [[i*va_bsize, min(va_samples, (i+1)*va_bsize)] for i in range(va_batches)]
+    va_rows = [(e_idx - s_idx) for (s_idx, e_idx) in va_bidx]
+    te_bidx = [[i*te_bsize, min(te_samples, (i+1)*te_bsize)] for i in range(te_batches)]
+    te_rows = [(e_idx - s_idx) for (s_idx, e_idx) in te_bidx]
     va_bidx = theano.shared(value=np.asarray(va_bidx, dtype=theano.config.floatX))
     te_bidx = theano.shared(value=np.asarray(te_bidx, dtype=theano.config.floatX))
     va_bidx = T.cast(va_bidx, 'int32')
@@ -181,6 +297,7 @@ def train_mlp(
     validation_metrics = validate_model(1)
     test_metrics = test_model(1)
     # compute metrics on testing set
+    stopper = EarlyStopper(_net_params(NET), sgd_params)
     while epoch_counter < n_epochs:
         ######################################################
         # process some number of minibatches for this epoch. #
@@ -195,6 +312,8 @@ def train_mlp(
         train_metrics = [(float(v) / tr_batches) for v in train_metrics]
         # update the learning rate
         new_learning_rate = set_learning_rate()
+        if not stopper.should_eval(epoch_counter):
+            continue
 
         ######################################################
         # validation, testing, and general diagnostic stuff. #
@@ -202,23 +321,23 @@ def train_mlp(
         # compute metrics on validation set
         validation_metrics = [0. for v in validation_metrics]
         for b_idx in xrange(va_batches):
-            batch_metrics = validate_model(b_idx)
+            batch_metrics = _weight_metrics(validate_model(b_idx), va_rows[b_idx])
             validation_metrics = [(em + bm) for (em, bm) in zip(validation_metrics, batch_metrics)]
         # Compute 'averaged' values over the minibatches
         validation_error = 100 * (float(validation_metrics[0]) / va_samples)
-        validation_loss = float(validation_metrics[1]) / va_batches
+        validation_loss = float(validation_metrics[1]) / va_samples
 
         # compute test error if new best validation error was found
         tag = " "
         # compute metrics on testing set
         test_metrics = [0. for v in test_metrics]
         for b_idx in xrange(te_batches):
-            batch_metrics = test_model(b_idx)
+            batch_metrics = _weight_metrics(test_model(b_idx), te_rows[b_idx])
             test_metrics = [(em + bm) for (em, bm) in zip(test_metrics, batch_metrics)]
         # Compute 'averaged' values over the minibatches
         test_error = 100 * (float(test_metrics[0]) / te_samples)
-        test_loss = float(test_metrics[1]) / te_batches
-        if (validation_error < min_validation_error):
+        test_loss = float(test_metrics[1]) / te_samples
+        if stopper.update(epoch_counter, validation_error):
             min_validation_error = validation_error
             min_test_error = test_error
             tag = ", test={0:.2f}".format(test_error)
@@ -235,72 +354,82 @@ def train_mlp(
         e_time = time.clock()
         # save first layer weights to an image locally
         utils.visualize(NET, 0, 0, img_file_name)
+        if stopper.should_stop(epoch_counter):
+            print("no new best in {0:d} epochs, stopping early".format( \
+                    stopper.patience))
+            break
 
+    stopper.finish()
     print("optimization complete. best validation error {0:.4f}, with test error {1:.4f}".format( \
           (min_validation_error), (min_test_error)))
 
-def train_ss_mlp(
-        NET,
-        sgd_params,
-        datasets):
+def _set_ss_data(trainer, datasets, sgd_params):
     """
-    Train NET using a mix of labeled an unlabeled data.
-
-    Datasets should be a four-tuple, in which the first item is a matrix/vector
-    pair of inputs/labels for training, the second item is a matrix of
-    unlabeled inputs for training, the third item is a matrix/vector pair of
-    inputs/labels for validation, and the fourth is a matrix/vector pair of
-    inputs/labels for testing.
+    Point the trainer's shared data at datasets, and set up the arrays of
+    start/end indices for minibatch slicing. Returns a dict of batch counts.
     """
-    initial_learning_rate = sgd_params['start_rate']
-    learning_rate_decay = sgd_params['decay_rate']
-    n_epochs = sgd_params['epochs']
+    NET = trainer['NET']
     batch_size = sgd_params['batch_size']
-    wt_norm_bound = sgd_params['wt_norm_bound']
-    result_tag = sgd_params['result_tag']
-    txt_file_name = "results_mlp_{0}.txt".format(result_tag)
-    img_file_name = "weights_mlp_{0}.png".format(result_tag)
-
-    # Get supervised and unsupervised portions of training data, and create
-    # arrays of start/end indices for easy minibatch slicing.
-    (Xtr_su, Ytr_su) = (datasets[0][0], T.cast(datasets[0][1], 'int32'))
-    (Xtr_un, Ytr_un) = (datasets[1][0], T.cast(datasets[1][1], 'int32'))
+    src_vars = [v for d in datasets for v in d]
+    for (dst, src) in zip(trainer['data'], src_vars):
+        if not (dst is src):
+            dst.set_value(src.get_value(borrow=True))
+    (Xtr_su, Ytr_su, Xtr_un, Ytr_un, Xva, Yva, Xte, Yte) = trainer['data']
     su_samples = Xtr_su.get_value(borrow=True).shape[0]
     un_samples = Xtr_un.get_value(borrow=True).shape[0]
-    tr_batches = 250
     su_bsize = batch_size / 2
     un_bsize = batch_size - su_bsize
     su_batches = int(np.ceil(float(su_samples) / su_bsize))
     un_batches = int(np.ceil(float(un_samples) / un_bsize))
     su_bidx = [[i*su_bsize, min(su_samples, (i+1)*su_bsize)] for i in range(su_batches)]
     un_bidx = [[i*un_bsize, min(un_samples, (i+1)*un_bsize)] for i in range(un_batches)]
-    su_bidx = theano.shared(value=np.asarray(su_bidx, dtype=theano.config.floatX))
-    un_bidx = theano.shared(value=np.asarray(un_bidx, dtype=theano.config.floatX))
-    su_bidx = T.cast(su_bidx, 'int32')
-    un_bidx = T.cast(un_bidx, 'int32')
-    # get the validation and testing sets and create arrays of start/end
-    # indices for easy minibatch slicing
-    Xva, Yva = (datasets[2][0], T.cast(datasets[2][1], 'int32'))
-    Xte, Yte = (datasets[3][0], T.cast(datasets[3][1], 'int32'))
     va_samples = Xva.get_value(borrow=True).shape[0]
     te_samples = Xte.get_value(borrow=True).shape[0]
-    va_batches = int(np.ceil(va_samples / 100.))
-    te_batches = int(np.ceil(te_samples / 100.))
-    va_bidx = [[i*100, min(va_samples, (i+1)*100)] for i in range(va_batches)]
-    te_bidx = [[i*100, min(te_samples, (i+1)*100)] for i in range(te_batches)]
-    va_bidx = theano.shared(value=np.asarray(va_bidx, dtype=theano.config.floatX))
-    te_bidx = theano.shared(value=np.asarray(te_bidx, dtype=theano.config.floatX))
-    va_bidx = T.cast(va_bidx, 'int32')
-    te_bidx = T.cast(te_bidx, 'int32')
+    va_bsize = eval_batch_size(NET, Xva, sgd_params)
+    te_bsize = eval_batch_size(NET, Xte, sgd_params)
+    va_batches = int(np.ceil(va_samples / float(va_bsize)))
+    te_batches = int(np.ceil(te_samples / float(te_bsize)))
+    va_bidx = [[i*va_bsize, min(va_samples, (i+1)*va_bsize)] for i in range(va_batches)]
+    va_rows = [(e_idx - s_idx) for (s_idx, e_idx) in va_bidx]
+    te_bidx = [[i*te_bsize, min(te_samples, (i+1)*te_bsize)] for i in range(te_batches)]
+    te_rows = [(e_idx - s_idx) for (s_idx, e_idx) in te_bidx]
+    for (name, bidx) in [('su', su_bidx), ('un', un_bidx), ('va', va_bidx), \
+                         ('te', te_bidx)]:
+        trainer['bidx'][name].set_value( \
+                np.asarray(bidx, dtype=theano.config.floatX))
+    batch_info = {'su_samples': su_samples, 'un_samples': un_samples, \
+                  'su_bsize': su_bsize, 'un_bsize': un_bsize, \
+                  'su_batches': su_batches, 'un_batches': un_batches, \
+                  'va_samples': va_samples, 'te_samples': te_samples, \
+                  'va_batches': va_batches, 'te_batches': te_batches, \
+                  'va_rows': va_rows, 'te_rows': te_rows}
+    return batch_info
+
+def _build_ss_mlp(NET, sgd_params, datasets):
+    """
+    Compile the functions used by train_ss_mlp, and return them in a dict,
+    along with the shared variables that hold the data and batch indices.
+    """
+    initial_learning_rate = sgd_params['start_rate']
+    learning_rate_decay = sgd_params['decay_rate']
+    wt_norm_bound = sgd_params['wt_norm_bound']
 
-    # Print some useful information about the dataset
-    print "dataset info:"
-    print "  supervised samples: {0:d}, unsupervised samples: {1:d}".format( \
-            su_samples, un_samples)
-    print "  samples/minibatch: {0:d}, minibatches/epoch: {1:d}".format( \
-            (su_bsize + un_bsize), tr_batches)
-    print "  validation samples: {0:d}, testing samples: {1:d}".format( \
-            va_samples, te_samples)
+    # Get supervised and unsupervised portions of training data, and make
+    # shared arrays of start/end indices for easy minibatch slicing. The
+    # indices get filled in by _set_ss_data.
+    data = [v for d in datasets for v in d]
+    bidx = {}
+    for name in ['su', 'un', 'va', 'te']:
+        bidx[name] = theano.shared(value=np.zeros((1, 2), \
+                dtype=theano.config.floatX))
+    (Xtr_su, Ytr_su) = (datasets[0][0], T.cast(datasets[0][1], 'int32'))
+    (Xtr_un, Ytr_un) = (datasets[1][0], T.cast(datasets[1][1], 'int32'))
+    Xva, Yva = (datasets[2][0], T.cast(datasets[2][1], 'int32'))
+    Xte, Yte = (datasets[3][0], T.cast(datasets[3][1], 'int32'))
+    su_bidx = T.cast(bidx['su'], 'int32')
+    un_bidx = T.cast(bidx['un'], 'int32')
+    va_bidx = T.cast(bidx['va'], 'int32')
+    te_bidx = T.cast(bidx['te'], 'int32')
 
     ######################
     # build actual model #
@@ -413,6 +542,64 @@ def train_ss_mlp(
     set_learning_rate = theano.function(inputs=[], outputs=learning_rate, \
             updates={learning_rate: learning_rate * learning_rate_decay})
 
+    trainer = {'NET': NET, 'data': data, 'bidx': bidx}
+    trainer['train_dev'] = train_dev
+    trainer['validate_model'] = validate_model
+    trainer['test_model'] = test_model
+    trainer['set_learning_rate'] = set_learning_rate
+    return trainer
+
+def train_ss_mlp(
+        NET,
+        sgd_params,
+        datasets):
+    """
+    Train NET using a mix of labeled an unlabeled data.
+
+    Datasets should be a four-tuple, in which the first item is a matrix/vector
+    pair of inputs/labels for training, the second item is a matrix of
+    unlabeled inputs for training, the third item is a matrix/vector pair of
+    inputs/labels for validation, and the fourth is a matrix/vector pair of
+    inputs/labels for testing.
+    """
+    n_epochs = sgd_params['epochs']
+    result_tag = sgd_params['result_tag']
+    txt_file_name = "results_mlp_{0}.txt".format(result_tag)
+    img_file_name = "weights_mlp_{0}.png".format(result_tag)
+
+    # Compile the model. The hidden layers draw their noise from CURAND
+    # streams, which fix their seeds when the graph gets built, so a compiled
+    # model can't be restarted for another trial.
+    trainer = _build_ss_mlp(NET, sgd_params, datasets)
+    batch_info = _set_ss_data(trainer, datasets, sgd_params)
+    tr_batches = 250
+    su_samples = batch_info['su_samples']
+    un_samples = batch_info['un_samples']
+    su_bsize = batch_info['su_bsize']
+    un_bsize = batch_info['un_bsize']
+    su_batches = batch_info['su_batches']
+    un_batches = batch_info['un_batches']
+    va_samples = batch_info['va_samples']
+    te_samples = batch_info['te_samples']
+    va_batches = batch_info['va_batches']
+    te_batches = batch_info['te_batches']
+    va_rows = batch_info['va_rows']
+    te_rows = batch_info['te_rows']
+
+    # Print some useful information about the dataset
+    print "dataset info:"
+    print "  supervised samples: {0:d}, unsupervised samples: {1:d}".format( \
+            su_samples, un_samples)
+    print "  samples/minibatch: {0:d}, minibatches/epoch: {1:d}".format( \
+            (su_bsize + un_bsize), tr_batches)
+    print "  validation samples: {0:d}, testing samples: {1:d}".format( \
+            va_samples, te_samples)
+
+    train_dev = trainer['train_dev']
+    validate_model = trainer['validate_model']
+    test_model = trainer['test_model']
+    set_learning_rate = trainer['set_learning_rate']
+
     ###############
     # train model #
     ###############
@@ -438,6 +625,7 @@ def train_ss_mlp(
     validation_metrics = validate_model(0)
     test_metrics = test_model(0)
     # compute metrics on testing set
+    stopper = EarlyStopper(_net_params(NET), sgd_params)
     while epoch_counter < n_epochs:
         ######################################################
         # process some number of minibatches for this epoch. #
@@ -454,6 +642,8 @@ def train_ss_mlp(
         train_metrics = [(float(v) / tr_batches) for v in train_metrics]
         # update the learning rate
         new_learning_rate = set_learning_rate()
+        if not stopper.should_eval(epoch_counter):
+            continue
 
         ######################################################
         # validation, testing, and general diagnostic stuff. #
@@ -461,23 +651,23 @@ def train_ss_mlp(
         # compute metrics on validation set
         validation_metrics = [0. for v in validation_metrics]
         for b_idx in xrange(va_batches):
-            batch_metrics = validate_model(b_idx)
+            batch_metrics = _weight_metrics(validate_model(b_idx), va_rows[b_idx])
             validation_metrics = [(em + bm) for (em, bm) in zip(validation_metrics, batch_metrics)]
         # Compute 'averaged' values over the minibatches
         validation_error = 100 * (float(validation_metrics[0]) / va_samples)
-        validation_loss = float(validation_metrics[1]) / va_batches
+        validation_loss = float(validation_metrics[1]) / va_samples
 
         # compute test error if new best validation error was found
         tag = " "
         # compute metrics on testing set
         test_metrics = [0. for v in test_metrics]
         for b_idx in xrange(te_batches):
-            batch_metrics = test_model(b_idx)
+            batch_metrics = _weight_metrics(test_model(b_idx), te_rows[b_idx])
             test_metrics = [(em + bm) for (em, bm) in zip(test_metrics, batch_metrics)]
         # Compute 'averaged' values over the minibatches
         test_error = 100 * (float(test_metrics[0]) / te_samples)
-        test_loss = float(test_metrics[1]) / te_batches
-        if (validation_error < min_validation_error):
+        test_loss = float(test_metrics[1]) / te_samples
+        if stopper.update(epoch_counter, validation_error):
             min_validation_error = validation_error
             min_test_error = test_error
             tag = ", test={0:.2f}".format(test_error)
@@ -494,9 +684,15 @@ def train_ss_mlp(
         e_time = time.clock()
         # save first layer weights to an image locally
         utils.visualize(NET, 0, 0, img_file_name)
+        if stopper.should_stop(epoch_counter):
+            print("no new best in {0:d} epochs, stopping early".format( \
+                    stopper.patience))
+            break
 
+    stopper.finish()
     print("optimization complete. best validation error {0:.4f}, with test error {1:.4f}".format( \
           (min_validation_error), (min_test_error)))
+    return
 
 def train_dae(
     NET,
@@ -532,10 +728,14 @@ def train_dae(
     Xte = datasets[2][0]
     va_samples = Xva.get_value(borrow=True).shape[0]
     te_samples = Xte.get_value(borrow=True).shape[0]
-    va_batches = int(np.ceil(va_samples / 100.))
-    te_batches = int(np.ceil(te_samples / 100.))
-    va_bidx = [[i*100, min(va_samples, (i+1)*100)] for i in range(va_batches)]
-    te_bidx = [[i*100, min(te_samples, (i+1)*100)] for i in range(te_batches)]
+    va_bsize = eval_batch_size(NET, Xva, sgd_params)
+    te_bsize = eval_batch_size(NET, Xte, sgd_params)
+    va_batches = int(np.ceil(va_samples / float(va_bsize)))
+    te_batches = int(np.ceil(te_samples / float(te_bsize)))
+    va_bidx = [[i*va_bsize, min(va_samples, (i+1)*va_bsize)] for i in range(va_batches)]
+    va_rows = [(e_idx - s_idx) for (s_idx, e_idx) in va_bidx]
+    te_bidx = [[i*te_bsize, min(te_samples, (i+1)*te_bsize)] for i in range(te_batches)]
+    te_rows = [(e_idx - s_idx) for (s_idx, e_idx) in te_bidx]
     va_bidx = theano.shared(value=np.asarray(va_bidx, dtype=theano.config.floatX))
     te_bidx = theano.shared(value=np.asarray(te_bidx, dtype=theano.config.floatX))
     va_bidx = T.cast(va_bidx, 'int32')
@@ -641,7 +841,6 @@ def train_dae(
 
     validation_loss = 1e6
     test_loss = 1e6
-    min_validation_loss = 1e6
     min_test_loss = 1e6
     epoch_counter = 0
     start_time = time.clock()
@@ -652,6 +851,7 @@ def train_dae(
     results_file.flush()
 
     train_metrics = train_NET(1, 0)
+    stopper = EarlyStopper(opt_params, sgd_params)
     while epoch_counter < n_epochs:
         ######################################################
         # Process some number of minibatches for this epoch. #
@@ -669,22 +869,26 @@ def train_dae(
 
         # Update the learning rate
         new_learning_rate = set_learning_rate()
+        if not stopper.should_eval(epoch_counter):
+            continue
 
         ######################################################
         # Validation, testing, and general diagnostic stuff. #
         ######################################################
         # Compute metrics on validation set
         validation_metrics = [validate_model(i) for i in xrange(va_batches)]
-        validation_loss = np.mean([vm[0] for vm in validation_metrics])
+        validation_loss = np.average([vm[0] for vm in validation_metrics], \
+                                     weights=va_rows)
 
         # Compute test error if new best validation error was found
         tag = " "
-        if ((validation_loss < min_validation_loss) or ((epoch_counter % 10) == 0)):
+        new_best = stopper.update(epoch_counter, validation_loss)
+        if (new_best or ((epoch_counter % 10) == 0)):
             # Compute metrics on testing set
             test_metrics = [test_model(i) for i in xrange(te_batches)]
-            test_loss = np.mean([tm[0] for tm in test_metrics])
-            if (validation_loss < min_validation_loss):
-                min_validation_loss = validation_loss
+            test_loss = np.average([tm[0] for tm in test_metrics], \
+                                   weights=te_rows)
+            if new_best:
                 min_test_loss = test_loss
                 tag = ", te_loss={0:.4f}".format(test_loss)
         results_file.write("{0:.4f} {1:.4f}\n".format(validation_loss, test_loss))
@@ -696,6 +900,13 @@ def train_dae(
         print "--time: {0:.4f}".format((time.clock() - e_time))
         # Save first layer weights to an image locally
         utils.visualize(NET, 0, 0, img_file_name)
+        if stopper.should_stop(epoch_counter):
+            print("no new best in {0:d} epochs, stopping early".format( \
+                    stopper.patience))
+            break
+
+    stopper.finish()
+    return
 
 
 
@@ -109,13 +109,11 @@ def load_udm_ss(dataset, sup_count, rng, zero_mean=True):
 
     return rval
 
-def load_udm(dataset, as_shared=True, zero_mean=True):
-    """Loads the UdM train/validate/test split of MNIST."""
-
-    #############
-    # LOAD DATA #
-    #############
+UDM_ARRAY_NAMES = ['train_x', 'train_y', 'valid_x', 'valid_y', \
+                   'test_x', 'test_y']
 
+def _read_udm_pickle(dataset):
+    """Read the (train, valid, test) sets from the pickled UdM MNIST file."""
     # Download the MNIST dataset if it is not present
     data_dir, data_file = os.path.split(dataset)
     if (not os.path.isfile(dataset)) and data_file == 'mnist.pkl.gz':
@@ -130,6 +128,50 @@ def load_udm(dataset, as_shared=True, zero_mean=True):
     f = gzip.open(dataset, 'rb')
     train_set, valid_set, test_set = cPickle.load(f)
     f.close()
+    return train_set, valid_set, test_set
+
+def _load_udm_arrays(data_dir):
+    """Read the (train, valid, test) sets saved by save_udm_arrays."""
+    print '... loading data from %s' % data_dir
+    arrays = []
+    for name in UDM_ARRAY_NAMES:
+        f_name = os.path.join(data_dir, "{0:s}.npy".format(name))
+        arrays.append(np.load(f_name))
+    return arrays[0:2], arrays[2:4], arrays[4:6]
+
+def save_udm_arrays(dataset, data_dir):
+    """Save the UdM MNIST data as raw .npy files in data_dir.
+
+    Passing data_dir as the dataset for load_udm/load_udm_ss then reads these
+    files, rather than unzipping and unpickling mnist.pkl.gz. Each process
+    still gets its own copy of the data, as load_udm converts and centers it.
+    """
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    train_set, valid_set, test_set = _read_udm_pickle(dataset)
+    arrays = [np.asarray(train_set[0], dtype=np.float32), train_set[1], \
+              np.asarray(valid_set[0], dtype=np.float32), valid_set[1], \
+              np.asarray(test_set[0], dtype=np.float32), test_set[1]]
+    for (name, array) in zip(UDM_ARRAY_NAMES, arrays):
+        np.save(os.path.join(data_dir, "{0:s}.npy".format(name)), array)
+    return data_dir
+
+def load_udm(dataset, as_shared=True, zero_mean=True):
+    """Loads the UdM train/validate/test split of MNIST.
+
+    The dataset can be either the pickled mnist.pkl.gz, or a directory written
+    by save_udm_arrays.
+    """
+
+    #############
+    # LOAD DATA #
+    #############
+
+    if os.path.isdir(dataset):
+        # Read the arrays written by save_udm_arrays
+        train_set, valid_set, test_set = _load_udm_arrays(dataset)
+    else:
+        train_set, valid_set, test_set = _read_udm_pickle(dataset)
     #train_set, valid_set, test_set format: tuple(input, target)
     #input is an np.ndarray of 2 dimensions (a matrix)
     #witch row's correspond to an example. target is a
@@ -139,9 +181,9 @@ def load_udm(dataset, as_shared=True, zero_mean=True):
     train_set = [v for v in train_set]
     valid_set = [v for v in valid_set]
     test_set = [v for v in test_set]
-    train_set[0] = np.asarray(train_set[0]).astype(np.float32)
-    valid_set[0] = np.asarray(valid_set[0]).astype(np.float32)
-    test_set[0] = np.asarray(test_set[0]).astype(np.float32)
+    train_set[0] = np.asarray(train_set[0], dtype=np.float32)
+    valid_set[0] = np.asarray(valid_set[0], dtype=np.float32)
+    test_set[0] = np.asarray(test_set[0], dtype=np.float32)
     if zero_mean:
         obs_mean = np.mean(train_set[0], axis=0, keepdims=True)
         train_set[0] = train_set[0] - obs_mean
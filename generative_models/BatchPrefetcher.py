@@ -0,0 +1,151 @@
+##################################################################
+# Code for building training minibatches in the background, so   #
+# compiled training functions don't wait on python-side batch    #
+# construction (sampling indices, masks, repeats, etc).          #
+##################################################################
+
+# basic python
+import time
+import threading
+import traceback
+import multiprocessing
+import Queue
+import numpy as np
+import numpy.random as npr
+
+
+def _thread_worker(make_batch, batch_queue, stop_event):
+    """
+    Repeatedly call make_batch() and put its results in batch_queue, until
+    stop_event gets set.
+    """
+    while not stop_event.is_set():
+        try:
+            batch = ('batch', make_batch())
+        except Exception:
+            batch = ('error', traceback.format_exc())
+        while not stop_event.is_set():
+            try:
+                batch_queue.put(batch, True, 0.1)
+                break
+            except Queue.Full:
+                continue
+        if batch[0] == 'error':
+            break
+    return
+
+def _process_worker(make_batch, batch_queue, stop_event, seed):
+    """
+    Same as _thread_worker, but for running in a child process. The child
+    gets its own seed, so that forked workers don't produce the same batches.
+    """
+    npr.seed(seed)
+    _thread_worker(make_batch, batch_queue, stop_event)
+    return
+
+class BatchPrefetcher(object):
+    """
+    Run make_batch() in some background workers, and hand out its results
+    through a bounded queue.
+
+    Parameters:
+        make_batch: function taking no arguments and returning a minibatch
+                    (e.g. a tuple of numpy arrays ready for train_joint)
+        queue_size: maximum number of minibatches to build ahead of time
+        worker_count: number of background workers to run
+        use_processes: whether to use processes rather than threads for the
+                       workers -- processes avoid contention for the GIL, but
+                       only see the state of the program from when they were
+                       started, and have to pickle each minibatch
+        seed: base seed for the numpy rngs of process workers
+
+    Batches are pulled with next(), or by iterating over the prefetcher.
+    Workers are stopped by close(), which is also called on deletion.
+    """
+    def __init__(self, make_batch, queue_size=8, worker_count=1, \
+                 use_processes=False, seed=None):
+        self.make_batch = make_batch
+        self.queue_size = queue_size
+        self.worker_count = worker_count
+        self.use_processes = use_processes
+        if seed is None:
+            seed = npr.randint(100000)
+        self.workers = []
+        if self.use_processes:
+            self.batch_queue = multiprocessing.Queue(maxsize=queue_size)
+            self.stop_event = multiprocessing.Event()
+            for i in range(worker_count):
+                worker = multiprocessing.Process(target=_process_worker, \
+                        args=(make_batch, self.batch_queue, self.stop_event, \
+                              seed + i))
+                self.workers.append(worker)
+        else:
+            self.batch_queue = Queue.Queue(maxsize=queue_size)
+            self.stop_event = threading.Event()
+            for i in range(worker_count):
+                worker = threading.Thread(target=_thread_worker, \
+                        args=(make_batch, self.batch_queue, self.stop_event))
+                self.workers.append(worker)
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+        # for measuring time spent waiting on the workers
+        self.batch_count = 0
+        self.wait_time = 0.0
+        return
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """
+        Get the next minibatch, blocking until one is ready.
+        """
+        t0 = time.time()
+        while True:
+            try:
+                (kind, batch) = self.batch_queue.get(True, 1.0)
+                break
+            except Queue.Empty:
+                if not any([w.is_alive() for w in self.workers]):
+                    raise RuntimeError("BatchPrefetcher: all workers died.")
+        self.wait_time += time.time() - t0
+        self.batch_count += 1
+        if kind == 'error':
+            self.close()
+            raise RuntimeError("BatchPrefetcher: make_batch failed:\n" + \
+                    batch)
+        return batch
+
+    def close(self):
+        """
+        Stop the background workers.
+        """
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.join(1.0)
+            if self.use_processes and worker.is_alive():
+                worker.terminate()
+        self.workers = []
+        return
+
+    def __del__(self):
+        if len(self.workers) > 0:
+            self.close()
+        return
+
+if __name__=="__main__":
+    # check that batches come through, and how long the consumer waited
+    def make_batch():
+        idx = npr.randint(low=0, high=1000, size=(100,))
+        X = np.repeat(npr.rand(1000, 784).take(idx, axis=0), 5, axis=0)
+        return [X, 0.0*X, 0.0*X]
+    for use_procs in [False, True]:
+        BP = BatchPrefetcher(make_batch, queue_size=4, worker_count=2, \
+                use_processes=use_procs)
+        for i in range(50):
+            Xd, Xc, Xm = BP.next()
+            assert(Xd.shape == (500, 784))
+        BP.close()
+        print("use_processes={0:s}: waited {1:.4f}s over {2:d} batches".format( \
+                str(use_procs), BP.wait_time, BP.batch_count))
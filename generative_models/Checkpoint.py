@@ -0,0 +1,515 @@
+##################################################################
+# Code for saving/loading model parameters in a binary format:   #
+# a small pickled header followed by an aligned blob holding the #
+# raw bytes of every parameter array. The blob can be memory-    #
+# mapped, so loading doesn't unpickle or copy the parameters.    #
+# Also, a manager for writing periodic training checkpoints in   #
+# the background.                                                #
+##################################################################
+
+# basic python
+import os
+import re
+import glob
+import time
+import struct
+import cPickle
+import tempfile
+import threading
+import traceback
+import Queue
+import numpy as np
+
+# theano business
+import theano
+from theano.compile.sharedvalue import SharedVariable
+from theano.gof.graph import inputs as graph_inputs
+
+# phil's sweetness
+from FuncCache import _creation_index, _set_default_mode, _is_tensor_var
+
+# file layout:
+#   CKPT_MAGIC | header length (uint64, little-endian) | pickled header |
+#   zero padding | tensor blob
+# the blob starts at a multiple of CKPT_ALIGN bytes, and so does each tensor
+# in it (w.r.t. the start of the file)
+CKPT_MAGIC = 'GMCKPT\x00\x01'
+CKPT_ALIGN = 64
+CKPT_VERSION = 1
+
+def _align(n):
+    """
+    Round n up to a multiple of CKPT_ALIGN.
+    """
+    return ((n + CKPT_ALIGN - 1) // CKPT_ALIGN) * CKPT_ALIGN
+
+def _numpy_value(param):
+    """
+    Get a C-contiguous numpy array holding the value of param, which is
+    either a theano shared variable or something array-like.
+    """
+    if hasattr(param, 'get_value'):
+        param = param.get_value(borrow=True)
+    return np.ascontiguousarray(param)
+
+def is_checkpoint_file(f_name):
+    """
+    Check whether f_name was written by write_checkpoint (rather than being,
+    e.g., one of the old multi-pickle parameter files).
+    """
+    f_handle = open(f_name, 'rb')
+    magic = f_handle.read(len(CKPT_MAGIC))
+    f_handle.close()
+    return (magic == CKPT_MAGIC)
+
+def write_checkpoint(f_name, meta, param_groups):
+    """
+    Write a checkpoint to f_name.
+
+    Parameters:
+        f_name: file to write the checkpoint to
+        meta: picklable "simple" python values to store in the header (e.g.
+              the params dict used to build a model)
+        param_groups: dict mapping group names to lists of dicts, each of
+                      which maps names to theano shared variables or numpy
+                      arrays (i.e. a model's shared_param_dicts)
+
+    The checkpoint is written to a temp file which is then renamed to f_name,
+    so a crash mid-write never clobbers the previous checkpoint.
+    """
+    # describe the layout of the tensor blob
+    layout = {}
+    tensors = []
+    values = []
+    offset = 0
+    for group in sorted(param_groups.keys()):
+        layout[group] = len(param_groups[group])
+        for (idx, param_dict) in enumerate(param_groups[group]):
+            for key in sorted(param_dict.keys()):
+                val = _numpy_value(param_dict[key])
+                tensors.append({'group': group, 'index': idx, 'key': key, \
+                        'dtype': val.dtype.str, 'shape': val.shape, \
+                        'offset': offset, 'nbytes': val.nbytes})
+                values.append(val)
+                offset = _align(offset + val.nbytes)
+    header = cPickle.dumps({'version': CKPT_VERSION, 'meta': meta, \
+            'layout': layout, 'tensors': tensors}, protocol=-1)
+    data_start = _align(len(CKPT_MAGIC) + 8 + len(header))
+    # write to a temp file in the same directory, then rename into place
+    f_dir = os.path.dirname(os.path.abspath(f_name))
+    fd, tmp_name = tempfile.mkstemp(dir=f_dir, suffix='.tmp')
+    f_handle = os.fdopen(fd, 'wb')
+    try:
+        f_handle.write(CKPT_MAGIC)
+        f_handle.write(struct.pack('<Q', len(header)))
+        f_handle.write(header)
+        pos = len(CKPT_MAGIC) + 8 + len(header)
+        for (info, val) in zip(tensors, values):
+            start = data_start + info['offset']
+            f_handle.write('\x00' * (start - pos))
+            val.tofile(f_handle)
+            pos = start + info['nbytes']
+        f_handle.close()
+        _set_default_mode(tmp_name)
+        os.rename(tmp_name, f_name)
+    except:
+        f_handle.close()
+        os.remove(tmp_name)
+        raise
+    return
+
+def read_checkpoint(f_name, groups=None, mmap_mode='c'):
+    """
+    Read a checkpoint written by write_checkpoint.
+
+    Parameters:
+        f_name: file to read the checkpoint from
+        groups: names of the parameter groups to load (None loads all)
+        mmap_mode: how to memory-map the tensor blob -- the default 'c' is
+                   copy-on-write, so arrays can be modified in place without
+                   touching the file. If this is None, the arrays are read
+                   into memory instead.
+    Outputs:
+        meta: the meta values passed to write_checkpoint
+        param_groups: dict mapping each loaded group name to a list of dicts
+                      mapping names to numpy arrays
+    """
+    f_handle = open(f_name, 'rb')
+    magic = f_handle.read(len(CKPT_MAGIC))
+    assert(magic == CKPT_MAGIC)
+    header_len = struct.unpack('<Q', f_handle.read(8))[0]
+    header = cPickle.loads(f_handle.read(header_len))
+    data_start = _align(len(CKPT_MAGIC) + 8 + header_len)
+    if groups is None:
+        groups = header['layout'].keys()
+    param_groups = {}
+    for group in groups:
+        param_groups[group] = \
+                [{} for i in range(header['layout'][group])]
+    # map (or read) the whole tensor blob, and take views of it
+    tensors = [t for t in header['tensors'] if (t['group'] in param_groups)]
+    blob_size = max([(t['offset'] + t['nbytes']) for t in tensors] + [0])
+    if blob_size == 0:
+        blob = np.zeros((0,), dtype=np.uint8)
+    elif mmap_mode is None:
+        f_handle.seek(data_start)
+        blob = np.fromfile(f_handle, dtype=np.uint8, count=blob_size)
+    else:
+        blob = np.memmap(f_name, dtype=np.uint8, mode=mmap_mode, \
+                offset=data_start, shape=(blob_size,))
+    f_handle.close()
+    for t in tensors:
+        start = t['offset']
+        val = blob[start:(start + t['nbytes'])].view(np.dtype(t['dtype']))
+        param_groups[t['group']][t['index']][t['key']] = \
+                val.reshape(t['shape'])
+    return [header['meta'], param_groups]
+
+def shared_param_dicts_from_numpy(numpy_dicts):
+    """
+    Make theano shared variables for a list of dicts of numpy arrays. Arrays
+    that already have dtype floatX are used without copying.
+    """
+    shared_dicts = []
+    for numpy_dict in numpy_dicts:
+        shared_dict = {}
+        for key in numpy_dict:
+            val = numpy_dict[key]
+            if val.dtype == theano.config.floatX:
+                shared_dict[key] = theano.shared(val, borrow=True)
+            else:
+                shared_dict[key] = \
+                        theano.shared(val.astype(theano.config.floatX))
+        shared_dicts.append(shared_dict)
+    return shared_dicts
+
+def set_params_from_checkpoint(f_name, param_groups, groups=None):
+    """
+    Set the values of the shared variables in param_groups (a dict, as for
+    write_checkpoint) to those stored in the checkpoint f_name. Only the
+    groups named in groups are touched (None means all groups). Parameters
+    missing from either side are skipped.
+    """
+    meta, numpy_groups = read_checkpoint(f_name, groups=groups)
+    for group in numpy_groups:
+        if not (group in param_groups):
+            continue
+        for (shared_dict, numpy_dict) in \
+                zip(param_groups[group], numpy_groups[group]):
+            for key in numpy_dict:
+                if not (key in shared_dict):
+                    continue
+                val = numpy_dict[key].astype(theano.config.floatX)
+                old_shape = shared_dict[key].get_value(borrow=True).shape
+                assert(old_shape == val.shape)
+                shared_dict[key].set_value(val, borrow=True)
+    return meta
+
+def training_state_vars(updates, exclude=None):
+    """
+    Get the shared variables that a training function with the given updates
+    reads or writes (i.e. params, optimizer moments, learning rates, etc.),
+    in the order in which they were created. For a model built by the same
+    code, this order is the same from one run to the next.
+
+    Only array-valued variables are included. Random generator state (e.g.
+    the CURAND generators behind rng.normal in InfNet/GenNet) can't go in a
+    checkpoint, and is just restarted from its seed on restore.
+    """
+    if exclude is None:
+        exclude = []
+    state_vars = [v for v in graph_inputs(list(updates.values())) \
+            if isinstance(v, SharedVariable)]
+    state_vars.extend(updates.keys())
+    state_vars = [v for v in set(state_vars) \
+            if _is_tensor_var(v) and not (v in exclude)]
+    state_vars.sort(key=_creation_index)
+    return state_vars
+
+class CheckpointManager(object):
+    """
+    Write periodic checkpoints of a model's training state in the background.
+
+    Each call to save() copies the current values of the state variables into
+    one of two host-side buffers, and a background thread writes the buffer
+    to "<ckpt_dir>/<prefix>_<step>.ckpt" while training continues. save() only
+    blocks if both buffers are still waiting to be written. Only the most
+    recent keep_last checkpoints are kept on disk. add_export() sets up more
+    files to write from each snapshot (e.g. the files save_to_file writes for
+    an InfNet or GenNet), so those don't block training either.
+
+    Parameters:
+        model: model whose training state to checkpoint, i.e. the shared
+               variables used by model.joint_updates (works for GIPair,
+               VCGLoop, TwoStageModel and GIStack)
+        ckpt_dir: directory to write the checkpoints in
+        prefix: prefix for the checkpoint file names
+        keep_last: number of checkpoints to keep
+        state_vars: explicit list of shared variables to checkpoint, to use
+                    instead of the ones found through model
+        exclude: shared variables to leave out of the checkpoints (e.g. a
+                 device-resident copy of the training set)
+    """
+    def __init__(self, model=None, ckpt_dir=None, prefix='ckpt', \
+                 keep_last=3, state_vars=None, exclude=None):
+        assert(not (ckpt_dir is None))
+        if state_vars is None:
+            state_vars = training_state_vars(model.joint_updates, \
+                    exclude=exclude)
+        self.state_vars = state_vars
+        # variables to snapshot: the state vars, then any extra ones that
+        # exports need
+        self.snap_vars = list(state_vars)
+        self.exports = []
+        self.ckpt_dir = ckpt_dir
+        self.prefix = prefix
+        self.keep_last = keep_last
+        if not os.path.exists(ckpt_dir):
+            os.makedirs(ckpt_dir)
+        # double-buffered host copies of the state variables
+        self.buffers = [None, None]
+        self.buffer_free = [threading.Event(), threading.Event()]
+        for event in self.buffer_free:
+            event.set()
+        self.next_buffer = 0
+        # background writer
+        self.error = None
+        self.write_queue = Queue.Queue()
+        self.writer = threading.Thread(target=self._write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+        # for measuring time spent blocking the training loop
+        self.save_count = 0
+        self.save_time = 0.0
+        return
+
+    def checkpoint_name(self, step):
+        """
+        Get the file name for the checkpoint at the given step.
+        """
+        f_name = "{0:s}_{1:09d}.ckpt".format(self.prefix, step)
+        return os.path.join(self.ckpt_dir, f_name)
+
+    def list_checkpoints(self):
+        """
+        Get (step, file name) pairs for the checkpoints in ckpt_dir, sorted
+        by step.
+        """
+        pattern = re.compile(re.escape(self.prefix) + r"_(\d+)\.ckpt$")
+        ckpts = []
+        for f_name in glob.glob(os.path.join(self.ckpt_dir, '*.ckpt')):
+            match = pattern.match(os.path.basename(f_name))
+            if not (match is None):
+                ckpts.append((int(match.group(1)), f_name))
+        ckpts.sort()
+        return ckpts
+
+    def save(self, step, meta=None):
+        """
+        Snapshot the state variables and queue them for writing, as the
+        checkpoint for the given step. meta can hold extra picklable info.
+        """
+        if not (self.error is None):
+            raise RuntimeError("CheckpointManager: write failed:\n" + \
+                    self.error)
+        t0 = time.time()
+        buf_idx = self.next_buffer
+        self.next_buffer = 1 - buf_idx
+        self.buffer_free[buf_idx].wait()
+        self.buffer_free[buf_idx].clear()
+        if self.buffers[buf_idx] is None:
+            self.buffers[buf_idx] = []
+        buf = self.buffers[buf_idx]
+        buf.extend([None for v in self.snap_vars[len(buf):]])
+        for (i, var) in enumerate(self.snap_vars):
+            val = var.get_value(borrow=True)
+            if (buf[i] is None) or (buf[i].shape != val.shape):
+                buf[i] = np.empty_like(val)
+            np.copyto(buf[i], val)
+        self.write_queue.put((step, buf_idx, meta))
+        self.save_time += time.time() - t0
+        self.save_count += 1
+        return
+
+    def add_export(self, f_name, meta, param_groups):
+        """
+        After each checkpoint, also write the values in param_groups to
+        f_name with write_checkpoint(f_name, meta, param_groups), using the
+        snapshot taken by save(). param_groups is as for write_checkpoint,
+        with shared variables for the values.
+        """
+        snap_idx = dict([(id(v), i) for (i, v) in enumerate(self.snap_vars)])
+        idx_groups = {}
+        for group in param_groups:
+            idx_groups[group] = []
+            for param_dict in param_groups[group]:
+                idx_dict = {}
+                for key in param_dict:
+                    var = param_dict[key]
+                    if not (id(var) in snap_idx):
+                        snap_idx[id(var)] = len(self.snap_vars)
+                        self.snap_vars.append(var)
+                    idx_dict[key] = snap_idx[id(var)]
+                idx_groups[group].append(idx_dict)
+        self.exports.append((f_name, meta, idx_groups))
+        return
+
+    def _write_exports(self, buf):
+        """
+        Write the files set up by add_export, from the snapshot in buf.
+        """
+        for (f_name, meta, idx_groups) in self.exports:
+            val_groups = {}
+            for group in idx_groups:
+                val_groups[group] = [dict([(key, buf[idx]) for (key, idx) \
+                        in idx_dict.items()]) for idx_dict in idx_groups[group]]
+            write_checkpoint(f_name, meta, val_groups)
+        return
+
+    def _write_loop(self):
+        """
+        Write the snapshots queued by save(), until told to stop.
+        """
+        while True:
+            item = self.write_queue.get()
+            if item is None:
+                self.write_queue.task_done()
+                break
+            step, buf_idx, meta = item
+            try:
+                buf = self.buffers[buf_idx]
+                state_dict = {}
+                for i in range(len(self.state_vars)):
+                    state_dict["v{0:05d}".format(i)] = buf[i]
+                ckpt_meta = {'step': step, 'meta': meta, \
+                        'var_names': [str(v.name) for v in self.state_vars]}
+                write_checkpoint(self.checkpoint_name(step), ckpt_meta, \
+                        {'state': [state_dict]})
+                self._write_exports(buf)
+                # only keep the most recent checkpoints
+                for (old_step, f_name) in \
+                        self.list_checkpoints()[:-self.keep_last]:
+                    os.remove(f_name)
+            except Exception:
+                self.error = traceback.format_exc()
+            finally:
+                self.buffer_free[buf_idx].set()
+                self.write_queue.task_done()
+        return
+
+    def wait(self):
+        """
+        Block until all queued checkpoints have been written.
+        """
+        self.write_queue.join()
+        if not (self.error is None):
+            raise RuntimeError("CheckpointManager: write failed:\n" + \
+                    self.error)
+        return
+
+    def close(self):
+        """
+        Write any queued checkpoints, then stop the background writer.
+        """
+        if self.writer.is_alive():
+            self.write_queue.put(None)
+            self.writer.join()
+        return
+
+    def restore(self, f_name=None):
+        """
+        Set the state variables to the values in the checkpoint f_name, or in
+        the latest checkpoint in ckpt_dir if f_name is None. This returns the
+        step at which the checkpoint was saved, or None if there was nothing
+        to restore. The checkpoint's meta info goes in self.restored_meta.
+        """
+        if f_name is None:
+            ckpts = self.list_checkpoints()
+            if len(ckpts) == 0:
+                return None
+            f_name = ckpts[-1][1]
+        ckpt_meta, param_groups = read_checkpoint(f_name)
+        state_dict = param_groups['state'][0]
+        assert(len(state_dict) == len(self.state_vars))
+        for (i, var) in enumerate(self.state_vars):
+            val = state_dict["v{0:05d}".format(i)]
+            assert(val.shape == var.get_value(borrow=True).shape)
+            var.set_value(np.array(val, dtype=var.dtype), borrow=True)
+        self.restored_meta = ckpt_meta['meta']
+        print("CheckpointManager: restored step {0:d} from {1:s}".format( \
+                ckpt_meta['step'], f_name))
+        return ckpt_meta['step']
+
+if __name__=="__main__":
+    # check that a checkpoint round-trips, in full and in part
+    f_name = "test_checkpoint.ckpt"
+    param_groups = {'shared': [{'W': np.random.randn(7, 5), \
+                                'b': np.arange(5).astype(np.float32)}], \
+                    'mu': [{}, {'W': np.ones((3, 3), dtype=np.float32)}]}
+    write_checkpoint(f_name, {'prior_sigma': 1.0}, param_groups)
+    assert(is_checkpoint_file(f_name))
+    for mmap_mode in ['c', None]:
+        meta, loaded = read_checkpoint(f_name, mmap_mode=mmap_mode)
+        assert(meta['prior_sigma'] == 1.0)
+        for group in param_groups:
+            for (d1, d2) in zip(param_groups[group], loaded[group]):
+                for key in d1:
+                    assert(np.all(d1[key] == d2[key]))
+                    assert(d1[key].dtype == d2[key].dtype)
+    meta, loaded = read_checkpoint(f_name, groups=['mu'])
+    assert(loaded.keys() == ['mu'])
+    os.remove(f_name)
+    # check that the manager writes, prunes and restores checkpoints
+    state_vars = [theano.shared(np.random.randn(50, 20)), \
+                  theano.shared(np.zeros((20,)))]
+    CM = CheckpointManager(ckpt_dir="test_checkpoints", keep_last=2, \
+            state_vars=state_vars)
+    for step in range(5):
+        state_vars[1].set_value(step + np.zeros((20,)))
+        CM.save(step)
+    CM.wait()
+    assert([s for (s, f) in CM.list_checkpoints()] == [3, 4])
+    state_vars[1].set_value(np.zeros((20,)))
+    assert(CM.restore() == 4)
+    assert(np.all(state_vars[1].get_value() == 4.0))
+    CM.close()
+    for (step, f_name) in CM.list_checkpoints():
+        os.remove(f_name)
+    # check a model with random noise: generator state (RandomStreams, plus
+    # CURAND when there's a gpu) is left out, and exports get written
+    import theano.tensor as T
+    from theano.tensor.shared_randomstreams import RandomStreams
+    W = theano.shared(np.ones((5, 3), dtype=theano.config.floatX))
+    C = theano.shared(np.ones((3,), dtype=theano.config.floatX))
+    Xn = T.matrix()
+    Yn = T.dot(Xn + RandomStreams(12345).normal(size=Xn.shape), W)
+    import theano.sandbox.cuda as cuda
+    if cuda.cuda_available:
+        from theano.sandbox.cuda.rng_curand import CURAND_RandomStreams
+        Yn = Yn + CURAND_RandomStreams(123).normal(size=Yn.shape, \
+                dtype=theano.config.floatX)
+    noise_updates = {W: (W - 0.01 * T.grad(T.sum(Yn**2.0), W))}
+    train_noise = theano.function([Xn], Yn, updates=noise_updates)
+    train_noise(np.ones((4, 5), dtype=theano.config.floatX))
+    noise_vars = training_state_vars(noise_updates)
+    assert((len(noise_vars) == 1) and (noise_vars[0] is W))
+    CM = CheckpointManager(ckpt_dir="test_checkpoints", keep_last=2, \
+            state_vars=noise_vars)
+    CM.add_export("test_export.ckpt", {'note': 'W and C'}, \
+            {'layers': [{'W': W, 'C': C}]})
+    CM.save(7)
+    CM.wait()
+    W_val = W.get_value()
+    W.set_value(0.0 * W_val)
+    assert(CM.restore() == 7)
+    assert(np.all(W.get_value() == W_val))
+    meta, loaded = read_checkpoint("test_export.ckpt")
+    assert(meta['note'] == 'W and C')
+    assert(np.all(loaded['layers'][0]['W'] == W_val))
+    assert(np.all(loaded['layers'][0]['C'] == 1.0))
+    CM.close()
+    for (step, f_name) in CM.list_checkpoints():
+        os.remove(f_name)
+    os.remove("test_export.ckpt")
+    os.rmdir("test_checkpoints")
+    print("CHECKPOINT TESTS PASSED.")
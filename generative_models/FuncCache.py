@@ -0,0 +1,298 @@
+##################################################################
+# Code for caching compiled theano functions on disk, so models  #
+# with identical computation graphs can skip recompilation, and  #
+# for deferring compilation until a function is first used.      #
+##################################################################
+
+# basic python
+import os
+import sys
+import hashlib
+import cPickle
+import tempfile
+import numpy as np
+
+# theano business
+import theano
+from theano.compile.sharedvalue import SharedVariable
+from theano.gof.graph import inputs as graph_inputs
+from theano.gof.graph import ancestors as graph_ancestors
+from theano.gof.graph import Constant
+from theano.tensor import TensorType
+try:
+    from theano.sandbox.cuda.type import CudaNdarrayType
+    TENSOR_TYPES = (TensorType, CudaNdarrayType)
+except ImportError:
+    TENSOR_TYPES = (TensorType,)
+
+
+def _current_umask():
+    """
+    Get the process umask, which can only be read by setting it.
+    """
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+# read once, since reading the umask briefly changes it for all threads
+_UMASK = _current_umask()
+
+def _set_default_mode(f_name):
+    """
+    Give the file f_name the permissions that a file created with open()
+    would get. mkstemp always makes files readable only by their owner.
+    """
+    os.chmod(f_name, (0o666 & ~_UMASK))
+    return
+
+def _is_tensor_var(var):
+    """
+    Check whether var holds an array (on the host or the gpu), rather than
+    some other python object (e.g. a CURAND generator or a RandomState).
+    """
+    return isinstance(var.type, TENSOR_TYPES)
+
+def _creation_index(var):
+    """
+    Get the position of var in the order in which theano variables were
+    created. For a model built by the same code, the relative creation order
+    of its variables is the same from one run to the next.
+    """
+    return int(var.auto_name.split('_')[-1])
+
+def _as_pairs(x):
+    """
+    Get (key, value) pairs from a dict or list of pairs, sorted by the
+    creation order of the keys so that the result is the same across runs.
+    """
+    if x is None:
+        return []
+    if isinstance(x, dict):
+        x = x.items()
+    pairs = list(x)
+    pairs.sort(key=lambda kv: _creation_index(kv[0]))
+    return pairs
+
+def _hidden_details(all_vars):
+    """
+    Describe the parts of the graph for all_vars that debugprint leaves out:
+    the seeds of random ops (e.g. CURAND ops don't print theirs) and the full
+    values of constants (long ones get abbreviated).
+    """
+    details = []
+    for v in graph_ancestors(all_vars):
+        if isinstance(v, Constant):
+            try:
+                data = np.asarray(v.data)
+                data_str = data.dtype.str + str(data.shape) + data.tostring()
+            except Exception:
+                data_str = repr(v.data)
+            details.append("const " + hashlib.sha1(data_str).hexdigest())
+        elif (not (v.owner is None)) and hasattr(v.owner.op, '_config'):
+            details.append("op " + str(v.owner.op._config()))
+        elif (not (v.owner is None)) and hasattr(v.owner.op, 'seed'):
+            details.append("op seed " + str(v.owner.op.seed))
+    return '\n'.join(details)
+
+def _graph_signature(inputs, outputs, givens, updates):
+    """
+    Compute a hash describing the graph for some function, and the list of
+    shared variables used by the function, in a canonical order.
+    """
+    outputs = outputs if isinstance(outputs, (list, tuple)) else [outputs]
+    given_pairs = _as_pairs(givens)
+    update_pairs = _as_pairs(updates)
+    roots = list(outputs) + [v for (k, v) in given_pairs] + \
+            [v for (k, v) in update_pairs]
+    # collect all shared variables used by the function, in creation order
+    shared_vars = [v for v in graph_inputs(roots) \
+            if isinstance(v, SharedVariable)]
+    shared_vars.extend([k for (k, v) in update_pairs])
+    shared_vars = list(set(shared_vars))
+    shared_vars.sort(key=_creation_index)
+    # describe the graph, with ids that don't depend on this python process
+    all_vars = list(inputs) + [k for (k, v) in given_pairs] + roots
+    graph_str = theano.printing.debugprint(all_vars, file='str', \
+            ids='CHAR', print_type=True)
+    # describe the shared variables, in canonical order
+    shared_str = [(str(v.name), str(v.type), \
+            str(getattr(v.get_value(borrow=True), 'shape', ()))) \
+            for v in shared_vars]
+    sig_parts = [theano.__version__, theano.config.floatX, \
+            theano.config.device, theano.config.mode, \
+            str([str(i.type) for i in inputs]), graph_str, str(shared_str), \
+            _hidden_details(all_vars), str(len(given_pairs)), \
+            str(len(update_pairs))]
+    digest = hashlib.sha1('\n'.join(sig_parts)).hexdigest()
+    return [digest, shared_vars]
+
+def _rebind_shared(func, shared_idx, shared_vars):
+    """
+    Return a copy of the unpickled function func, in which the shared
+    variables recreated by unpickling are replaced by the corresponding
+    shared variables in shared_vars.
+    """
+    old_shared = [i.variable for i in func.maker.inputs if i.shared]
+    if len(old_shared) != len(shared_idx):
+        return None
+    swap = {}
+    for (old_var, idx) in zip(old_shared, shared_idx):
+        new_var = shared_vars[idx]
+        if not (old_var.type == new_var.type):
+            return None
+        swap[old_var] = new_var
+    return func.copy(swap=swap)
+
+def _placeholder_value(var):
+    """
+    Get a small value of the right type for a stand-in for the shared
+    variable var.
+    """
+    if _is_tensor_var(var):
+        return np.zeros([1 for d in range(var.ndim)], dtype=var.dtype)
+    if isinstance(var.get_value(borrow=True), np.random.RandomState):
+        return np.random.RandomState(0)
+    # e.g. the generic variables holding CURAND generators, which start out
+    # as False and get allocated (from the op's seed) when first used
+    return False
+
+def _placeholder_copy(func):
+    """
+    Return a copy of func in which each shared variable is swapped for a
+    placeholder of the same type, holding a tiny (or empty) value. Pickling
+    this copy doesn't drag along the (possibly huge) values in the real
+    shared vars, or unpicklable things like CURAND generators. The real vars
+    get swapped back in by _rebind_shared when the function is reloaded.
+    """
+    swap = {}
+    for i in func.maker.inputs:
+        if not i.shared:
+            continue
+        v = i.variable
+        swap[v] = type(v)(name=v.name, type=v.type, \
+                          value=_placeholder_value(v), strict=False)
+    return func.copy(swap=swap)
+
+def cached_function(inputs, outputs=None, givens=None, updates=None, \
+                    cache_dir=None, **kwargs):
+    """
+    Drop-in replacement for theano.function, which stores the compiled
+    function in cache_dir and reuses it when a function with the same graph
+    (up to the values in its shared variables) is requested again.
+
+    When cache_dir is None, or theano's profiler is on (the profile stats
+    don't survive pickling), this just calls theano.function.
+    """
+    if (cache_dir is None) or theano.config.profile:
+        return theano.function(inputs, outputs=outputs, givens=givens, \
+                updates=updates, **kwargs)
+    old_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(old_limit, 50000))
+    try:
+        digest, shared_vars = _graph_signature(inputs, outputs, givens, \
+                updates)
+        f_name = os.path.join(cache_dir, "{0:s}.pkl".format(digest))
+        func = None
+        if os.path.exists(f_name):
+            # load the cached function, without reoptimizing its graph
+            old_reopt = theano.config.reoptimize_unpickled_function
+            theano.config.reoptimize_unpickled_function = False
+            try:
+                f_handle = open(f_name, 'rb')
+                cached_func = cPickle.load(f_handle)
+                shared_idx = cPickle.load(f_handle)
+                f_handle.close()
+                func = _rebind_shared(cached_func, shared_idx, shared_vars)
+            except Exception as e:
+                print("FuncCache: failed to load {0:s} ({1:s})".format( \
+                        f_name, str(e)))
+                func = None
+            finally:
+                theano.config.reoptimize_unpickled_function = old_reopt
+        if func is None:
+            func = theano.function(inputs, outputs=outputs, givens=givens, \
+                    updates=updates, **kwargs)
+            # record where each of the function's shared variables sits in
+            # the canonical ordering, for rebinding them when reloaded
+            var_idx = dict([(v, i) for (i, v) in enumerate(shared_vars)])
+            func_shared = [i.variable for i in func.maker.inputs if i.shared]
+            if all([(v in var_idx) for v in func_shared]):
+                shared_idx = [var_idx[v] for v in func_shared]
+                try:
+                    stub_func = _placeholder_copy(func)
+                except Exception as e:
+                    print("FuncCache: not caching {0:s} ({1:s})".format( \
+                            f_name, str(e)))
+                    stub_func = None
+                if not (stub_func is None):
+                    if not os.path.exists(cache_dir):
+                        os.makedirs(cache_dir)
+                    # write to a temp file and rename it into place, so
+                    # readers never see a partially written function
+                    fd, tmp_name = tempfile.mkstemp(dir=cache_dir, \
+                                                    suffix='.tmp')
+                    f_handle = os.fdopen(fd, 'wb')
+                    cPickle.dump(stub_func, f_handle, protocol=-1)
+                    cPickle.dump(shared_idx, f_handle, protocol=-1)
+                    f_handle.close()
+                    _set_default_mode(tmp_name)
+                    os.rename(tmp_name, f_name)
+    finally:
+        sys.setrecursionlimit(old_limit)
+    return func
+
+class LazyFunction(object):
+    """
+    Descriptor for a compiled function that is built on first access, by
+    calling the method builder_name of the owning instance (this defaults to
+    "_construct_<name>"). The result is stored in the instance dict, so later
+    accesses go straight to it.
+
+    Assigning to the attribute (e.g. setting it to None) bypasses the build.
+
+    If the owning instance has a func_profiler (see FuncProfiler.py), the
+    function is built through it, and gets timed when called.
+    """
+    def __init__(self, name, builder_name=None):
+        self.name = name
+        if builder_name is None:
+            builder_name = "_construct_{0:s}".format(name)
+        self.builder_name = builder_name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        builder = getattr(obj, self.builder_name)
+        profiler = getattr(obj, 'func_profiler', None)
+        if profiler is None:
+            func = builder()
+        else:
+            func = profiler.build("{0:s}.{1:s}".format( \
+                    type(obj).__name__, self.name), builder)
+        obj.__dict__[self.name] = func
+        return func
+
+def lazy_function_names(obj):
+    """
+    Get the names of all lazily-compiled functions provided by obj's class.
+    """
+    names = []
+    for klass in type(obj).__mro__:
+        for (key, val) in klass.__dict__.items():
+            if isinstance(val, LazyFunction) and (not (key in names)):
+                names.append(key)
+    return names
+
+def warm_functions(obj, func_names=None):
+    """
+    Force compilation of the lazily-compiled functions in func_names, or of
+    all lazily-compiled functions on obj if func_names is None.
+    """
+    if func_names is None:
+        func_names = lazy_function_names(obj)
+    for name in func_names:
+        getattr(obj, name)
+    return
+
+if __name__=="__main__":
+    print("NO TEST/DEMO CODE FOR NOW.")
@@ -0,0 +1,195 @@
+##################################################################
+# Code for timing compiled theano functions: call counts, wall   #
+# time, input sizes and throughput, optionally with theano's own #
+# per-op profiler, and a machine-readable report of it all.      #
+##################################################################
+
+# basic python
+import sys
+import time
+import json
+import atexit
+import StringIO
+import numpy as np
+
+# theano business
+import theano
+
+
+class TimedFunction(object):
+    """
+    Wrapper for a compiled function which records the time taken by each
+    call, and the number/size of the samples passed to it. "Samples" are the
+    rows of the first array argument (e.g. the Xd minibatch, or the index
+    vector for the *_idx training functions).
+
+    Attribute access falls through to the wrapped function, so things like
+    func.maker or func.profile still work.
+    """
+    def __init__(self, name, func, compile_time=0.0):
+        self.name = name
+        self.func = func
+        self.compile_time = compile_time
+        self.call_count = 0
+        self.total_time = 0.0
+        self.min_time = float('inf')
+        self.max_time = 0.0
+        self.sample_count = 0
+        self.input_bytes = 0
+        return
+
+    def __call__(self, *args, **kwargs):
+        t0 = time.time()
+        result = self.func(*args, **kwargs)
+        t = time.time() - t0
+        self.call_count += 1
+        self.total_time += t
+        self.min_time = min(self.min_time, t)
+        self.max_time = max(self.max_time, t)
+        arrays = [a for a in args if isinstance(a, np.ndarray)]
+        if len(arrays) > 0:
+            if arrays[0].ndim > 0:
+                self.sample_count += arrays[0].shape[0]
+            self.input_bytes += sum([a.nbytes for a in arrays])
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.func, name)
+
+    def stats(self):
+        """
+        Get a dict describing the calls to this function so far.
+        """
+        calls = max(self.call_count, 1)
+        total_time = max(self.total_time, 1e-12)
+        stats = {'calls': self.call_count, \
+                 'compile_time': self.compile_time, \
+                 'total_time': self.total_time, \
+                 'mean_time': self.total_time / calls, \
+                 'min_time': (self.min_time if self.call_count > 0 else 0.0), \
+                 'max_time': self.max_time, \
+                 'samples': self.sample_count, \
+                 'samples_per_sec': self.sample_count / total_time, \
+                 'input_bytes': self.input_bytes}
+        # include the summary from theano's profiler, if it was on
+        profile = getattr(self.func, 'profile', None)
+        if not ((profile is None) or (profile is False)):
+            summary = StringIO.StringIO()
+            try:
+                profile.summary(file=summary)
+                stats['theano_profile'] = summary.getvalue()
+            except Exception as e:
+                stats['theano_profile'] = "summary failed: {0:s}".format(str(e))
+        return stats
+
+class FuncProfiler(object):
+    """
+    Collects timing info for the compiled functions of one or more models.
+
+    Models given a FuncProfiler through params['func_profiler'] wrap each of
+    their compiled functions in a TimedFunction when it gets built. Functions
+    whose names are in theano_profile_funcs (either the bare name, like
+    'train_joint', or the qualified name, like 'GIPair.train_joint') also get
+    compiled with theano's profiler turned on. Such functions bypass the
+    compiled function cache.
+
+    Parameters:
+        theano_profile_funcs: names of functions to profile with theano
+        report_file: if given, the report gets written here (as JSON) when
+                     the python process exits
+    """
+    def __init__(self, theano_profile_funcs=None, report_file=None):
+        if theano_profile_funcs is None:
+            theano_profile_funcs = []
+        self.theano_profile_funcs = list(theano_profile_funcs)
+        self.funcs = []
+        self.report_file = report_file
+        if not (report_file is None):
+            atexit.register(self.dump, report_file)
+        return
+
+    def build(self, name, builder):
+        """
+        Call builder() to get the compiled function called name, and return
+        it wrapped in a TimedFunction.
+        """
+        bare_name = name.split('.')[-1]
+        use_profile = (name in self.theano_profile_funcs) or \
+                (bare_name in self.theano_profile_funcs)
+        old_profile = theano.config.profile
+        t0 = time.time()
+        try:
+            if use_profile:
+                theano.config.profile = True
+            func = builder()
+        finally:
+            theano.config.profile = old_profile
+        timed_func = TimedFunction(name, func, compile_time=(time.time()-t0))
+        self.funcs.append(timed_func)
+        return timed_func
+
+    def report(self):
+        """
+        Get a dict with the stats for every function built through this
+        profiler. Functions with the same name (e.g. from clones of a model)
+        are listed separately, with "#<n>" appended to later names.
+        """
+        report = {}
+        for tf in self.funcs:
+            key = tf.name
+            count = 1
+            while key in report:
+                count += 1
+                key = "{0:s}#{1:d}".format(tf.name, count)
+            report[key] = tf.stats()
+        return report
+
+    def print_report(self, out_file=None):
+        """
+        Print a table of the main stats for each function, slowest first.
+        """
+        if out_file is None:
+            out_file = sys.stdout
+        report = self.report()
+        names = sorted(report.keys(), key=lambda k: -report[k]['total_time'])
+        out_file.write("{0:40s} {1:>8s} {2:>10s} {3:>10s} {4:>12s}\n".format( \
+                'function', 'calls', 'total (s)', 'mean (ms)', 'samples/s'))
+        for name in names:
+            s = report[name]
+            out_file.write("{0:40s} {1:8d} {2:10.2f} {3:10.2f} {4:12.1f}\n".format( \
+                    name, s['calls'], s['total_time'], 1000.0*s['mean_time'], \
+                    s['samples_per_sec']))
+        return
+
+    def dump(self, f_name=None):
+        """
+        Write the report to f_name as JSON.
+        """
+        if f_name is None:
+            f_name = self.report_file
+        f_handle = open(f_name, 'w')
+        json.dump(self.report(), f_handle, indent=1, sort_keys=True)
+        f_handle.close()
+        return
+
+def profiled_build(profiler, name, builder):
+    """
+    Build a compiled function via builder(), through profiler if it's not
+    None. This is for models that compile some functions eagerly.
+    """
+    if profiler is None:
+        return builder()
+    return profiler.build(name, builder)
+
+if __name__=="__main__":
+    # check that calls are timed and reported
+    x = theano.tensor.matrix()
+    FP = FuncProfiler(theano_profile_funcs=['Demo.sum_sq'])
+    f = FP.build('Demo.sum_sq', \
+            lambda: theano.function([x], outputs=(x**2.0).sum()))
+    for i in range(10):
+        f(np.ones((100, 20), dtype=theano.config.floatX))
+    report = FP.report()
+    assert(report['Demo.sum_sq']['calls'] == 10)
+    assert(report['Demo.sum_sq']['samples'] == 1000)
+    FP.print_report()
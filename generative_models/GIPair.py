@@ -20,7 +20,9 @@ from GenNet import GenNet
 from InfNet import InfNet
 from PeaNet import PeaNet
 from DKCode import get_adam_updates, get_adadelta_updates
-from LogPDFs import gaussian_kld
+from FuncCache import cached_function, LazyFunction
+from LogPDFs import gaussian_kld, log_prob_gaussian, multi_sample_stats, \
+                    multi_sample_estimator
 
 #
 #
@@ -54,6 +56,14 @@ class GIPair(object):
                             GIPair will be initialized as a "shared-parameter"
                             clone of some other GIPair.
     """
+    # compiled functions, built on first access
+    train_joint = LazyFunction('train_joint')
+    train_joint_idx = LazyFunction('train_joint_idx')
+    compute_costs = LazyFunction('compute_costs')
+    compute_ll_bound = LazyFunction('compute_ll_bound')
+    compute_post_stats = LazyFunction('compute_post_stats')
+    chain_sampler = LazyFunction('chain_sampler')
+
     def __init__(self, rng=None, \
             Xd=None, Xc=None, Xm=None, \
             g_net=None, i_net=None, \
@@ -65,6 +75,16 @@ class GIPair(object):
             self.params = {}
         else:
             self.params = params
+        # directory for caching compiled theano functions (None to disable)
+        if 'func_cache_dir' in self.params:
+            self.func_cache_dir = self.params['func_cache_dir']
+        else:
+            self.func_cache_dir = None
+        # optional FuncProfiler for timing compiled functions (None to disable)
+        if 'func_profiler' in self.params:
+            self.func_profiler = self.params['func_profiler']
+        else:
+            self.func_profiler = None
 
         # record the symbolic variables that will provide inputs to the
         # computation graph created to describe this GIPair
@@ -138,6 +158,9 @@ class GIPair(object):
             # init shared var for controlling l2 regularization on params
             self.lam_l2w = theano.shared(value=zero_ary, name='gip_lam_l2w')
             self.set_lam_l2w(1e-4)
+            # init shared var for holding a device-resident training set
+            zero_mat = np.zeros((1, data_dim)).astype(theano.config.floatX)
+            self.X_train = theano.shared(value=zero_mat, name='gip_X_train')
             # record shared parameters that are to be shared among clones
             self.shared_param_dicts['gip_lr_gn'] = self.lr_gn
             self.shared_param_dicts['gip_lr_in'] = self.lr_in
@@ -147,6 +170,7 @@ class GIPair(object):
             self.shared_param_dicts['gip_lam_nll'] = self.lam_nll
             self.shared_param_dicts['gip_lam_kld'] = self.lam_kld
             self.shared_param_dicts['gip_lam_l2w'] = self.lam_l2w
+            self.shared_param_dicts['gip_X_train'] = self.X_train
         else:
             # use some shared parameters that are shared among all clones of
             # some "base" GIPair
@@ -158,6 +182,7 @@ class GIPair(object):
             self.lam_nll = self.shared_param_dicts['gip_lam_nll']
             self.lam_kld = self.shared_param_dicts['gip_lam_kld']
             self.lam_l2w = self.shared_param_dicts['gip_lam_l2w']
+            self.X_train = self.shared_param_dicts['gip_X_train']
 
         # Grab the full set of "optimizable" parameters from the generator
         # and inferencer networks that we'll be working with.
@@ -196,11 +221,8 @@ class GIPair(object):
             self.joint_updates[k] = self.in_updates[k]
         self.joint_updates[self.IN.kld_mean] = self.IN.kld_mean_update
 
-        # Construct a function for jointly training the generator/inferencer
-        self.train_joint = self._construct_train_joint()
-        self.compute_costs = self._construct_compute_costs()
-        self.compute_ll_bound = self._construct_compute_ll_bound()
-        self.compute_post_stats = self._construct_compute_post_stats()
+        # Functions for training/evaluation are compiled on first use. See
+        # the LazyFunction attributes of this class.
         return
 
     def set_all_sgd_params(self, lr_gn=0.01, lr_in=0.01, \
@@ -263,14 +285,28 @@ class GIPair(object):
         self.lam_l2w.set_value(new_lam.astype(theano.config.floatX))
         return
 
+    def set_train_data(self, X):
+        """
+        Set the training set from which train_joint_idx takes minibatches.
+        """
+        self.X_train.set_value(X.astype(theano.config.floatX))
+        return
+
     def _construct_compute_ll_bound(self):
         """
         Construct a function for computing the variational likelihood bound.
+
+        Each input row is repeated sample_reps times inside the compiled
+        graph, and the per-sample terms are reduced per-observation before
+        coming back to the host. The returned function processes the input in
+        chunks of at most batch_size repeated rows.
         """
         # setup some symbolic variables for theano to deal with
         Xd = T.matrix()
-        Xc = T.zeros_like(Xd)
-        Xm = T.zeros_like(Xd)
+        sample_reps = T.lscalar()
+        Xr = Xd.repeat(sample_reps, axis=0)
+        Xc = T.zeros_like(Xr)
+        Xm = T.zeros_like(Xr)
         # get symbolic var for posterior KLds
         post_kld = self.IN.kld_cost
         # get symbolic var for log likelihoods
@@ -278,23 +314,32 @@ class GIPair(object):
             log_likelihood = self.GN.compute_log_prob(self.IN.Xd_encoded)
         else:
             log_likelihood = self.GN.compute_log_prob(self.IN.Xd)
+        # get symbolic var for log importance weights of the posterior samples
+        Xp = self.IN.output
+        log_p_z = log_prob_gaussian(Xp, T.zeros_like(Xp), \
+                les_sigmas=self.GN.prior_sigma)
+        log_q_z = log_prob_gaussian(Xp, self.IN.output_mean, \
+                les_sigmas=self.IN.output_sigma)
+        log_weights = log_likelihood + log_p_z - log_q_z
         # construct a theano function for actually computing stuff
-        outputs = [post_kld, log_likelihood]
-        out_func = theano.function([Xd], outputs=outputs, \
-                givens={ self.Xd: Xd, self.Xc: Xc, self.Xm: Xm })
+        outputs = multi_sample_stats(log_likelihood, post_kld, log_weights, \
+                sample_reps)
+        out_func = cached_function([Xd, sample_reps], outputs=outputs, \
+                givens={ self.Xd: Xr, self.Xc: Xc, self.Xm: Xm }, \
+                cache_dir=self.func_cache_dir)
         # construct a function for computing multi-sample averages
-        def multi_sample_bound(X, sample_count=10):
-            post_klds = np.zeros((X.shape[0], 1))
-            log_likelihoods = np.zeros((X.shape[0], 1))
-            max_lls = np.zeros((X.shape[0], 1)) - 1e8
-            for i in range(sample_count):
-                result = out_func(X)
-                post_klds = post_klds + (1.0 * result[0])
-                log_likelihoods = log_likelihoods + (1.0 * result[1])
-                max_lls = np.maximum(max_lls, (1.0 * result[1]))
-            post_klds = post_klds / sample_count
-            log_likelihoods = log_likelihoods / sample_count
+        def multi_sample_bound(X, sample_count=10, batch_size=10000, \
+                               iw_bound=False):
+            result = multi_sample_estimator(out_func, X, sample_count, \
+                    batch_size=batch_size)
+            log_likelihoods = result[0].reshape((X.shape[0], 1))
+            post_klds = result[1].reshape((X.shape[0], 1))
+            max_lls = result[2].reshape((X.shape[0], 1))
             ll_bounds = log_likelihoods - post_klds
+            if iw_bound:
+                iw_bounds = result[3].reshape((X.shape[0], 1))
+                return [ll_bounds, post_klds, log_likelihoods, max_lls, \
+                        iw_bounds]
             return [ll_bounds, post_klds, log_likelihoods, max_lls]
         return multi_sample_bound
 
@@ -346,9 +391,30 @@ class GIPair(object):
         """
         outputs = [self.joint_cost, self.data_nll_cost, self.post_kld_cost, \
                 self.other_reg_cost, self.posterior_norms, self.posterior_klds]
-        func = theano.function(inputs=[ self.Xd, self.Xc, self.Xm ], \
+        func = cached_function(inputs=[ self.Xd, self.Xc, self.Xm ], \
+                outputs=outputs, \
+                updates=self.joint_updates, \
+                cache_dir=self.func_cache_dir)
+        return func
+
+    def _construct_train_joint_idx(self):
+        """
+        Construct theano function to train inferencer and generator jointly,
+        using the rows of self.X_train given by an index vector. Each row is
+        repeated batch_reps times, and Xc/Xm are set to zero, in the graph.
+        """
+        idx = T.ivector()
+        batch_reps = T.lscalar()
+        Xb = self.X_train[idx].repeat(batch_reps, axis=0)
+        outputs = [self.joint_cost, self.data_nll_cost, self.post_kld_cost, \
+                self.other_reg_cost, self.posterior_norms, self.posterior_klds]
+        func = cached_function(inputs=[ idx, batch_reps ], \
                 outputs=outputs, \
-                updates=self.joint_updates)
+                givens={ self.Xd: Xb, \
+                         self.Xc: T.zeros_like(Xb), \
+                         self.Xm: T.zeros_like(Xb) }, \
+                updates=self.joint_updates, \
+                cache_dir=self.func_cache_dir)
         return func
 
     def _construct_compute_costs(self):
@@ -358,8 +424,9 @@ class GIPair(object):
         """
         outputs = [self.joint_cost, self.data_nll_cost, self.post_kld_cost, \
                 self.other_reg_cost]
-        func = theano.function(inputs=[ self.Xd, self.Xc, self.Xm ], \
-                outputs=outputs)
+        func = cached_function(inputs=[ self.Xd, self.Xc, self.Xm ], \
+                outputs=outputs, \
+                cache_dir=self.func_cache_dir)
         return func
 
     def _construct_compute_post_stats(self):
@@ -378,8 +445,9 @@ class GIPair(object):
         dim_vars = T.sum(self.IN.output_mean**2.0, axis=0) / obs_count
         # make a theano function to compute them
         outputs = [all_klds, obs_klds, dim_klds, dim_vars]
-        func = theano.function(inputs=[self.Xd, self.Xc, self.Xm], \
-                outputs=outputs)
+        func = cached_function(inputs=[self.Xd, self.Xc, self.Xm], \
+                outputs=outputs, \
+                cache_dir=self.func_cache_dir)
         return func
 
     def shared_param_clone(self, rng=None, Xd=None, Xc=None, Xm=None):
@@ -394,37 +462,101 @@ class GIPair(object):
             params=self.params, shared_param_dicts=self.shared_param_dicts)
         return clone_gip
 
+    def _construct_chain_sampler(self):
+        """
+        Construct a scan-based function for running the I<->G loop. Given an
+        initial state, it records the masked data samples and posterior
+        samples for rec_count steps spaced rec_every steps apart, and returns
+        those along with the state reached at the end.
+        """
+        X_d0 = T.matrix()
+        X_c = T.matrix()
+        X_m = T.matrix()
+        rec_count = T.lscalar()
+        rec_every = T.lscalar()
+        def chain_step(X_d):
+            # one trip through the loop, with the observed data fixed
+            outs = theano.clone([self.IN.output, self.GN.output_decoded], \
+                    replace={self.Xd: X_d, self.Xc: X_c, self.Xm: X_m})
+            X_in = apply_mask(Xd=X_d, Xc=X_c, Xm=X_m)
+            return [outs[1], X_in, outs[0]]
+        def record_step(X_d):
+            # run rec_every steps, and record the first of them
+            [Xd_seq, Xin_seq, Xp_seq], updates = theano.scan(chain_step, \
+                    outputs_info=[X_d, None, None], n_steps=rec_every)
+            return [Xd_seq[-1], Xin_seq[0], Xp_seq[0]], updates
+        [Xd_recs, Xin_recs, Xp_recs], updates = theano.scan(record_step, \
+                outputs_info=[X_d0, None, None], n_steps=rec_count)
+        func = theano.function( \
+                inputs=[X_d0, X_c, X_m, rec_count, rec_every], \
+                outputs=[Xd_recs[-1], Xin_recs, Xp_recs], \
+                updates=updates)
+        return func
+
     def sample_from_chain(self, X_d, X_c=None, X_m=None, loop_iters=5, \
-            sigma_scale=None):
+            sigma_scale=None, record_every=1, data_out=None, prior_out=None, \
+            chunk_size=50, stats_only=False):
         """
         Sample for several rounds through the I<->G loop, initialized with the
         the "data variable" samples in X_d.
+
+        The loop runs in a compiled scan, chunk_size recorded steps per call.
+        Every record_every-th step is recorded into the arrays data_out and
+        prior_out, with shapes (rec_count, obs_count, dim), where rec_count is
+        ceil(loop_iters / record_every). These are allocated if not given,
+        and can be memmaps (e.g. from np.lib.format.open_memmap) for chains
+        that won't fit in memory. The "data samples" and "prior samples" in
+        the result are lists of views into these arrays.
+
+        If stats_only is True, the recorded steps aren't kept, and the result
+        instead holds the mean and variance of each chain's data samples over
+        the recorded steps, as "data mean" and "data var".
         """
-        data_samples = []
-        prior_samples = []
+        X_d = X_d.astype(theano.config.floatX)
         if X_c is None:
             X_c = 0.0 * X_d
         if X_m is None:
             X_m = 0.0 * X_d
+        X_c = X_c.astype(theano.config.floatX)
+        X_m = X_m.astype(theano.config.floatX)
         if sigma_scale is None:
             sigma_scale = self.GN.prior_sigma
+        obs_count = X_d.shape[0]
+        rec_count = int(np.ceil(loop_iters / float(record_every)))
+        if not stats_only:
+            if data_out is None:
+                data_out = np.zeros((rec_count, obs_count, self.data_dim), \
+                        dtype=theano.config.floatX)
+            if prior_out is None:
+                prior_out = np.zeros((rec_count, obs_count, self.prior_dim), \
+                        dtype=theano.config.floatX)
+        else:
+            data_sum = np.zeros(X_d.shape)
+            data_sq_sum = np.zeros(X_d.shape)
         # set sigma_scale on our InfNet
         old_scale = self.IN.sigma_scale.get_value(borrow=False)
         self.IN.set_sigma_scale(sigma_scale)
-        for i in range(loop_iters):
-            # apply mask, mixing foreground and background data
-            X_d = apply_mask(Xd=X_d, Xc=X_c, Xm=X_m)
-            # record the data samples for this iteration
-            data_samples.append(1.0 * X_d)
-            # sample from their inferred posteriors
-            X_p = self.IN.sample_posterior(X_d)
-            # record the sampled points (in the "prior space")
-            prior_samples.append(1.0 * X_p)
-            # get next data samples by transforming the prior-space points
-            X_d = self.GN.transform_prior(X_p)
+        rec_start = 0
+        while (rec_start < rec_count):
+            rec_end = min(rec_count, (rec_start + chunk_size))
+            X_d, Xin_recs, Xp_recs = self.chain_sampler(X_d, X_c, X_m, \
+                    (rec_end - rec_start), record_every)
+            if not stats_only:
+                data_out[rec_start:rec_end] = Xin_recs
+                prior_out[rec_start:rec_end] = Xp_recs
+            else:
+                data_sum += np.sum(Xin_recs, axis=0)
+                data_sq_sum += np.sum(Xin_recs**2.0, axis=0)
+            rec_start = rec_end
         # reset sigma_scale on our InfNet
         self.IN.set_sigma_scale(old_scale[0])
-        result = {"data samples": data_samples, "prior samples": prior_samples}
+        if not stats_only:
+            result = {"data samples": [data_out[i] for i in range(rec_count)], \
+                      "prior samples": [prior_out[i] for i in range(rec_count)]}
+        else:
+            data_mean = data_sum / rec_count
+            data_var = (data_sq_sum / rec_count) - data_mean**2.0
+            result = {"data mean": data_mean, "data var": data_var}
         return result
 
     def sample_from_prior(self, samp_count, sigma=None):
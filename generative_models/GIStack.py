@@ -26,6 +26,8 @@ from DKCode import get_adam_updates, get_adadelta_updates
 from GenNet import GenNet
 from InfNet import InfNet
 from PeaNet import PeaNet
+from FuncCache import cached_function
+from FuncProfiler import profiled_build
 
 ######################################################
 # HELPER FUNCTIONS FOR PEAR AND CLASSIFICATION COSTS #
@@ -176,6 +178,20 @@ class GIStack(object):
 
         # setup a rng for this GIStack
         self.rng = RandStream(rng.randint(100000))
+        if params is None:
+            self.params = {}
+        else:
+            self.params = params
+        # directory for caching compiled theano functions (None to disable)
+        if 'func_cache_dir' in self.params:
+            self.func_cache_dir = self.params['func_cache_dir']
+        else:
+            self.func_cache_dir = None
+        # optional FuncProfiler for timing compiled functions (None to disable)
+        if 'func_profiler' in self.params:
+            self.func_profiler = self.params['func_profiler']
+        else:
+            self.func_profiler = None
         # record the symbolic variables that will provide inputs to the
         # computation graph created for this GIStack
         self.Xd = Xd
@@ -302,7 +318,8 @@ class GIStack(object):
 
         # construct a training function for all parameters. training for the
         # various networks can be switched on and off via learning rates
-        self.train_joint = self._construct_train_joint()
+        self.train_joint = profiled_build(self.func_profiler, \
+                'GIStack.train_joint', self._construct_train_joint)
         return
 
     def set_pn_sgd_params(self, learn_rate=0.01):
@@ -462,9 +479,10 @@ class GIStack(object):
         """
         outputs = [self.joint_cost, self.data_nll_cost, self.post_kld_cost, \
                 self.post_cat_cost, self.post_pea_cost, self.other_reg_cost]
-        func = theano.function(inputs=[ self.Xd, self.Xc, self.Xm, self.Yd ], \
+        func = cached_function(inputs=[ self.Xd, self.Xc, self.Xm, self.Yd ], \
                 outputs=outputs, \
-                updates=self.joint_updates)
+                updates=self.joint_updates, \
+                cache_dir=self.func_cache_dir)
         return func
 
     def sample_gis_from_data(self, X_d, loop_iters=10):
@@ -27,6 +27,7 @@ from NetLayers import relu_actfun, softplus_actfun, \
 from GenNet import GenNet
 from InfNet import InfNet
 from PeaNet import PeaNet
+from FuncCache import cached_function
 
 def cat_entropy(p):
     """
@@ -154,6 +155,11 @@ class GITrip(object):
             self.params = {}
         else:
             self.params = params
+        # directory for caching compiled theano functions (None to disable)
+        if 'func_cache_dir' in self.params:
+            self.func_cache_dir = self.params['func_cache_dir']
+        else:
+            self.func_cache_dir = None
 
         # record the dimensionality of the data handled by this GITrip
         self.data_dim = data_dim
@@ -630,8 +636,9 @@ class GITrip(object):
         outputs = [self.joint_cost, self.data_nll_cost, self.post_kld_cost, \
                 self.post_cat_cost, self.post_pea_cost, self.post_ent_cost, \
                 self.post_dir_cost, self.other_reg_cost]
-        func = theano.function(inputs=[ self.Xd, self.Xc, self.Xm, self.Yd ], \
-                outputs=outputs, updates=self.joint_updates)
+        func = cached_function(inputs=[ self.Xd, self.Xc, self.Xm, self.Yd ], \
+                outputs=outputs, updates=self.joint_updates, \
+                cache_dir=self.func_cache_dir)
         COMMENT="""
         theano.printing.pydotprint(func, \
             outfile='GITrip_train_joint.svg', compact=True, format='svg', with_ids=False, \
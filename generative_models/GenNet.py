@@ -18,6 +18,10 @@ from theano.sandbox.cuda.rng_curand import CURAND_RandomStreams as RandStream
 from NetLayers import HiddenLayer, DiscLayer, relu_actfun, safe_log, \
                       max_normalize
 from LogPDFs import log_prob_bernoulli, log_prob_gaussian2
+from FuncCache import LazyFunction
+from Checkpoint import write_checkpoint, read_checkpoint, \
+                       is_checkpoint_file, set_params_from_checkpoint, \
+                       shared_param_dicts_from_numpy
 
 #####################################
 # GENERATIVE NETWORK IMPLEMENTATION #
@@ -76,6 +80,15 @@ class GenNet(object):
             init_scale: scaling factor for hidden layer weights (__ * 0.01)
         shared_param_dicts: parameters for the MLP controlled by this GenNet
     """
+    # compiled functions, built on first access
+    sample_from_prior = LazyFunction('sample_from_prior', \
+            '_construct_prior_sampler')
+    sample_from_model = LazyFunction('sample_from_model', \
+            '_construct_model_sampler')
+    scaled_sampler = LazyFunction('scaled_sampler', \
+            '_construct_scaled_sampler')
+    transform_prior = LazyFunction('transform_prior')
+
     def __init__(self, \
             rng=None, \
             Xp=None, \
@@ -357,14 +370,10 @@ class GenNet(object):
         self.act_reg_cost = lam_l2a * self._act_reg_cost()
         # Construct a sampler for drawing independent samples from this model's
         # isotropic Gaussian prior, and a sampler for the model distribution.
-        if self.build_theano_funcs:
-            self.sample_from_prior = self._construct_prior_sampler()
-            self.sample_from_model = self._construct_model_sampler()
-            self.scaled_sampler = self._construct_scaled_sampler()
-            # Construct a function for passing points from the latent/prior space
-            # through the transform induced by the current model parameters.
-            self.transform_prior = self._construct_transform_prior()
-        else:
+        # These functions are compiled on first use, and a function for
+        # passing points from the latent/prior space through the transform
+        # induced by the current model parameters is built in the same way.
+        if not self.build_theano_funcs:
             self.sample_from_prior = None
             self.sample_from_model = None
             self.scaled_sampler = None
@@ -592,28 +601,31 @@ class GenNet(object):
 
     def save_to_file(self, f_name=None):
         """
-        Dump important stuff to a Python pickle, so that we can reload this
-        model later. We'll pickle everything required to create a clone of
-        this model given the pickle and the rng/Xd params to the cloning
+        Dump important stuff to a checkpoint file, so that we can reload this
+        model later. We'll save everything required to create a clone of
+        this model given the file and the rng/Xd params to the cloning
         function: "GenNet.shared_param_clone()".
         """
         assert(not (f_name is None))
-        f_handle = file(f_name, 'wb')
-        # dump the "simple" python value in self.prior_sigma
-        cPickle.dump(self.prior_sigma, f_handle, protocol=-1)
-        # dump the dict self.params, which just holds "simple" python values
-        cPickle.dump(self.params, f_handle, protocol=-1)
-        # make a copy of self.shared_param_dicts, with numpy arrays in place
-        # of the theano shared variables
-        numpy_param_dicts = []
-        for shared_dict in self.shared_param_dicts:
-            numpy_dict = {}
-            for key in shared_dict:
-                numpy_dict[key] = shared_dict[key].get_value(borrow=False)
-            numpy_param_dicts.append(numpy_dict)
-        # dump the numpy version of self.shared_param_dicts
-        cPickle.dump(numpy_param_dicts, f_handle, protocol=-1)
-        f_handle.close()
+        meta, param_groups = self.checkpoint_contents()
+        write_checkpoint(f_name, meta, param_groups)
+        return
+
+    def checkpoint_contents(self):
+        """
+        Get the (meta, param_groups) that save_to_file writes, e.g. for
+        exporting this model from a CheckpointManager.
+        """
+        meta = {'prior_sigma': self.prior_sigma, 'params': self.params}
+        return meta, {'layers': self.shared_param_dicts}
+
+    def load_params_from_file(self, f_name=None):
+        """
+        Set this network's parameters to those in a file written by
+        save_to_file.
+        """
+        assert(not (f_name is None))
+        set_params_from_checkpoint(f_name, {'layers': self.shared_param_dicts})
         return
 
 def load_gennet_from_file(f_name=None, rng=None, Xp=None, new_params=None):
@@ -622,21 +634,24 @@ def load_gennet_from_file(f_name=None, rng=None, Xp=None, new_params=None):
     the loaded model to be clamped at 0 post-hoc.
     """
     assert(not (f_name is None))
-    pickle_file = open(f_name)
-    self_dot_prior_sigma = cPickle.load(pickle_file)
-    self_dot_params = cPickle.load(pickle_file)
+    if is_checkpoint_file(f_name):
+        meta, numpy_groups = read_checkpoint(f_name)
+        self_dot_prior_sigma = meta['prior_sigma']
+        self_dot_params = meta['params']
+        self_dot_numpy_param_dicts = numpy_groups['layers']
+    else:
+        # files from before the checkpoint format hold three pickles
+        pickle_file = open(f_name)
+        self_dot_prior_sigma = cPickle.load(pickle_file)
+        self_dot_params = cPickle.load(pickle_file)
+        self_dot_numpy_param_dicts = cPickle.load(pickle_file)
+        pickle_file.close()
     if not (new_params is None):
         for k in new_params:
             self_dot_params[k] = new_params[k]
-    self_dot_numpy_param_dicts = cPickle.load(pickle_file)
-    self_dot_shared_param_dicts = []
-    for numpy_dict in self_dot_numpy_param_dicts:
-        shared_dict = {}
-        for key in numpy_dict:
-            val = numpy_dict[key].astype(theano.config.floatX)
-            shared_dict[key] = theano.shared(val)
-        self_dot_shared_param_dicts.append(shared_dict)
-    # now, create a PeaNet with the configuration we just unpickled
+    self_dot_shared_param_dicts = \
+            shared_param_dicts_from_numpy(self_dot_numpy_param_dicts)
+    # now, create a GenNet with the configuration we just loaded
     clone_net = GenNet(rng=rng, Xp=Xp, \
             prior_sigma=self_dot_prior_sigma, params=self_dot_params, \
             shared_param_dicts=self_dot_shared_param_dicts)
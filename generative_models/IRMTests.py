@@ -17,6 +17,7 @@ from NetLayers import relu_actfun, softplus_actfun, safe_log, \
 from GenNet import GenNet
 from InfNet import InfNet
 from IRModel import IRModel
+from BatchPrefetcher import BatchPrefetcher
 from load_data import load_udm, load_udm_ss, load_mnist
 import utils
 
@@ -140,15 +141,20 @@ def test_with_constant_init():
     ################################################################
     costs = [0. for i in range(10)]
     learn_rate = 0.005
+    # sample and binarize minibatches in background processes
+    def make_batch():
+        tr_idx = npr.randint(low=0,high=tr_samples,size=(batch_size,))
+        Xb = binarize_data(Xtr.take(tr_idx, axis=0))
+        return Xb.astype(theano.config.floatX)
+    batches = BatchPrefetcher(make_batch, queue_size=16, worker_count=2, \
+            use_processes=True)
     for i in range(150000):
         scale_1 = min(1.0, ((i+1) / 10000.0))
         scale_2 = min(1.0, ((i+1) / 10000.0))
         if (((i + 1) % 10000) == 0):
             learn_rate = learn_rate * 0.8
-        # randomly sample a minibatch
-        tr_idx = npr.randint(low=0,high=tr_samples,size=(batch_size,))
-        Xb = binarize_data(Xtr.take(tr_idx, axis=0))
-        Xb = Xb.astype(theano.config.floatX)
+        # grab the next prefetched minibatch
+        Xb = batches.next()
         # train the coarse approximation and corrector model jointly
         IRM.set_sgd_params(lr_1=scale_1*learn_rate, lr_2=scale_1*learn_rate, \
                 mom_1=0.8, mom_2=0.99)
@@ -207,6 +213,7 @@ def test_with_constant_init():
             file_name = "CI_FREE_ENERGY_b{0:d}.png".format(i)
             utils.plot_scatter(fe_terms[1], fe_terms[0], file_name, \
                     x_label='Posterior KLd', y_label='Negative Log-likelihood')
+    batches.close()
     return
 
 
@@ -372,14 +379,19 @@ def test_with_model_init():
     ################################################################
     costs = [0. for i in range(10)]
     learn_rate = 0.005
+    # sample and binarize minibatches in background processes
+    def make_batch():
+        tr_idx = npr.randint(low=0,high=tr_samples,size=(batch_size,))
+        Xb = binarize_data(Xtr.take(tr_idx, axis=0))
+        return Xb.astype(theano.config.floatX)
+    batches = BatchPrefetcher(make_batch, queue_size=16, worker_count=2, \
+            use_processes=True)
     for i in range(250000):
         scale = min(1.0, ((i+1) / 8000.0))
         if (((i + 1) % 60000) == 0):
             learn_rate = learn_rate * 0.8
-        # randomly sample a minibatch
-        tr_idx = npr.randint(low=0,high=tr_samples,size=(batch_size,))
-        Xb = binarize_data(Xtr.take(tr_idx, axis=0))
-        Xb = Xb.astype(theano.config.floatX)
+        # grab the next prefetched minibatch
+        Xb = batches.next()
         # train the coarse approximation and corrector model jointly
         if False: #((i < 10000) and ((i % 100) > 75)):
             IRM.set_sgd_params(lr_1=0.0*learn_rate, lr_2=scale*learn_rate, \
@@ -452,6 +464,7 @@ def test_with_model_init():
             print("    nll_bound : {0:.4f}".format(fe_mean))
             utils.plot_scatter(fe_terms[1], fe_terms[0], file_name, \
                     x_label='Posterior KLd', y_label='Negative Log-likelihood')
+    batches.close()
     return
 
 if __name__=="__main__":
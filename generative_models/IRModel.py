@@ -20,7 +20,9 @@ from GenNet import GenNet
 from InfNet import InfNet
 from PeaNet import PeaNet
 from DKCode import get_adam_updates, get_adadelta_updates
-from LogPDFs import log_prob_bernoulli, log_prob_gaussian2, gaussian_kld
+from FuncCache import LazyFunction
+from LogPDFs import log_prob_bernoulli, log_prob_gaussian, log_prob_gaussian2, \
+                    gaussian_kld, multi_sample_stats, make_fe_estimator
 
 #
 #
@@ -52,6 +54,13 @@ class IRModel(object):
                 xt_type: can be "latent" or "observed"
                 xt_transform: can be 'none' or 'sigmoid'
     """
+    # compiled functions, built on first access
+    train_joint = LazyFunction('train_joint')
+    train_joint_idx = LazyFunction('train_joint_idx')
+    compute_post_klds = LazyFunction('compute_post_klds')
+    compute_fe_terms = LazyFunction('compute_fe_terms')
+    sample_from_prior = LazyFunction('sample_from_prior')
+
     def __init__(self, rng=None, x_in=None, \
             p_xt0_given_z=None, p_zti_given_xti=None, p_xti_given_xti_zti=None, \
             p_x_given_xti_zti=None, q_z_given_x=None, q_zti_given_x_xti=None, \
@@ -80,6 +89,11 @@ class IRModel(object):
             self.params = {}
         else:
             self.params = params
+        # optional FuncProfiler for timing compiled functions (None to disable)
+        if 'func_profiler' in self.params:
+            self.func_profiler = self.params['func_profiler']
+        else:
+            self.func_profiler = None
         self.x_type = self.params['x_type']
         self.xt_type = self.params['xt_type']
         if 'xt_transform' in self.params:
@@ -131,6 +145,9 @@ class IRModel(object):
         zero_row = np.zeros((self.x_dim,)).astype(theano.config.floatX)
         self.output_bias = theano.shared(value=zero_row, name='irm_output_bias')
         self.output_logvar = theano.shared(value=zero_ary, name='irm_output_logvar')
+        # self.X_train holds a device-resident training set
+        zero_mat = np.zeros((1, self.x_dim)).astype(theano.config.floatX)
+        self.X_train = theano.shared(value=zero_mat, name='irm_X_train')
 
         ##############################
         # Setup self.z and self.xt0. #
@@ -270,12 +287,8 @@ class IRModel(object):
         for k in self.group_2_updates:
             self.joint_updates[k] = self.group_2_updates[k]
 
-        # Construct a function for jointly training the generator/inferencer
-        print("Compiling training function...")
-        self.train_joint = self._construct_train_joint()
-        self.compute_post_klds = self._construct_compute_post_klds()
-        self.compute_fe_terms = self._construct_compute_fe_terms()
-        self.sample_from_prior = self._construct_sample_from_prior()
+        # Functions for training/evaluation are compiled on first use. See
+        # the LazyFunction attributes of this class.
         # make easy access points for some interesting parameters
         if self.model_init:
             self.inf_1_weights = self.q_z_given_x.shared_layers[0].W
@@ -343,6 +356,13 @@ class IRModel(object):
         self.lam_l2w.set_value(new_lam.astype(theano.config.floatX))
         return
 
+    def set_train_data(self, X):
+        """
+        Set the training set from which train_joint_idx takes minibatches.
+        """
+        self.X_train.set_value(X.astype(theano.config.floatX))
+        return
+
     def set_train_switch(self, switch_val=0.0):
         """
         Set the switch for changing between training and sampling behavior.
@@ -468,6 +488,7 @@ class IRModel(object):
         """
         Construct theano function to train all networks jointly.
         """
+        print("Compiling training function...")
         # setup some symbolic variables for theano to deal with
         x = T.matrix()
         # collect the outputs to return from this function
@@ -480,29 +501,57 @@ class IRModel(object):
                 updates=self.joint_updates)
         return func
 
+    def _construct_train_joint_idx(self):
+        """
+        Construct theano function to train all networks jointly, using the
+        rows of self.X_train given by an index vector. Each row is repeated
+        batch_reps times in the graph.
+        """
+        idx = T.ivector()
+        Xb = self.X_train[idx].repeat(self.batch_reps, axis=0)
+        outputs = [self.joint_cost, self.nll_cost, self.kld_cost, \
+                self.reg_cost]
+        func = theano.function(inputs=[ idx, self.batch_reps ], \
+                outputs=outputs, \
+                givens={ self.x: Xb }, \
+                updates=self.joint_updates)
+        return func
+
     def _construct_compute_fe_terms(self):
         """
         Construct a function for computing terms in variational free energy.
         """
         # setup some symbolic variables for theano to deal with
         x_in = T.matrix()
+        sample_reps = T.lscalar()
         # construct values to output
         nll = self._construct_nll_costs()
         kld = self.kld_z + self.kld_zti_cond
-        # compile theano function for a one-sample free-energy estimate
-        fe_term_sample = theano.function(inputs=[x_in], \
-                outputs=[nll, kld], givens={self.x: x_in})
+        # construct log importance weights for the sampled latent variables.
+        # each zti only contributes when it was sampled from q_zti_given_x_xti.
+        log_weights = -nll
+        if self.model_init:
+            log_p_z = log_prob_gaussian2(self.z, T.zeros_like(self.z), \
+                    log_vars=0.0)
+            log_q_z = log_prob_gaussian(self.z, self.q_z_given_x.output_mean, \
+                    les_sigmas=self.q_z_given_x.output_sigma)
+            log_weights = log_weights + log_p_z - log_q_z
+        for i in range(self.ir_steps):
+            log_p_zti = log_prob_gaussian2(self.zt[i], \
+                    self.p_zti_given_xti[i].output_mean, \
+                    log_vars=self.p_zti_given_xti[i].output_logvar)
+            log_q_zti = log_prob_gaussian(self.zt[i], \
+                    self.q_zti_given_x_xti[i].output_mean, \
+                    les_sigmas=self.q_zti_given_x_xti[i].output_sigma)
+            log_weights = log_weights + \
+                    (self.train_switch[0] * (log_p_zti - log_q_zti))
+        # compile theano function for a multi-sample free-energy estimate
+        outputs = multi_sample_stats(-nll, kld, log_weights, sample_reps)
+        fe_term_sample = theano.function(inputs=[x_in, sample_reps], \
+                outputs=outputs, \
+                givens={self.x: x_in.repeat(sample_reps, axis=0)})
         # construct a wrapper function for multi-sample free-energy estimate
-        def fe_term_estimator(X, sample_count):
-            nll_sum = np.zeros((X.shape[0],))
-            kld_sum = np.zeros((X.shape[0],))
-            for i in range(sample_count):
-                result = fe_term_sample(X)
-                nll_sum += result[0].ravel()
-                kld_sum += result[1].ravel()
-            mean_nll = nll_sum / float(sample_count)
-            mean_kld = kld_sum / float(sample_count)
-            return [mean_nll, mean_kld]
+        fe_term_estimator = make_fe_estimator(fe_term_sample)
         return fe_term_estimator
 
     def _construct_compute_post_klds(self):
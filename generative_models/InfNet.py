@@ -18,6 +18,10 @@ from theano.sandbox.cuda.rng_curand import CURAND_RandomStreams as RandStream
 from NetLayers import HiddenLayer, DiscLayer, relu_actfun, \
                       softplus_actfun, safe_log
 from LogPDFs import gaussian_kld
+from FuncCache import LazyFunction
+from Checkpoint import write_checkpoint, read_checkpoint, \
+                       is_checkpoint_file, set_params_from_checkpoint, \
+                       shared_param_dicts_from_numpy
 
 ####################################
 # INFREENCE NETWORK IMPLEMENTATION #
@@ -67,6 +71,11 @@ class InfNet(object):
                      in-lining, e.g., PCA preprocessing on training data
         shared_param_dicts: parameters for the MLP controlled by this InfNet
     """
+    # compiled functions, built on first access
+    kld_func = LazyFunction('kld_func')
+    sample_posterior = LazyFunction('sample_posterior')
+    mean_posterior = LazyFunction('mean_posterior')
+
     def __init__(self, \
             rng=None, \
             Xd=None, \
@@ -421,15 +430,10 @@ class InfNet(object):
         self.kld_cost = self._construct_kld_cost()
         self.kld_mean_update = T.cast((0.98 * self.kld_mean) + \
                 (0.02 * T.mean(self.kld_cost)), 'floatX')
-        self.kld_func = self._construct_kld_func() # function computing KLds
-        # Construct a theano function for sampling from the approximate
-        # posteriors inferred by this model for some collection of points
-        # in the "data space".
-        if self.build_theano_funcs:
-            self.sample_posterior = self._construct_sample_posterior()
-            self.mean_posterior = theano.function([self.Xd], \
-                    outputs=self.output_mean)
-        else:
+        # The function for computing KLds, and functions for sampling from
+        # the approximate posteriors inferred by this model for some
+        # collection of points in the "data space", are compiled on first use.
+        if not self.build_theano_funcs:
             self.sample_posterior = None
             self.mean_posterior = None
 
@@ -524,6 +528,15 @@ class InfNet(object):
                 outputs=self.output)
         return psample
 
+    def _construct_mean_posterior(self):
+        """
+        Construct a function that computes the mean of the inferred posterior
+        for some set of inputs.
+        """
+        pmean = theano.function([self.Xd], \
+                outputs=self.output_mean)
+        return pmean
+
     def _construct_kld_func(self):
         """
         Construct a function for computing posterior KLds for some inputs.
@@ -565,29 +578,33 @@ class InfNet(object):
 
     def save_to_file(self, f_name=None):
         """
-        Dump important stuff to a Python pickle, so that we can reload this
-        model later. We'll pickle everything required to create a clone of
-        this model given the pickle and the rng/Xd params to the cloning
+        Dump important stuff to a checkpoint file, so that we can reload this
+        model later. We'll save everything required to create a clone of
+        this model given the file and the rng/Xd params to the cloning
         function: "InfNet.shared_param_clone()".
         """
         assert(not (f_name is None))
-        f_handle = file(f_name, 'wb')
-        # dump the "simple" python value in self.prior_sigma
-        cPickle.dump(self.prior_sigma, f_handle, protocol=-1)
-        # dump the dict self.params, which just holds "simple" python values
-        cPickle.dump(self.params, f_handle, protocol=-1)
-        # make a copy of self.shared_param_dicts, with numpy arrays in place
-        # of the theano shared variables
-        numpy_param_dicts = {'shared': [], 'mu': [], 'sigma': []}
-        for layer_group in ['shared', 'mu', 'sigma']:
-            for shared_dict in self.shared_param_dicts[layer_group]:
-                numpy_dict = {}
-                for key in shared_dict:
-                    numpy_dict[key] = shared_dict[key].get_value(borrow=False)
-                numpy_param_dicts[layer_group].append(numpy_dict)
-        # dump the numpy version of self.shared_param_dicts
-        cPickle.dump(numpy_param_dicts, f_handle, protocol=-1)
-        f_handle.close()
+        meta, param_groups = self.checkpoint_contents()
+        write_checkpoint(f_name, meta, param_groups)
+        return
+
+    def checkpoint_contents(self):
+        """
+        Get the (meta, param_groups) that save_to_file writes, e.g. for
+        exporting this model from a CheckpointManager.
+        """
+        meta = {'prior_sigma': self.prior_sigma, 'params': self.params}
+        return meta, self.shared_param_dicts
+
+    def load_params_from_file(self, f_name=None, groups=None):
+        """
+        Set this network's parameters to those in a file written by
+        save_to_file. If groups is given, only the listed layer groups (from
+        'shared', 'mu' and 'sigma') are loaded.
+        """
+        assert(not (f_name is None))
+        set_params_from_checkpoint(f_name, self.shared_param_dicts, \
+                groups=groups)
         return
 
 def load_infnet_from_file(f_name=None, rng=None, Xd=None, \
@@ -596,22 +613,26 @@ def load_infnet_from_file(f_name=None, rng=None, Xd=None, \
     Load a clone of some previously trained model.
     """
     assert(not (f_name is None))
-    pickle_file = open(f_name)
-    self_dot_prior_sigma = cPickle.load(pickle_file)
-    self_dot_params = cPickle.load(pickle_file)
+    if is_checkpoint_file(f_name):
+        meta, self_dot_numpy_param_dicts = read_checkpoint(f_name)
+        self_dot_prior_sigma = meta['prior_sigma']
+        self_dot_params = meta['params']
+    else:
+        # files from before the checkpoint format hold three pickles
+        pickle_file = open(f_name)
+        self_dot_prior_sigma = cPickle.load(pickle_file)
+        self_dot_params = cPickle.load(pickle_file)
+        self_dot_numpy_param_dicts = cPickle.load(pickle_file)
+        pickle_file.close()
     if not (new_params is None):
         for k in new_params:
             self_dot_params[k] = new_params[k]
-    self_dot_numpy_param_dicts = cPickle.load(pickle_file)
-    self_dot_shared_param_dicts = {'shared': [], 'mu': [], 'sigma': []}
+    self_dot_shared_param_dicts = {}
     for layer_group in ['shared', 'mu', 'sigma']:
-        for numpy_dict in self_dot_numpy_param_dicts[layer_group]:
-            shared_dict = {}
-            for key in numpy_dict:
-                val = numpy_dict[key].astype(theano.config.floatX)
-                shared_dict[key] = theano.shared(val)
-            self_dot_shared_param_dicts[layer_group].append(shared_dict)
-    # now, create a PeaNet with the configuration we just unpickled
+        self_dot_shared_param_dicts[layer_group] = \
+                shared_param_dicts_from_numpy( \
+                self_dot_numpy_param_dicts[layer_group])
+    # now, create an InfNet with the configuration we just loaded
     clone_net = InfNet(rng=rng, Xd=Xd, \
             prior_sigma=self_dot_prior_sigma, params=self_dot_params, \
             shared_param_dicts=self_dot_shared_param_dicts)
@@ -100,6 +100,95 @@ def gaussian_kld_BN(logvar_left, logvar_right):
             (1.0 / T.exp(logvar_right)) - 1.0)
     return gauss_klds
 
+#######################################
+# Multi-sample free-energy estimation #
+#######################################
+
+def log_sum_exp_rows(A):
+    """
+    Compute a numerically stable log(sum(exp(A))) for each row of A.
+    """
+    max_ = T.max(A, axis=1, keepdims=True)
+    lse = max_ + T.log(T.sum(T.exp(A - max_), axis=1, keepdims=True))
+    return lse.flatten()
+
+def multi_sample_stats(ll_terms, kld_terms, log_weights, sample_reps):
+    """
+    Reduce per-sample terms computed for a row-repeated input batch (i.e.
+    one made by X.repeat(sample_reps, axis=0)) into per-observation stats.
+
+    Returns symbolic vectors holding, for each observation, the sum of its
+    sampled log-likelihoods, the sum of its sampled KLds, the max of its
+    sampled log-likelihoods, and the log-sum-exp of its log importance
+    weights. These can be merged across calls by multi_sample_estimator.
+    """
+    obs_count = ll_terms.shape[0] // sample_reps
+    ll_mat = T.reshape(ll_terms.flatten(), (obs_count, sample_reps))
+    kld_mat = T.reshape(kld_terms.flatten(), (obs_count, sample_reps))
+    lw_mat = T.reshape(log_weights.flatten(), (obs_count, sample_reps))
+    ll_sum = T.sum(ll_mat, axis=1)
+    kld_sum = T.sum(kld_mat, axis=1)
+    ll_max = T.max(ll_mat, axis=1)
+    lw_lse = log_sum_exp_rows(lw_mat)
+    return [ll_sum, kld_sum, ll_max, lw_lse]
+
+def multi_sample_estimator(sample_func, X, sample_count, batch_size=10000):
+    """
+    Stream the observations in X through sample_func, which should be a
+    compiled function taking (Xb, sample_reps) and returning the outputs of
+    multi_sample_stats for Xb. At most batch_size rows of the repeated input
+    are pushed through the graph by each call, which bounds memory use.
+
+    Returns per-observation means of the sampled log-likelihoods and KLds,
+    the max sampled log-likelihood, and the importance-weighted bound.
+    """
+    obs_count = X.shape[0]
+    reps_per_call = max(1, min(sample_count, batch_size))
+    rows_per_call = max(1, batch_size // reps_per_call)
+    ll_sum = np.zeros((obs_count,))
+    kld_sum = np.zeros((obs_count,))
+    ll_max = np.zeros((obs_count,)) - np.inf
+    lw_lse = np.zeros((obs_count,)) - np.inf
+    for row_start in range(0, obs_count, rows_per_call):
+        row_end = min(obs_count, row_start + rows_per_call)
+        Xb = X[row_start:row_end]
+        samps_done = 0
+        while samps_done < sample_count:
+            reps = min(reps_per_call, sample_count - samps_done)
+            result = sample_func(Xb, reps)
+            ll_sum[row_start:row_end] += result[0]
+            kld_sum[row_start:row_end] += result[1]
+            ll_max[row_start:row_end] = \
+                    np.maximum(ll_max[row_start:row_end], result[2])
+            lw_lse[row_start:row_end] = \
+                    np.logaddexp(lw_lse[row_start:row_end], result[3])
+            samps_done = samps_done + reps
+    mean_ll = ll_sum / float(sample_count)
+    mean_kld = kld_sum / float(sample_count)
+    iw_bound = lw_lse - np.log(sample_count)
+    return [mean_ll, mean_kld, ll_max, iw_bound]
+
+def make_fe_estimator(sample_func, batch_size=10000):
+    """
+    Wrap a compiled multi-sample function (see multi_sample_stats) in a
+    multi-sample free-energy estimator for some collection of inputs.
+
+    The estimator returns the per-observation mean NLL, the mean KLd, and
+    the NLL given by the importance-weighted bound. The free-energy bound is
+    given by the sum of the first two terms.
+    """
+    default_batch_size = batch_size
+    def fe_term_estimator(X, sample_count, batch_size=None):
+        if batch_size is None:
+            batch_size = default_batch_size
+        result = multi_sample_estimator(sample_func, X, sample_count, \
+                batch_size=batch_size)
+        mean_nll = -result[0]
+        mean_kld = result[1]
+        iw_nll = -result[3]
+        return [mean_nll, mean_kld, iw_nll]
+    return fe_term_estimator
+
 #################################
 # Log-gamma function for theano #
 #################################
@@ -138,7 +227,6 @@ def log_gamma_lanczos_sub(z): #expanded version
 # PARZEN DENSITY ESTIMATOR #
 ############################
 import time
-import gc
 
 def get_nll(x, parzen, batch_size=100):
     """
@@ -181,25 +269,87 @@ def theano_parzen(mu, sigma):
     parzen_func = theano.function([x], E - Z)
     return parzen_func
 
-def cross_validate_sigma(samples, data, sigmas, batch_size):
+def _parzen_lls_chunk(X, mu, sigmas, mu_batch=5000):
+    """
+    Compute Parzen log-likelihoods of the rows in X for each sigma in sigmas,
+    sweeping over the kernel centers in mu in blocks of mu_batch rows. The
+    squared distances for each block are shared by all sigmas, and we keep a
+    running log-sum-exp for each (row, sigma) pair, so memory use does not
+    grow with the number of kernel centers.
+    """
+    X = X.astype(np.float64)
+    sigmas = np.asarray(sigmas, dtype=np.float64)
+    scales = -0.5 / sigmas**2.0
+    x_sq = np.sum(X**2.0, axis=1)[:,np.newaxis]
+    run_max = np.zeros((X.shape[0], sigmas.shape[0])) - np.inf
+    run_sum = np.zeros((X.shape[0], sigmas.shape[0]))
+    for mu_start in range(0, mu.shape[0], mu_batch):
+        mu_b = mu[mu_start:(mu_start + mu_batch)].astype(np.float64)
+        mu_sq = np.sum(mu_b**2.0, axis=1)[np.newaxis,:]
+        d2 = np.maximum((x_sq + mu_sq) - (2.0 * np.dot(X, mu_b.T)), 0.0)
+        # the max over each block is given by the min squared distance
+        d2_min = np.min(d2, axis=1)
+        for j in range(sigmas.shape[0]):
+            new_max = np.maximum(run_max[:,j], scales[j] * d2_min)
+            run_sum[:,j] = (run_sum[:,j] * np.exp(run_max[:,j] - new_max)) + \
+                    np.sum(np.exp((scales[j] * d2) - new_max[:,np.newaxis]), axis=1)
+            run_max[:,j] = new_max
+    log_means = run_max + np.log(run_sum) - np.log(mu.shape[0])
+    Z = mu.shape[1] * np.log(sigmas * np.sqrt(np.pi * 2.0))
+    return log_means - Z[np.newaxis,:]
+
+# state shared with the worker processes used by parzen_lls
+_PARZEN_ARGS = {}
+
+def _parzen_init(mu, sigmas, mu_batch):
+    _PARZEN_ARGS['mu'] = mu
+    _PARZEN_ARGS['sigmas'] = sigmas
+    _PARZEN_ARGS['mu_batch'] = mu_batch
+    return
+
+def _parzen_work(X):
+    return _parzen_lls_chunk(X, _PARZEN_ARGS['mu'], _PARZEN_ARGS['sigmas'], \
+            mu_batch=_PARZEN_ARGS['mu_batch'])
+
+def parzen_lls(X, mu, sigmas, x_batch=500, mu_batch=5000, n_procs=1):
+    """
+    Compute Parzen window log-likelihoods for the rows of X, using Gaussian
+    kernels centered on the rows of mu, for all bandwidths in sigmas.
+
+    The rows of X are processed in chunks of x_batch rows, which can be
+    farmed out to a pool of n_procs worker processes. Returns a matrix with
+    one row per row of X and one column per sigma.
+    """
+    sigmas = list(sigmas)
+    chunks = [X[i:(i + x_batch)] for i in range(0, X.shape[0], x_batch)]
+    if n_procs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(n_procs, initializer=_parzen_init, \
+                initargs=(mu, sigmas, mu_batch))
+        try:
+            results = pool.map(_parzen_work, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_parzen_lls_chunk(Xc, mu, sigmas, mu_batch=mu_batch) \
+                for Xc in chunks]
+    return np.vstack(results)
+
+def cross_validate_sigma(samples, data, sigmas, batch_size, n_procs=1):
     """
     Find which sigma is best for the Parzen estimator bound.
+
+    All sigmas are evaluated in a single sweep over the data.
     """
-    lls = []
-    best_ll = -1e6
-    best_lls = None
-    best_sigma = None
-    for sigma in sigmas:
-        print sigma
-        parzen = theano_parzen(samples, sigma)
-        tmp = get_nll(data, parzen, batch_size=batch_size)
-        sigma_lls = np.asarray(tmp)
-        mean_ll = sigma_lls.mean()
-        lls.append(mean_ll)
-        if (mean_ll > best_ll):
-            best_ll = mean_ll
-            best_lls = sigma_lls
-            best_sigma = sigma
-        del parzen
-        gc.collect()
-    return [best_sigma, best_ll, best_lls]
\ No newline at end of file
+    sigmas = list(sigmas)
+    all_lls = parzen_lls(data, samples, sigmas, x_batch=batch_size, \
+            n_procs=n_procs)
+    mean_lls = np.mean(all_lls, axis=0)
+    for sigma, mean_ll in zip(sigmas, mean_lls):
+        print("sigma: {0:.4f}, mean ll: {1:.4f}".format(sigma, mean_ll))
+    best_idx = int(np.argmax(mean_lls))
+    best_sigma = sigmas[best_idx]
+    best_ll = mean_lls[best_idx]
+    best_lls = all_lls[:,best_idx]
+    return [best_sigma, best_ll, best_lls]
@@ -104,7 +104,66 @@ class MCSampler(object):
         sample_func = theano.function([self.Xd], outputs=outputs)
         return sample_func
 
-def resample_chain_steps(MCS, Xtr_chains):
+def make_chain_tensor(Xtr, chain_len, f_name=None):
+    """
+    Allocate a contiguous float32 tensor of shape (chain_len+1, N, D) for
+    holding chains started at the N rows of Xtr, with Xtr in step 0 and the
+    remaining steps initialized to copies of Xtr. If f_name is given, the
+    tensor is a memmap backed by the .npy file f_name.
+    """
+    shape = (chain_len + 1, Xtr.shape[0], Xtr.shape[1])
+    if f_name is None:
+        Xtr_chains = np.zeros(shape, dtype=np.float32)
+    else:
+        Xtr_chains = np.lib.format.open_memmap(f_name, mode='w+', \
+                dtype=np.float32, shape=shape)
+    for i in range(chain_len + 1):
+        Xtr_chains[i] = Xtr
+    return Xtr_chains
+
+def auto_batch_size(MCS, mem_frac=0.25, min_size=100, max_size=20000):
+    """
+    Pick a batch size for resample_chain_steps, such that the activations
+    for a batch of chains take at most mem_frac of the free memory. This
+    uses free GPU memory when theano is on the GPU, and otherwise uses free
+    host memory.
+    """
+    free_bytes = None
+    try:
+        from theano.sandbox.cuda import cuda_ndarray
+        free_bytes = cuda_ndarray.cuda_ndarray.mem_info()[0]
+    except Exception:
+        free_bytes = None
+    if free_bytes is None:
+        try:
+            for line in open('/proc/meminfo'):
+                if line.startswith('MemAvailable:'):
+                    free_bytes = int(line.split()[1]) * 1024
+        except Exception:
+            free_bytes = None
+    if free_bytes is None:
+        return 5000
+    # estimate the (float32) activations computed per row in each step
+    layers = MCS.IN.shared_layers + MCS.IN.mu_layers + \
+            MCS.IN.sigma_layers + MCS.GN.mlp_layers
+    row_vals = MCS.data_dim + sum([l.out_dim for l in layers])
+    # allow for some intermediate values alongside each activation
+    row_bytes = 3 * 4 * row_vals * MCS.chain_len
+    batch_size = int((mem_frac * free_bytes) / row_bytes)
+    return max(min_size, min(max_size, batch_size))
+
+def resample_chain_steps(MCS, Xtr_chains, refresh_frac=1.0, chain_ages=None, \
+                         max_staleness=None, batch_size=5000):
+    """
+    Resample the chains in Xtr_chains, which is either a list of chain_len+1
+    arrays or a tensor from make_chain_tensor, and is updated in place.
+
+    With refresh_frac < 1, only a random refresh_frac of the chains are
+    resampled. If chain_ages is given, it should hold the number of calls
+    since each chain was last resampled, and it gets updated here. Chains
+    whose age reaches max_staleness are always resampled. If batch_size is
+    None, it is chosen by auto_batch_size.
+    """
     # get and set some basic dataset information
     assert(len(Xtr_chains) == (MCS.chain_len + 1))
     Xtr = Xtr_chains[0]
@@ -113,16 +172,42 @@ def resample_chain_steps(MCS, Xtr_chains):
         assert(Xc.shape[1] == Xtr.shape[1])
     tr_samples = Xtr.shape[0]
     data_dim = Xtr.shape[1]
-    batch_size = 5000
-    batch_count = int(np.ceil(tr_samples / float(batch_size)))
+    if batch_size is None:
+        batch_size = auto_batch_size(MCS)
+    # pick the chains to resample
+    if refresh_frac >= 1.0:
+        chain_idx = None
+        refresh_count = tr_samples
+    else:
+        refresh_mask = npr.rand(tr_samples) < refresh_frac
+        if (not (chain_ages is None)) and (not (max_staleness is None)):
+            refresh_mask = refresh_mask | ((chain_ages + 1) >= max_staleness)
+        # sorted indices keep reads/writes local, which helps for memmaps
+        chain_idx = np.flatnonzero(refresh_mask)
+        refresh_count = chain_idx.shape[0]
+    batch_count = int(np.ceil(refresh_count / float(batch_size)))
     # print("Resampling {0:d} batches of {1:d} chains with {2:d} steps...".format(batch_count, batch_size, MCS.chain_len))
     for i in range(batch_count):
         batch_start = i * batch_size
-        batch_end = min(tr_samples, (batch_start + batch_size))
-        batch_Xd = Xtr[batch_start:batch_end]
-        batch_chains = MCS.sample_from_chain(batch_Xd)
-        for j in range(len(batch_chains)):
-            Xtr_chains[j+1][batch_start:batch_end] = batch_chains[j]
+        batch_end = min(refresh_count, (batch_start + batch_size))
+        if chain_idx is None:
+            batch_Xd = Xtr[batch_start:batch_end]
+            batch_chains = MCS.sample_from_chain(batch_Xd)
+            for j in range(len(batch_chains)):
+                Xtr_chains[j+1][batch_start:batch_end] = batch_chains[j]
+        else:
+            batch_idx = chain_idx[batch_start:batch_end]
+            batch_Xd = Xtr.take(batch_idx, axis=0)
+            batch_chains = MCS.sample_from_chain(batch_Xd)
+            for j in range(len(batch_chains)):
+                Xtr_chains[j+1][batch_idx] = batch_chains[j]
+    # update the number of calls since each chain was resampled
+    if not (chain_ages is None):
+        chain_ages += 1
+        if chain_idx is None:
+            chain_ages[:] = 0
+        else:
+            chain_ages[chain_idx] = 0
     return Xtr_chains
 
 
@@ -194,6 +279,16 @@ if __name__=="__main__":
     Xtr_chains = resample_chain_steps(MCS, Xtr_chains)
     total_time = time.clock() - start_time
     print("total_time: {0:.4f}".format(total_time))
+    # incrementally refresh chains stored in a single tensor
+    Xtr_chains = make_chain_tensor(Xtr, MCS.chain_len)
+    chain_ages = np.zeros((tr_samples,), dtype=np.int32)
+    start_time = time.clock()
+    for i in range(10):
+        Xtr_chains = resample_chain_steps(MCS, Xtr_chains, refresh_frac=0.1, \
+                chain_ages=chain_ages, max_staleness=20, batch_size=None)
+    total_time = time.clock() - start_time
+    print("incremental total_time: {0:.4f}, max age: {1:d}".format( \
+            total_time, int(np.max(chain_ages))))
 
 
 
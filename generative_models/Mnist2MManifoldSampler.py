@@ -12,7 +12,8 @@ from GenNet import GenNet, load_gennet_from_file
 from VCGLoop import VCGLoop
 from GIPair import GIPair
 from NetLayers import relu_actfun, softplus_actfun, \
-                      safe_softmax, safe_log
+                      safe_softmax, safe_log, sample_masks, \
+                      sample_patch_masks
 import GenNet as GNet
 import InfNet as INet
 import PeaNet as PNet
@@ -26,35 +27,6 @@ sys.setrecursionlimit(10**6)
 RESULT_PATH = "M2MMS_RESULTS_50D/"
 
 
-#####################################
-# HELPER FUNCTIONS FOR DATA MASKING #
-#####################################
-
-def sample_masks(X, drop_prob=0.3):
-    """
-    Sample a binary mask to apply to the matrix X, with rate mask_prob.
-    """
-    probs = npr.rand(*X.shape)
-    mask = 1.0 * (probs > drop_prob)
-    return mask.astype(theano.config.floatX)
-
-def sample_patch_masks(X, im_shape, patch_shape):
-    """
-    Sample a random patch mask for each image in X.
-    """
-    obs_count = X.shape[0]
-    rs = patch_shape[0]
-    cs = patch_shape[1]
-    off_row = npr.randint(1,high=(im_shape[0]-rs-1), size=(obs_count,))
-    off_col = npr.randint(1,high=(im_shape[1]-cs-1), size=(obs_count,))
-    dummy = np.zeros(im_shape)
-    mask = np.zeros(X.shape)
-    for i in range(obs_count):
-        dummy = (0.0 * dummy) + 1.0
-        dummy[off_row[i]:(off_row[i]+rs), off_col[i]:(off_col[i]+cs)] = 0.0
-        mask[i,:] = dummy.ravel()
-    return mask.astype(theano.config.floatX)
-
 ######################
 ######################
 ## PRETRAIN THE GIP ##
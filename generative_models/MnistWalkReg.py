@@ -17,12 +17,22 @@ import GenNet as GNet
 import InfNet as INet
 import PeaNet as PNet
 from DKCode import PCA_theano
-from MCSampler import MCSampler, resample_chain_steps
+from MCSampler import MCSampler, resample_chain_steps, make_chain_tensor
+from BatchPrefetcher import BatchPrefetcher
 
 def downsample_chains(X_chain, stride=1):
 	Xs = [X_chain[i] for i in range(len(X_chain)) if ((i % stride) == 0)]
 	return Xs
 
+def fresh_chains(X_chain):
+	"""
+	Get a new chain tensor with the same start points as the chain tensor
+	X_chain, so resampling it leaves X_chain untouched.
+	"""
+	Xs = np.empty_like(X_chain)
+	Xs[0] = X_chain[0]
+	return Xs
+
 
 def manifold_walk_regularization():
 
@@ -86,8 +96,8 @@ def manifold_walk_regularization():
 	    full_chain_len = MCS.chain_len + 1
 
 	    # setup "chain" versions of the labeled/unlabeled/validate sets
-	    Xtr_su_chains = [Xtr_su.copy() for i in range(full_chain_len)]
-	    Xtr_un_chains = [Xtr_un.copy() for i in range(full_chain_len)]
+	    Xtr_su_chains = make_chain_tensor(Xtr_su, MCS.chain_len)
+	    Xtr_un_chains = make_chain_tensor(Xtr_un, MCS.chain_len)
 	    Ytr_su_chains = [Ytr_su for i in range(full_chain_len)]
 	    Ytr_un_chains = [Ytr_un for i in range(full_chain_len)]
 	    Xva_chains = [Xva for i in range(full_chain_len)]
@@ -136,25 +146,39 @@ def manifold_walk_regularization():
 
 	    learn_rate = 0.05
 	    PNS.set_pn_sgd_params(lr_pn=learn_rate, mom_1=0.9, mom_2=0.999)
+	    # build minibatches in a background thread. the thread reads the
+	    # current chains, so batches still in the (short) queue when the
+	    # chains get resampled will come from the previous chains. chains are
+	    # resampled into new arrays, and swapped in all at once through
+	    # cur_chains, so the thread never sees a half-resampled chain.
+	    cur_chains = [(Xtr_su_short, Xtr_un_short)]
+	    def make_batch():
+	        Xsu_short, Xun_short = cur_chains[0]
+	        su_idx = npr.randint(low=0,high=su_samples,size=(batch_size,))
+	        xsuc = [(x.take(su_idx, axis=0) - Xtr_mean) for x in Xsu_short]
+	        ysuc = [y.take(su_idx, axis=0) for y in Ytr_su_short]
+	        un_idx = npr.randint(low=0,high=un_samples,size=(batch_size,))
+	        xunc = [(x.take(un_idx, axis=0) - Xtr_mean) for x in Xun_short]
+	        yunc = [y.take(un_idx, axis=0) for y in Ytr_un_short]
+	        Xb_chains = [np.vstack((xsu, xun)) for (xsu, xun) in zip(xsuc, xunc)]
+	        Yb_chains = [np.vstack((ysu, yun)) for (ysu, yun) in zip(ysuc, yunc)]
+	        return [Xb_chains, Yb_chains]
+	    batches = BatchPrefetcher(make_batch, queue_size=4, worker_count=1)
 	    for i in range(300000):
 	        if i < 5000:
 	            scale = float(i + 1) / 5000.0
 	        if ((i+1 % 100000) == 0):
 	            learn_rate = learn_rate * 0.5
 	        if ((i % 250) == 0):
-	        	Xtr_su_chains = resample_chain_steps(MCS, Xtr_su_chains)
-	        	Xtr_un_chains = resample_chain_steps(MCS, Xtr_un_chains)
+	        	Xtr_su_chains = resample_chain_steps(MCS, \
+	        			fresh_chains(Xtr_su_chains))
+	        	Xtr_un_chains = resample_chain_steps(MCS, \
+	        			fresh_chains(Xtr_un_chains))
 	        	Xtr_su_short = downsample_chains(Xtr_su_chains, stride=1)
 	        	Xtr_un_short = downsample_chains(Xtr_un_chains, stride=1)
-	        # get some data to train with
-	        su_idx = npr.randint(low=0,high=su_samples,size=(batch_size,))
-	        xsuc = [(x.take(su_idx, axis=0) - Xtr_mean) for x in Xtr_su_short]
-	        ysuc = [y.take(su_idx, axis=0) for y in Ytr_su_short]
-	        un_idx = npr.randint(low=0,high=un_samples,size=(batch_size,))
-	        xunc = [(x.take(un_idx, axis=0) - Xtr_mean) for x in Xtr_un_short]
-	        yunc = [y.take(un_idx, axis=0) for y in Ytr_un_short]
-	        Xb_chains = [np.vstack((xsu, xun)) for (xsu, xun) in zip(xsuc, xunc)]
-	        Yb_chains = [np.vstack((ysu, yun)) for (ysu, yun) in zip(ysuc, yunc)]
+	        	cur_chains[0] = (Xtr_su_short, Xtr_un_short)
+	        # get some data to train with (built in the background)
+	        Xb_chains, Yb_chains = batches.next()
 	        # set learning parameters for this update
 	        PNS.set_pn_sgd_params(lr_pn=learn_rate, mom_1=0.9, mom_2=0.999)
 	        # do a minibatch update of all PeaNet parameters
@@ -182,6 +206,7 @@ def manifold_walk_regularization():
 	            # draw the main PeaNet's first-layer filters/weights
 	            file_name = "MWR_PN_WEIGHTS.png".format(i)
 	            utils.visualize_net_layer(PNS.PN.proto_nets[0][0], file_name)
+	    batches.close()
 	    print("TESTING COMPLETE!")
 
 if __name__ == "__main__":
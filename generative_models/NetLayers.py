@@ -137,6 +137,72 @@ def binarize_data(X):
     X_binary = 1.0 * (probs < X)
     return X_binary.astype(theano.config.floatX)
 
+def sample_masks(X, drop_prob=0.3):
+    """
+    Sample a binary mask to apply to the matrix X, with rate mask_prob.
+    """
+    probs = npr.rand(*X.shape)
+    mask = 1.0 * (probs > drop_prob)
+    return mask.astype(theano.config.floatX)
+
+def sample_patch_masks(X, im_shape, patch_shape, patch_count=1):
+    """
+    Sample a random patch mask for each image in X. Each mask is zero inside
+    patch_count (possibly overlapping) patches of shape patch_shape, whose
+    top-left corners are placed uniformly at random (one pixel away from
+    the image border), and one elsewhere.
+    """
+    obs_count = X.shape[0]
+    rs = patch_shape[0]
+    cs = patch_shape[1]
+    off_row = npr.randint(1,high=(im_shape[0]-rs-1), \
+            size=(obs_count,patch_count,1))
+    off_col = npr.randint(1,high=(im_shape[1]-cs-1), \
+            size=(obs_count,patch_count,1))
+    # find the rows and columns covered by each patch
+    rows = np.arange(im_shape[0]).reshape((1,1,-1))
+    cols = np.arange(im_shape[1]).reshape((1,1,-1))
+    in_rows = (rows >= off_row) & (rows < (off_row + rs))
+    in_cols = (cols >= off_col) & (cols < (off_col + cs))
+    # a pixel is masked if any patch covers both its row and column
+    in_patch = in_rows[:,:,:,np.newaxis] & in_cols[:,:,np.newaxis,:]
+    mask = 1.0 - np.any(in_patch, axis=1).reshape((obs_count, -1))
+    return mask.astype(theano.config.floatX)
+
+def sample_patch_masks_theano(rng, obs_count, im_shape, patch_shape, \
+                              patch_count=1):
+    """
+    Symbolic version of sample_patch_masks, which samples obs_count masks
+    in the graph using the (CURAND) random stream rng.
+    """
+    rs = patch_shape[0]
+    cs = patch_shape[1]
+    # sample integer offsets in [1, im_shape - patch_shape - 1), like the
+    # numpy version. CURAND's uniform can return exactly 1.0, so the scaled
+    # samples get clamped to the last offset.
+    n_row = im_shape[0] - rs - 2
+    n_col = im_shape[1] - cs - 2
+    u_row = rng.uniform(size=(obs_count, patch_count), low=0.0, high=1.0, \
+            dtype=theano.config.floatX)
+    u_col = rng.uniform(size=(obs_count, patch_count), low=0.0, high=1.0, \
+            dtype=theano.config.floatX)
+    off_row = 1.0 + T.minimum(T.floor(u_row * n_row), (n_row - 1))
+    off_col = 1.0 + T.minimum(T.floor(u_col * n_col), (n_col - 1))
+    off_row = off_row.dimshuffle(0, 1, 'x')
+    off_col = off_col.dimshuffle(0, 1, 'x')
+    # find the rows and columns covered by each patch
+    rows = T.arange(im_shape[0]).astype(theano.config.floatX)
+    cols = T.arange(im_shape[1]).astype(theano.config.floatX)
+    rows = rows.dimshuffle('x', 'x', 0)
+    cols = cols.dimshuffle('x', 'x', 0)
+    in_rows = T.ge(rows, off_row) * T.lt(rows, (off_row + rs))
+    in_cols = T.ge(cols, off_col) * T.lt(cols, (off_col + cs))
+    # a pixel is masked if any patch covers both its row and column
+    in_patch = in_rows.dimshuffle(0, 1, 2, 'x') * \
+            in_cols.dimshuffle(0, 1, 'x', 2)
+    mask = 1.0 - T.max(in_patch, axis=1).reshape((obs_count, -1))
+    return T.cast(mask, theano.config.floatX)
+
 def row_shuffle(X):
     """
     Return a copy of X with shuffled rows.
@@ -579,3 +645,40 @@ class DAELayer(object):
         # Cast mask from int to float32, to keep things on GPU
         noisy_input = input * drop_mask
         return noisy_input
+
+if __name__ == "__main__":
+    # Check that sample_patch_masks_theano puts its patches at the same
+    # offsets as sample_patch_masks, including when the uniform samples are
+    # at the ends of [0, 1].
+    from theano.tensor.shared_randomstreams import RandomStreams
+    class ConstStream(object):
+        """Stand-in random stream whose uniform samples all equal val."""
+        def __init__(self, val):
+            self.val = val
+        def uniform(self, size, low=0.0, high=1.0, dtype=None):
+            return T.alloc(np.asarray(self.val, dtype=dtype), *size)
+    im_shape = (28, 28)
+    patch_shape = (7, 7)
+    obs_count = 1000
+    def mask_offsets(masks):
+        # row and column of the top-left masked pixel in each mask
+        ims = masks.reshape((-1, im_shape[0], im_shape[1])) < 0.5
+        rows = np.argmax(np.any(ims, axis=2), axis=1)
+        cols = np.argmax(np.any(ims, axis=1), axis=1)
+        return np.concatenate([rows, cols])
+    npr.seed(0)
+    X = np.zeros((obs_count, im_shape[0]*im_shape[1]))
+    np_offs = mask_offsets(sample_patch_masks(X, im_shape, patch_shape))
+    (off_min, off_max) = (1, im_shape[0] - patch_shape[0] - 2)
+    assert((np_offs.min() == off_min) and (np_offs.max() == off_max))
+    srng = RandomStreams(0)
+    for (rng, offs) in [(srng, None), (ConstStream(0.0), off_min), \
+                        (ConstStream(0.5), None), (ConstStream(1.0), off_max)]:
+        sample_masks = theano.function([], \
+                sample_patch_masks_theano(rng, obs_count, im_shape, patch_shape))
+        th_offs = mask_offsets(sample_masks())
+        assert((th_offs.min() >= off_min) and (th_offs.max() <= off_max))
+        if offs is not None:
+            assert(np.all(th_offs == offs))
+    print("sample_patch_masks_theano offsets OK, in [{0:d}, {1:d}]".format( \
+            off_min, off_max))
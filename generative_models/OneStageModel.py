@@ -20,7 +20,9 @@ from GenNet import GenNet
 from InfNet import InfNet
 from PeaNet import PeaNet
 from DKCode import get_adam_updates, get_adadelta_updates
-from LogPDFs import log_prob_bernoulli, log_prob_gaussian2, gaussian_kld
+from FuncCache import LazyFunction
+from LogPDFs import log_prob_bernoulli, log_prob_gaussian, log_prob_gaussian2, \
+                    gaussian_kld, multi_sample_stats, make_fe_estimator
 
 
 #
@@ -58,6 +60,13 @@ class OneStageModel(object):
                 x_type: can be "bernoulli" or "gaussian"
                 xt_type: must be "observed"
     """
+    # compiled functions, built on first access
+    train_joint = LazyFunction('train_joint')
+    train_joint_idx = LazyFunction('train_joint_idx')
+    compute_fe_terms = LazyFunction('compute_fe_terms')
+    compute_post_klds = LazyFunction('compute_post_klds')
+    sample_from_prior = LazyFunction('sample_from_prior')
+
     def __init__(self, rng=None, \
             Xd=None, Xc=None, Xm=None, \
             p_xt_given_z=None, q_z_given_x=None, \
@@ -104,6 +113,9 @@ class OneStageModel(object):
         zero_row = np.zeros((self.x_dim,)).astype(theano.config.floatX)
         self.output_bias = theano.shared(value=zero_row, name='tsm_output_bias')
         self.output_logvar = theano.shared(value=zero_ary, name='tsm_output_logvar')
+        # self.X_train holds a device-resident training set
+        zero_mat = np.zeros((1, self.x_dim)).astype(theano.config.floatX)
+        self.X_train = theano.shared(value=zero_mat, name='osm_X_train')
 
         #####################################################################
         # Setup the computation graph that provides values in our objective #
@@ -183,11 +195,8 @@ class OneStageModel(object):
                 beta1=self.mom_1, beta2=self.mom_2, it_count=self.it_count, \
                 mom2_init=1e-3, smoothing=1e-8, max_grad_norm=10.0)
 
-        # Construct a function for jointly training the generator/inferencer
-        self.train_joint = self._construct_train_joint()
-        self.compute_fe_terms = self._construct_compute_fe_terms()
-        self.compute_post_klds = self._construct_compute_post_klds()
-        self.sample_from_prior = self._construct_sample_from_prior()
+        # Functions for training/evaluation are compiled on first use. See
+        # the LazyFunction attributes of this class.
         self.inf_weights = self.q_z_given_x.shared_layers[0].W
         self.gen_weights = self.p_xt_given_z.mu_layers[-1].W
         return
@@ -236,6 +245,13 @@ class OneStageModel(object):
         self.lam_l2w.set_value(new_lam.astype(theano.config.floatX))
         return
 
+    def set_train_data(self, X):
+        """
+        Set the training set from which train_joint_idx takes minibatches.
+        """
+        self.X_train.set_value(X.astype(theano.config.floatX))
+        return
+
     def set_lam_zmm(self, lam_zmm=1e-3):
         """
         Set the relative weight of moment matching on posteriors over z.
@@ -335,6 +351,25 @@ class OneStageModel(object):
                 updates=self.joint_updates)
         return func
 
+    def _construct_train_joint_idx(self):
+        """
+        Construct theano function to train all networks jointly, using the
+        rows of self.X_train given by an index vector. Each row is repeated
+        batch_reps times, and Xc/Xm are set to zero, in the graph.
+        """
+        idx = T.ivector()
+        Xb = self.X_train[idx].repeat(self.batch_reps, axis=0)
+        outputs = [self.joint_cost, self.nll_cost, self.kld_cost, \
+                self.reg_cost, self.zmm_cost, self.nll_costs, \
+                self.kld_costs]
+        func = theano.function(inputs=[ idx, self.batch_reps ], \
+                outputs=outputs, \
+                givens={ self.Xd: Xb, \
+                         self.Xc: T.zeros_like(Xb), \
+                         self.Xm: T.zeros_like(Xb) }, \
+                updates=self.joint_updates)
+        return func
+
     def _construct_compute_post_klds(self):
         """
         Construct theano function to compute the info about the variational
@@ -361,8 +396,10 @@ class OneStageModel(object):
         """
         # setup some symbolic variables for theano to deal with
         Xd = T.matrix()
-        Xc = T.zeros_like(Xd)
-        Xm = T.zeros_like(Xd)
+        sample_reps = T.lscalar()
+        Xr = Xd.repeat(sample_reps, axis=0)
+        Xc = T.zeros_like(Xr)
+        Xm = T.zeros_like(Xr)
         # construct values to output
         if self.x_type == 'bernoulli':
             ll_term = log_prob_bernoulli(self.x, self.xg)
@@ -375,21 +412,20 @@ class OneStageModel(object):
                 self.q_z_given_x.output_logvar, \
                 prior_mean, prior_logvar)
         kld_term = T.sum(all_klds, axis=1)
-        # compile theano function for a one-sample free-energy estimate
-        fe_term_sample = theano.function(inputs=[Xd], \
-                outputs=[ll_term, kld_term], \
-                givens={self.Xd: Xd, self.Xc: Xc, self.Xm: Xm})
+        # construct log importance weights for the sampled latent variables
+        log_p_z = log_prob_gaussian2(self.z, T.zeros_like(self.z) + \
+                prior_mean, log_vars=prior_logvar)
+        log_q_z = log_prob_gaussian(self.z, self.z_mean, \
+                les_sigmas=self.q_z_given_x.output_sigma)
+        log_weights = ll_term + log_p_z - log_q_z
+        # compile theano function for a multi-sample free-energy estimate
+        outputs = multi_sample_stats(ll_term, kld_term, log_weights, \
+                sample_reps)
+        fe_term_sample = theano.function(inputs=[Xd, sample_reps], \
+                outputs=outputs, \
+                givens={self.Xd: Xr, self.Xc: Xc, self.Xm: Xm})
         # construct a wrapper function for multi-sample free-energy estimate
-        def fe_term_estimator(X, sample_count):
-            ll_sum = np.zeros((X.shape[0],))
-            kld_sum = np.zeros((X.shape[0],))
-            for i in range(sample_count):
-                result = fe_term_sample(X)
-                ll_sum = ll_sum + result[0].ravel()
-                kld_sum = kld_sum + result[1].ravel()
-            mean_nll = -ll_sum / float(sample_count)
-            mean_kld = kld_sum / float(sample_count)
-            return [mean_nll, mean_kld]
+        fe_term_estimator = make_fe_estimator(fe_term_sample)
         return fe_term_estimator
 
     def _construct_sample_from_prior(self):
@@ -411,29 +447,18 @@ class OneStageModel(object):
             return result_dict
         return prior_sampler
 
-def compute_fe_bound(OSM, X, sample_count):
+def compute_fe_bound(OSM, X, sample_count, batch_size=10000):
     """
     Compute free-energy bound for X, in minibatches.
+
+    The returned importance-weighted bound is computed in the same pass.
     """
-    obs_count = X.shape[0]
-    batch_size = 2000
-    X_nll = np.zeros((obs_count,))
-    X_kld = np.zeros((obs_count,))
-    batch_start = 0
-    while True:
-        batch_end = min(obs_count, batch_start+batch_size)
-        print("batch index: {0:d} --> {1:d}".format(batch_start, batch_end))
-        Xb = X[batch_start:batch_end]
-        fe_terms = OSM.compute_fe_terms(Xb, sample_count)
-        X_nll[batch_start:batch_end] = fe_terms[0].ravel()
-        X_kld[batch_start:batch_end] = fe_terms[1].ravel()
-        # advance batch bounds
-        batch_start = batch_end
-        # quit when its the right time
-        if batch_start == obs_count:
-            break
+    fe_terms = OSM.compute_fe_terms(X, sample_count, batch_size=batch_size)
+    X_nll = fe_terms[0]
+    X_kld = fe_terms[1]
     X_fe = X_nll + X_kld
-    return [X_fe, X_nll, X_kld]
+    X_iw = fe_terms[2]
+    return [X_fe, X_nll, X_kld, X_iw]
 
 def collect_obs_costs(batch_costs, batch_reps):
     """
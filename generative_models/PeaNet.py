@@ -12,6 +12,9 @@ from theano.sandbox.cuda.rng_curand import CURAND_RandomStreams as RandStream
 
 from NetLayers import HiddenLayer, JoinLayer, DAELayer, safe_log, \
                       relu_actfun, safe_softmax
+from Checkpoint import write_checkpoint, read_checkpoint, \
+                       is_checkpoint_file, set_params_from_checkpoint, \
+                       shared_param_dicts_from_numpy
 
 #####################################################################
 # NON-LINEARITIES: Some activation functions, for your convenience. #
@@ -416,26 +419,23 @@ class PeaNet(object):
 
     def save_to_file(self, f_name=None):
         """
-        Dump important stuff to a Python pickle, so that we can reload this
-        model later. We'll pickle everything required to create a clone of
-        this model given the pickle and the rng/Xd params to the cloning
+        Dump important stuff to a checkpoint file, so that we can reload this
+        model later. We'll save everything required to create a clone of
+        this model given the file and the rng/Xd params to the cloning
         function: "PeaNet.shared_param_clone()".
         """
         assert(not (f_name is None))
-        f_handle = file(f_name, 'wb')
-        # dump the dict self.params, which just holds "simple" python values
-        cPickle.dump(self.params, f_handle, protocol=-1)
-        # make a copy of self.shared_param_dicts, with numpy arrays in place
-        # of the theano shared variables
-        numpy_param_dicts = []
-        for shared_dict in self.shared_param_dicts:
-            numpy_dict = {}
-            for key in shared_dict:
-                numpy_dict[key] = shared_dict[key].get_value(borrow=False)
-            numpy_param_dicts.append(numpy_dict)
-        # dump the numpy version of self.shared_param_dicts
-        cPickle.dump(numpy_param_dicts, f_handle, protocol=-1)
-        f_handle.close()
+        meta = {'params': self.params}
+        write_checkpoint(f_name, meta, {'layers': self.shared_param_dicts})
+        return
+
+    def load_params_from_file(self, f_name=None):
+        """
+        Set this network's parameters to those in a file written by
+        save_to_file.
+        """
+        assert(not (f_name is None))
+        set_params_from_checkpoint(f_name, {'layers': self.shared_param_dicts})
         return
 
 def load_peanet_from_file(f_name=None, rng=None, Xd=None):
@@ -443,17 +443,19 @@ def load_peanet_from_file(f_name=None, rng=None, Xd=None):
     Load a clone of some previously trained model.
     """
     assert(not (f_name is None))
-    pickle_file = open(f_name)
-    self_dot_params = cPickle.load(pickle_file)
-    self_dot_numpy_param_dicts = cPickle.load(pickle_file)
-    self_dot_shared_param_dicts = []
-    for numpy_dict in self_dot_numpy_param_dicts:
-        shared_dict = {}
-        for key in numpy_dict:
-            val = numpy_dict[key].astype(theano.config.floatX)
-            shared_dict[key] = theano.shared(val)
-        self_dot_shared_param_dicts.append(shared_dict)
-    # now, create a PeaNet with the configuration we just unpickled
+    if is_checkpoint_file(f_name):
+        meta, numpy_groups = read_checkpoint(f_name)
+        self_dot_params = meta['params']
+        self_dot_numpy_param_dicts = numpy_groups['layers']
+    else:
+        # files from before the checkpoint format hold two pickles
+        pickle_file = open(f_name)
+        self_dot_params = cPickle.load(pickle_file)
+        self_dot_numpy_param_dicts = cPickle.load(pickle_file)
+        pickle_file.close()
+    self_dot_shared_param_dicts = \
+            shared_param_dicts_from_numpy(self_dot_numpy_param_dicts)
+    # now, create a PeaNet with the configuration we just loaded
     clone_net = PeaNet(rng=rng, Xd=Xd, params=self_dot_params, \
             shared_param_dicts=self_dot_shared_param_dicts)
     return clone_net
@@ -11,8 +11,11 @@ from InfNet import InfNet, load_infnet_from_file
 from GenNet import GenNet, load_gennet_from_file
 from VCGLoop import VCGLoop
 from GIPair import GIPair
+from BatchPrefetcher import BatchPrefetcher
+from Checkpoint import CheckpointManager
 from NetLayers import relu_actfun, softplus_actfun, \
-                      safe_softmax, safe_log
+                      safe_softmax, safe_log, sample_masks, \
+                      sample_patch_masks
 import GenNet as GNet
 import InfNet as INet
 import PeaNet as PNet
@@ -29,34 +32,9 @@ sys.setrecursionlimit(10**6)
 RESULT_PATH = "TFD_WALKOUT_TEST_50D_SMALL/"
 PRIOR_DIM = 50
 
-#####################################
-# HELPER FUNCTIONS FOR DATA MASKING #
-#####################################
-
-def sample_masks(X, drop_prob=0.3):
-    """
-    Sample a binary mask to apply to the matrix X, with rate mask_prob.
-    """
-    probs = npr.rand(*X.shape)
-    mask = 1.0 * (probs > drop_prob)
-    return mask.astype(theano.config.floatX)
-
-def sample_patch_masks(X, im_shape, patch_shape):
-    """
-    Sample a random patch mask for each image in X.
-    """
-    obs_count = X.shape[0]
-    rs = patch_shape[0]
-    cs = patch_shape[1]
-    off_row = npr.randint(1,high=(im_shape[0]-rs-1), size=(obs_count,))
-    off_col = npr.randint(1,high=(im_shape[1]-cs-1), size=(obs_count,))
-    dummy = np.zeros(im_shape)
-    mask = np.zeros(X.shape)
-    for i in range(obs_count):
-        dummy = (0.0 * dummy) + 1.0
-        dummy[off_row[i]:(off_row[i]+rs), off_col[i]:(off_col[i]+cs)] = 0.0
-        mask[i,:] = dummy.ravel()
-    return mask.astype(theano.config.floatX)
+####################
+# HELPER FUNCTIONS #
+####################
 
 def posterior_klds(IN, Xtr, batch_size, batch_count):
     """
@@ -159,6 +137,20 @@ def pretrain_gip(extra_lam_kld=0.0, kld2_scale=0.0):
     GIP = GIPair(rng=rng, Xd=Xd, Xc=Xc, Xm=Xm, g_net=GN, i_net=IN, \
             data_dim=data_dim, prior_dim=PRIOR_DIM, params=None)
     GIP.set_lam_l2w(1e-4)
+    # keep the training set on the device, so updates only ship indices
+    GIP.set_train_data(Xtr)
+
+    # checkpoint the training state in the background, and pick up from the
+    # latest checkpoint if there is one
+    ckpt = CheckpointManager(GIP, RESULT_PATH+"pt_gip_ckpt", keep_last=3)
+    # the writer thread also refreshes the IN/GN files that the later stages
+    # load, from the same snapshots
+    ckpt.add_export(RESULT_PATH+"pt_gip_params_IN.pkl", \
+            *IN.checkpoint_contents())
+    ckpt.add_export(RESULT_PATH+"pt_gip_params_GN.pkl", \
+            *GN.checkpoint_contents())
+    last_step = ckpt.restore()
+    start_i = 110001 if (last_step is None) else (last_step + 1)
 
     ######################
     # BASIC VAE TRAINING #
@@ -167,23 +159,22 @@ def pretrain_gip(extra_lam_kld=0.0, kld2_scale=0.0):
     # Set initial learning rate and basic SGD hyper parameters
     cost_1 = [0. for i in range(10)]
     learn_rate = 0.001
-    for i in range(110001, 500000):
+    if not (last_step is None):
+        learn_rate = ckpt.restored_meta['learn_rate']
+    for i in range(start_i, 500000):
         scale = min(1.0, float(i) / 20000.0)
         if (i > 75000) and ((i + 1) % 50000 == 0):
             learn_rate = learn_rate * 0.5
         # do a minibatch update of the model, and compute some costs
         tr_idx = npr.randint(low=0,high=tr_samples,size=(batch_size,))
-        Xd_batch = Xtr.take(tr_idx, axis=0)
-        Xd_batch = np.repeat(Xd_batch, batch_reps, axis=0)
-        Xc_batch = 0.0 * Xd_batch
-        Xm_batch = 0.0 * Xd_batch
+        tr_idx = tr_idx.astype(np.int32)
         # do a minibatch update of the model, and compute some costs
         GIP.set_all_sgd_params(lr_gn=(scale*learn_rate), \
                 lr_in=(scale*learn_rate), mom_1=0.9, mom_2=0.99)
         #GIP.set_lr(lr=(2.0*scale_1*learn_rate), net='IN')
         GIP.set_lam_nll(1.0)
         GIP.set_lam_kld(1.0 + extra_lam_kld*scale)
-        outputs = GIP.train_joint(Xd_batch, Xc_batch, Xm_batch)
+        outputs = GIP.train_joint_idx(tr_idx, batch_reps)
         cost_1 = [(cost_1[k] + 1.*outputs[k]) for k in range(len(outputs))]
         if ((i % 1000) == 0):
             cost_1 = [(v / 1000.) for v in cost_1]
@@ -239,11 +230,14 @@ def pretrain_gip(extra_lam_kld=0.0, kld2_scale=0.0):
             utils.plot_line(np.arange(obs_post_klds.shape[0]), obs_post_klds, RESULT_PATH+"PPP_OBS_POST_KLDS_b{0:d}.png".format(i))
             utils.plot_stem(np.arange(post_dim_klds.shape[0]), post_dim_klds, RESULT_PATH+"PPP_POST_DIM_KLDS_b{0:d}.png".format(i))
             utils.plot_stem(np.arange(post_dim_vars.shape[0]), post_dim_vars, RESULT_PATH+"PPP_POST_DIM_VARS_b{0:d}.png".format(i))
+        if ((i % 5000) == 0):
+            ckpt.save(i, meta={'learn_rate': learn_rate})
         if ((i % 10000) == 0):
             IN.save_to_file(f_name=RESULT_PATH+"pt_gip_params_b{0:d}_IN.pkl".format(i))
             GN.save_to_file(f_name=RESULT_PATH+"pt_gip_params_b{0:d}_GN.pkl".format(i))
     IN.save_to_file(f_name=RESULT_PATH+"pt_gip_params_IN.pkl")
     GN.save_to_file(f_name=RESULT_PATH+"pt_gip_params_GN.pkl")
+    ckpt.close()
     return
 
 #####################################################
@@ -344,6 +338,21 @@ def train_walk_from_pretrained_gip(extra_lam_kld=0.0):
     ####################################################
     learn_rate = 0.00015
     cost_1 = [0. for i in range(10)]
+    # build minibatches for the loop below in a background thread
+    def make_batch():
+        tr_idx = npr.randint(low=0,high=tr_samples,size=(batch_size,))
+        Xd_batch = Xtr.take(tr_idx, axis=0)
+        Xc_batch = 0.0 * Xd_batch
+        Xm_batch = 0.0 * Xd_batch
+        # do 5 repetitions of the batch
+        Xd_batch = np.repeat(Xd_batch, batch_reps, axis=0)
+        Xc_batch = np.repeat(Xc_batch, batch_reps, axis=0)
+        Xm_batch = np.repeat(Xm_batch, batch_reps, axis=0)
+        # examples from the target distribution, to train discriminator
+        tr_idx = npr.randint(low=0,high=tr_samples,size=(batch_reps*batch_size,))
+        Xt_batch = Xtr.take(tr_idx, axis=0)
+        return [Xd_batch, Xc_batch, Xm_batch, Xt_batch]
+    batches = BatchPrefetcher(make_batch, queue_size=8, worker_count=2)
     for i in range(1000000):
         scale = float(min((i+1), 25000)) / 25000.0
         if ((i+1 % 50000) == 0):
@@ -359,18 +368,8 @@ def train_walk_from_pretrained_gip(extra_lam_kld=0.0):
         VCGL.set_lam_chain_vel(0.0)
         VCGL.set_lam_mask_nll(0.0)
         VCGL.set_lam_mask_kld(0.0)
-        # get some data to train with
-        tr_idx = npr.randint(low=0,high=tr_samples,size=(batch_size,))
-        Xd_batch = Xtr.take(tr_idx, axis=0)
-        Xc_batch = 0.0 * Xd_batch
-        Xm_batch = 0.0 * Xd_batch
-        # do 5 repetitions of the batch
-        Xd_batch = np.repeat(Xd_batch, batch_reps, axis=0)
-        Xc_batch = np.repeat(Xc_batch, batch_reps, axis=0)
-        Xm_batch = np.repeat(Xm_batch, batch_reps, axis=0)
-        # examples from the target distribution, to train discriminator
-        tr_idx = npr.randint(low=0,high=tr_samples,size=(batch_reps*batch_size,))
-        Xt_batch = Xtr.take(tr_idx, axis=0)
+        # get some data to train with (built in the background)
+        Xd_batch, Xc_batch, Xm_batch, Xt_batch = batches.next()
         # do a minibatch update of the model, and compute some costs
         outputs = VCGL.train_joint(Xd_batch, Xc_batch, Xm_batch, Xt_batch)
         cost_1 = [(cost_1[k] + 1.*outputs[k]) for k in range(len(outputs))]
@@ -430,6 +429,7 @@ def train_walk_from_pretrained_gip(extra_lam_kld=0.0):
             DN.save_to_file(f_name=RESULT_PATH+"pt_walk_params_b{0:d}_DN.pkl".format(i))
             IN.save_to_file(f_name=RESULT_PATH+"pt_walk_params_b{0:d}_IN.pkl".format(i))
             GN.save_to_file(f_name=RESULT_PATH+"pt_walk_params_b{0:d}_GN.pkl".format(i))
+    batches.close()
     return
 
 
@@ -527,6 +527,23 @@ def train_recon_from_pretrained_gip(extra_lam_kld=0.0):
     ####################################################
     learn_rate = 0.00015
     cost_2 = [0. for i in range(10)]
+    # build minibatches for the loop below in a background thread
+    def make_batch():
+        tr_idx = npr.randint(low=0,high=tr_samples,size=(batch_size,))
+        Xd_batch = Xc_mean
+        Xc_batch = Xtr.take(tr_idx, axis=0)
+        Xm_rand = sample_masks(Xc_batch, drop_prob=0.0)
+        Xm_patch = sample_patch_masks(Xc_batch, (48,48), (25,25))
+        Xm_batch = Xm_rand * Xm_patch
+        tr_idx = npr.randint(low=0,high=tr_samples,size=(batch_size,))
+        Xt_batch = Xtr.take(tr_idx, axis=0)
+        # do multiple repetitions of the batch
+        Xd_batch = np.repeat(Xd_batch, batch_reps, axis=0)
+        Xc_batch = np.repeat(Xc_batch, batch_reps, axis=0)
+        Xm_batch = np.repeat(Xm_batch, batch_reps, axis=0)
+        Xt_batch = np.repeat(Xt_batch, batch_reps, axis=0)
+        return [Xd_batch, Xc_batch, Xm_batch, Xt_batch]
+    batches = BatchPrefetcher(make_batch, queue_size=8, worker_count=2)
     for i in range(1000000):
         scale = float(min((i+1), 25000)) / 25000.0
         if ((i+1 % 50000) == 0):
@@ -542,20 +559,8 @@ def train_recon_from_pretrained_gip(extra_lam_kld=0.0):
         VCGL.set_lam_chain_vel(0.0)
         VCGL.set_lam_mask_nll(1.0)
         VCGL.set_lam_mask_kld(1.0 + extra_lam_kld)
-        # get some data to train with
-        tr_idx = npr.randint(low=0,high=tr_samples,size=(batch_size,))
-        Xd_batch = Xc_mean
-        Xc_batch = Xtr.take(tr_idx, axis=0)
-        Xm_rand = sample_masks(Xc_batch, drop_prob=0.0)
-        Xm_patch = sample_patch_masks(Xc_batch, (48,48), (25,25))
-        Xm_batch = Xm_rand * Xm_patch
-        tr_idx = npr.randint(low=0,high=tr_samples,size=(batch_size,))
-        Xt_batch = Xtr.take(tr_idx, axis=0)
-        # do multiple repetitions of the batch
-        Xd_batch = np.repeat(Xd_batch, batch_reps, axis=0)
-        Xc_batch = np.repeat(Xc_batch, batch_reps, axis=0)
-        Xm_batch = np.repeat(Xm_batch, batch_reps, axis=0)
-        Xt_batch = np.repeat(Xt_batch, batch_reps, axis=0)
+        # get some data to train with (built in the background)
+        Xd_batch, Xc_batch, Xm_batch, Xt_batch = batches.next()
         # do a minibatch update of the model, and compute some costs
         outputs = VCGL.train_joint(Xd_batch, Xc_batch, Xm_batch, Xt_batch)
         if ((i % 2) == 0):
@@ -623,6 +628,7 @@ def train_recon_from_pretrained_gip(extra_lam_kld=0.0):
             DN.save_to_file(f_name=RESULT_PATH+"pt_recon_params_b{0:d}_DN.pkl".format(i))
             IN.save_to_file(f_name=RESULT_PATH+"pt_recon_params_b{0:d}_IN.pkl".format(i))
             GN.save_to_file(f_name=RESULT_PATH+"pt_recon_params_b{0:d}_GN.pkl".format(i))
+    batches.close()
     return
 
 if __name__=="__main__":
@@ -20,7 +20,9 @@ from GenNet import GenNet
 from InfNet import InfNet
 from PeaNet import PeaNet
 from DKCode import get_adam_updates, get_adadelta_updates
-from LogPDFs import log_prob_bernoulli, log_prob_gaussian2, gaussian_kld
+from FuncCache import cached_function, LazyFunction
+from LogPDFs import log_prob_bernoulli, log_prob_gaussian, log_prob_gaussian2, \
+                    gaussian_kld, multi_sample_stats, make_fe_estimator
 
 
 #
@@ -54,6 +56,14 @@ class TwoStageModel(object):
                 x_type: can be "bernoulli" or "gaussian"
                 xt_type: can be "latent" or "observed"
     """
+    # compiled functions, built on first access
+    train_joint = LazyFunction('train_joint')
+    train_joint_idx = LazyFunction('train_joint_idx')
+    compute_costs = LazyFunction('compute_costs')
+    compute_post_klds = LazyFunction('compute_post_klds')
+    compute_fe_terms = LazyFunction('compute_fe_terms')
+    sample_from_prior = LazyFunction('sample_from_prior')
+
     def __init__(self, rng=None, \
             Xd=None, Xc=None, Xm=None, \
             p_xt_given_z=None, p_zt_given_xt=None, p_x_given_xt_zt=None, \
@@ -68,6 +78,16 @@ class TwoStageModel(object):
             self.params = {}
         else:
             self.params = params
+        # directory for caching compiled theano functions (None to disable)
+        if 'func_cache_dir' in self.params:
+            self.func_cache_dir = self.params['func_cache_dir']
+        else:
+            self.func_cache_dir = None
+        # optional FuncProfiler for timing compiled functions (None to disable)
+        if 'func_profiler' in self.params:
+            self.func_profiler = self.params['func_profiler']
+        else:
+            self.func_profiler = None
         self.x_type = self.params['x_type']
         self.xt_type = self.params['xt_type']
         #
@@ -115,6 +135,9 @@ class TwoStageModel(object):
         # self.output_bias/self.output_logvar modify the output distribution
         self.output_bias = theano.shared(value=zero_row, name='tsm_output_bias')
         self.output_logvar = theano.shared(value=zero_ary, name='tsm_output_logvar')
+        # self.X_train holds a device-resident training set
+        zero_mat = np.zeros((1, self.x_dim)).astype(theano.config.floatX)
+        self.X_train = theano.shared(value=zero_mat, name='tsm_X_train')
 
         #####################################################################
         # Setup the computation graph that provides values in our objective #
@@ -262,12 +285,8 @@ class TwoStageModel(object):
         for k in self.group_2_updates:
             self.joint_updates[k] = self.group_2_updates[k]
 
-        # Construct a function for jointly training the generator/inferencer
-        self.train_joint = self._construct_train_joint()
-        self.compute_costs = self._construct_compute_costs()
-        self.compute_post_klds = self._construct_compute_post_klds()
-        self.compute_fe_terms = self._construct_compute_fe_terms()
-        self.sample_from_prior = self._construct_sample_from_prior()
+        # Functions for training/evaluation are compiled on first use. See
+        # the LazyFunction attributes of this class.
         # make easy access points for some interesting parameters
         self.inf_1_weights = self.q_z_given_x.shared_layers[0].W
         self.gen_1_weights = self.p_xt_given_z.mu_layers[-1].W
@@ -322,6 +341,13 @@ class TwoStageModel(object):
         self.lam_l2w.set_value(new_lam.astype(theano.config.floatX))
         return
 
+    def set_train_data(self, X):
+        """
+        Set the training set from which train_joint_idx takes minibatches.
+        """
+        self.X_train.set_value(X.astype(theano.config.floatX))
+        return
+
     def set_train_switch(self, switch_val=0.0):
         """
         Set the switch for changing between training and sampling behavior.
@@ -391,8 +417,10 @@ class TwoStageModel(object):
         """
         # setup some symbolic variables for theano to deal with
         Xd = T.matrix()
-        Xc = T.zeros_like(Xd)
-        Xm = T.zeros_like(Xd)
+        sample_reps = T.lscalar()
+        Xr = Xd.repeat(sample_reps, axis=0)
+        Xc = T.zeros_like(Xr)
+        Xm = T.zeros_like(Xr)
         # construct values to output
         if self.x_type == 'bernoulli':
             ll_term = log_prob_bernoulli(self.x, self.xg)
@@ -405,23 +433,28 @@ class TwoStageModel(object):
                 self.q_z_given_x.output_logvar, \
                 prior_mean, prior_logvar)
         kld_term = T.sum(all_klds, axis=1)
-        # compile theano function for a one-sample free-energy estimate
-        fe_term_sample = theano.function(inputs=[Xd], \
-                outputs=[ll_term, kld_term], \
-                givens={self.Xd: Xd, self.Xc: Xc, self.Xm: Xm})
+        # construct log importance weights for the sampled latent variables.
+        # zt only contributes when it was sampled from q_zt_given_x_xt.
+        log_p_z = log_prob_gaussian2(self.z, T.zeros_like(self.z) + \
+                prior_mean, log_vars=prior_logvar)
+        log_q_z = log_prob_gaussian(self.z, self.q_z_given_x.output_mean, \
+                les_sigmas=self.q_z_given_x.output_sigma)
+        log_p_zt = log_prob_gaussian2(self.zt, self.p_zt_given_xt.output_mean, \
+                log_vars=self.p_zt_given_xt.output_logvar)
+        log_q_zt = log_prob_gaussian(self.zt, self.q_zt_given_x_xt.output_mean, \
+                les_sigmas=self.q_zt_given_x_xt.output_sigma)
+        log_weights = ll_term + log_p_z - log_q_z + \
+                (self.train_switch[0] * (log_p_zt - log_q_zt))
+        # compile theano function for a multi-sample free-energy estimate
+        outputs = multi_sample_stats(ll_term, kld_term, log_weights, \
+                sample_reps)
+        fe_term_sample = cached_function(inputs=[Xd, sample_reps], \
+                outputs=outputs, \
+                givens={self.Xd: Xr, self.Xc: Xc, self.Xm: Xm}, \
+                cache_dir=self.func_cache_dir)
         # construct a wrapper function for multi-sample free-energy estimate
-        def fe_term_estimator(X, sample_count):
-            ll_sum = np.zeros((X.shape[0],))
-            kld_sum = np.zeros((X.shape[0],))
-            for i in range(sample_count):
-                result = fe_term_sample(X)
-                ll_sum = ll_sum + result[0].ravel()
-                kld_sum = kld_sum + result[1].ravel()
-            mean_nll = -ll_sum / float(sample_count)
-            mean_kld = kld_sum / float(sample_count)
-            return [mean_nll, mean_kld]
+        fe_term_estimator = make_fe_estimator(fe_term_sample)
         return fe_term_estimator
-        return multi_sample_bound
 
     def _construct_nll_cost(self):
         """
@@ -494,12 +527,32 @@ class TwoStageModel(object):
         outputs = [self.joint_cost, self.nll_cost, self.kld_cost_1, \
                 self.kld_cost_2, self.kld_cost, self.reg_cost]
         # compile the theano function
-        func = theano.function(inputs=[ Xd, Xc, Xm, self.batch_reps ], \
+        func = cached_function(inputs=[ Xd, Xc, Xm, self.batch_reps ], \
                 outputs=outputs, \
                 givens={ self.Xd: Xd.repeat(self.batch_reps, axis=0), \
                          self.Xc: Xc.repeat(self.batch_reps, axis=0), \
                          self.Xm: Xm.repeat(self.batch_reps, axis=0) }, \
-                updates=self.joint_updates)
+                updates=self.joint_updates, \
+                cache_dir=self.func_cache_dir)
+        return func
+
+    def _construct_train_joint_idx(self):
+        """
+        Construct theano function to train all networks jointly, using the
+        rows of self.X_train given by an index vector. Each row is repeated
+        batch_reps times, and Xc/Xm are set to zero, in the graph.
+        """
+        idx = T.ivector()
+        Xb = self.X_train[idx].repeat(self.batch_reps, axis=0)
+        outputs = [self.joint_cost, self.nll_cost, self.kld_cost_1, \
+                self.kld_cost_2, self.kld_cost, self.reg_cost]
+        func = cached_function(inputs=[ idx, self.batch_reps ], \
+                outputs=outputs, \
+                givens={ self.Xd: Xb, \
+                         self.Xc: T.zeros_like(Xb), \
+                         self.Xm: T.zeros_like(Xb) }, \
+                updates=self.joint_updates, \
+                cache_dir=self.func_cache_dir)
         return func
 
     def _construct_compute_costs(self):
@@ -509,8 +562,9 @@ class TwoStageModel(object):
         """
         outputs = [self.joint_cost, self.nll_cost, self.kld_cost_1, \
                 self.kld_cost_2, self.reg_cost]
-        func = theano.function(inputs=[ self.Xd, self.Xc, self.Xm ], \
-                outputs=outputs)
+        func = cached_function(inputs=[ self.Xd, self.Xc, self.Xm ], \
+                outputs=outputs, \
+                cache_dir=self.func_cache_dir)
         return func
 
     def _construct_compute_post_klds(self):
@@ -534,8 +588,9 @@ class TwoStageModel(object):
                 self.p_zt_given_xt.output_logvar, 0.0, 0.0)
         all_klds = [kld_z, kld_zt_cond, kld_zt_glob]
         # compile theano function for a one-sample free-energy estimate
-        kld_func = theano.function(inputs=[Xd], outputs=all_klds, \
-                givens={self.Xd: Xd, self.Xc: Xc, self.Xm: Xm})
+        kld_func = cached_function(inputs=[Xd], outputs=all_klds, \
+                givens={self.Xd: Xd, self.Xc: Xc, self.Xm: Xm}, \
+                cache_dir=self.func_cache_dir)
         return kld_func
 
     def _construct_sample_from_prior(self):
@@ -546,11 +601,12 @@ class TwoStageModel(object):
         z_sym = T.matrix()
         x_sym = T.matrix()
         oputs = [self.xg, self.xg_xt]
-        sample_func = theano.function(inputs=[z_sym, x_sym], outputs=oputs, \
+        sample_func = cached_function(inputs=[z_sym, x_sym], outputs=oputs, \
                 givens={ self.z: z_sym, \
                         self.Xd: T.zeros_like(x_sym), \
                         self.Xc: T.zeros_like(x_sym), \
-                        self.Xm: T.zeros_like(x_sym) })
+                        self.Xm: T.zeros_like(x_sym) }, \
+                cache_dir=self.func_cache_dir)
         def prior_sampler(samp_count):
             z_samps = npr.randn(samp_count, self.z_dim)
             z_samps = (np.exp(0.5 * self.z_prior_logvar) * z_samps) + \
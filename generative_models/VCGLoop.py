@@ -17,9 +17,11 @@ from theano.sandbox.cuda.rng_curand import CURAND_RandomStreams as RandStream
 
 # phil's sweetness
 from NetLayers import HiddenLayer, DiscLayer, safe_log, softplus_actfun, \
-                      apply_mask
+                      apply_mask, sample_masks, sample_patch_masks
 from DKCode import get_adam_updates, get_adadelta_updates
 from GIPair import GIPair
+from FuncCache import cached_function
+from FuncProfiler import profiled_build
 
 #################
 # FOR PROFILING #
@@ -124,31 +126,6 @@ def binarize_data(X):
     X_binary = 1.0 * (probs < X)
     return X_binary.astype(theano.config.floatX)
 
-def sample_masks(X, drop_prob=0.3):
-    """
-    Sample a binary mask to apply to the matrix X, with rate mask_prob.
-    """
-    probs = npr.rand(*X.shape)
-    mask = 1.0 * (probs > drop_prob)
-    return mask.astype(theano.config.floatX)
-
-def sample_patch_masks(X, im_shape, patch_shape):
-    """
-    Sample a random patch mask for each image in X.
-    """
-    obs_count = X.shape[0]
-    rs = patch_shape[0]
-    cs = patch_shape[1]
-    off_row = npr.randint(1,high=(im_shape[0]-rs-1), size=(obs_count,))
-    off_col = npr.randint(1,high=(im_shape[1]-cs-1), size=(obs_count,))
-    dummy = np.zeros(im_shape)
-    mask = np.zeros(X.shape)
-    for i in range(obs_count):
-        dummy = (0.0 * dummy) + 1.0
-        dummy[off_row[i]:(off_row[i]+rs), off_col[i]:(off_col[i]+cs)] = 0.0
-        mask[i,:] = dummy.ravel()
-    return mask.astype(theano.config.floatX)
-
 class VCGLoop(object):
     """
     Controller for training a self-looping VAE using guidance provided by a
@@ -200,6 +177,16 @@ class VCGLoop(object):
             self.chain_type = params['chain_type']
         else:
             self.chain_type = 'walkout'
+        # directory for caching compiled theano functions (None to disable)
+        if 'func_cache_dir' in self.params:
+            self.func_cache_dir = self.params['func_cache_dir']
+        else:
+            self.func_cache_dir = None
+        # optional FuncProfiler for timing compiled functions (None to disable)
+        if 'func_profiler' in self.params:
+            self.func_profiler = self.params['func_profiler']
+        else:
+            self.func_profiler = None
 
         # symbolic var for inputting samples for initializing the VAE chain
         self.Xd = Xd
@@ -219,7 +206,10 @@ class VCGLoop(object):
         # get a clone of the desired VAE, for easy access
         self.GIP = GIPair(rng=rng, Xd=self.Xd, Xc=self.Xc, Xm=self.Xm, \
                 g_net=g_net, i_net=i_net, data_dim=self.data_dim, \
-                prior_dim=self.prior_dim, params=None, shared_param_dicts=None)
+                prior_dim=self.prior_dim, \
+                params={'func_cache_dir': self.func_cache_dir, \
+                        'func_profiler': self.func_profiler}, \
+                shared_param_dicts=None)
         self.IN = self.GIP.IN
         self.GN = self.GIP.GN
         self.kld2_scale = self.IN.kld2_scale
@@ -412,7 +402,8 @@ class VCGLoop(object):
         self.joint_updates[self.IN.kld_mean] = T.cast(new_kld_mean, 'floatX')
 
         # construct the function for training on training data
-        self.train_joint = self._construct_train_joint()
+        self.train_joint = profiled_build(self.func_profiler, \
+                'VCGLoop.train_joint', self._construct_train_joint)
         return
 
     def set_dn_sgd_params(self, learn_rate=0.01):
@@ -722,19 +713,24 @@ class VCGLoop(object):
         outputs = [self.joint_cost, self.chain_nll_cost, self.chain_kld_cost, \
                 self.chain_vel_cost, self.mask_nll_cost, self.mask_kld_cost, \
                 self.disc_cost_gn, self.disc_cost_dn, self.other_reg_cost]
-        func = theano.function(inputs=[ self.Xd, self.Xc, self.Xm, self.Xt ], \
-                outputs=outputs, updates=self.joint_updates) # , \
+        func = cached_function(inputs=[ self.Xd, self.Xc, self.Xm, self.Xt ], \
+                outputs=outputs, updates=self.joint_updates, \
+                cache_dir=self.func_cache_dir) # , \
                 #mode=profmode)
         return func
 
     def sample_from_chain(self, X_d, X_c=None, X_m=None, loop_iters=5, \
-            sigma_scale=None):
+            sigma_scale=None, record_every=1, data_out=None, prior_out=None, \
+            chunk_size=50, stats_only=False):
         """
         Sample for several rounds through the I<->G loop, initialized with the
-        the "data variable" samples in X_d.
+        the "data variable" samples in X_d. See GIPair.sample_from_chain.
         """
         result = self.GIP.sample_from_chain(X_d, X_c=X_c, X_m=X_m, \
-                loop_iters=loop_iters, sigma_scale=sigma_scale)
+                loop_iters=loop_iters, sigma_scale=sigma_scale, \
+                record_every=record_every, data_out=data_out, \
+                prior_out=prior_out, chunk_size=chunk_size, \
+                stats_only=stats_only)
         return result
 
     def sample_from_prior(self, samp_count, sigma=None):
@@ -1,43 +1,60 @@
+import struct
 import subprocess
 import threading
 from os import path,remove,devnull
 from sys import stdin,stdout
 import numpy as np
  
+# number of channels for the colorspaces supported by VideoSink/FrameStore
+COLORSPACE_CHANNELS = {'y8': 1, 'y800': 1, 'rgb24': 3, 'bgr24': 3}
+
+def _chunk(fourcc, data):
+        """
+        Wrap data in a RIFF chunk with the given four-character code.
+        """
+        return fourcc + struct.pack('<I', len(data)) + data
+
+def _list_chunk(list_type, data):
+        """
+        Wrap data in a RIFF LIST chunk with the given list type.
+        """
+        return b'LIST' + struct.pack('<I', len(data) + 4) + list_type + data
+
 class VideoSink(object) :
         """
-        VideoSink: write numpy array to a movie file
+        VideoSink: write numpy arrays to an uncompressed .avi file
         ------------------------------------------------------------------------
- 
-        Requires mencoder:
-        <http://www.mplayerhq.hu/design7/dload.html>
- 
+
+        Pure python/numpy, so it doesn't need mencoder (or anything else).
+        Frames are stored as uncompressed DIBs: 8-bit grayscale with a gray
+        palette for 'y8', or 24-bit color for 'rgb24'/'bgr24'. Each frame is
+        copied once, into a preallocated buffer in the DIB layout (bottom-up
+        rows, BGR order, rows padded to 4 bytes), which gets written straight
+        to the file. Plain AVI files are limited to 4GB, so very long movies
+        should be split over several files.
+
         Parameters:
         ----------------
         filename        string  The path/name of the output file
- 
+
         size            tuple   The row/column dimensions of the output movie
- 
+
         rate            scalar  The framerate (fps)
- 
+
         colorspace      string  The color space of the output frames, 8-bit RGB
-                                by default ('$ mencoder -vf format=fmt=help'
-                                for a list of valid color spaces)
- 
-        codec           string  The codec to use, libavcodecs by default
-                                ('$ mencoder -ovc -h' for a list of valid codecs)
- 
+                                by default ('y8' for 8-bit grayscale)
+
         Methods:
         ----------------
         VideoSink(array)        Write the input array to the specified .avi file
                                 - must be in the form [rows,columns,(channels)],
                                 and (rows,colums) must match the 'size'
                                 specified when initialising the VideoSink.
- 
+
         VideoSink.close()       Close the .avi file. The file *must* be closed
                                 after writing, or the header information isn't
                                 written correctly
- 
+
         Example useage:
         ----------------
         frames = np.random.random_integers(0,255,size=50,100,200,3).astype('uint8')
@@ -45,37 +62,172 @@ class VideoSink(object) :
         for frame in frames:
                 vsnk(frame)
         vsnk.close()
- 
-        Alistair Muldal, Aug 2012
- 
-        Credit to VokkiCodder for this idea
-        <http://vokicodder.blogspot.co.uk/2011/02/numpy-arrays-to-video.html>
- 
         """
-        def __init__( self, filename='output.avi', size=(512,512), rate=25, colorspace='rgb24',codec='lavc'):
- 
+        def __init__( self, filename='output.avi', size=(512,512), rate=25, colorspace='rgb24'):
+                if not (colorspace in COLORSPACE_CHANNELS):
+                        raise ValueError('Unsupported colorspace "%s"' %colorspace)
                 # row/col --> x/y by swapping order
                 self.size = size[::-1]
- 
-                cmdstring  = (  'mencoder',
-                                '/dev/stdin',
-                                '-demuxer', 'rawvideo',
-                                '-rawvideo', 'w=%i:h=%i'%self.size+':fps=%i:format=%s'%(rate,colorspace),
-                                '-o', filename,
-                                '-ovc', codec,
-                                '-nosound',
-                                '-really-quiet'
-                                )
-                self.p = subprocess.Popen(cmdstring, stdin=subprocess.PIPE, shell=False)
- 
+                self.rows, self.cols = size
+                self.channels = COLORSPACE_CHANNELS[colorspace]
+                self.rate = int(rate)
+                self.frame_count = 0
+                # DIB rows are padded to a multiple of 4 bytes
+                self.row_bytes = ((self.cols * self.channels + 3) // 4) * 4
+                self.frame_bytes = self.row_bytes * self.rows
+                # preallocated frame buffer, and a view of it in which pixels
+                # are indexed top-down and in RGB order
+                self._buf = np.zeros((self.rows, self.row_bytes), dtype=np.uint8)
+                self._pix = self._buf[::-1,0:(self.cols*self.channels)].reshape( \
+                                (self.rows, self.cols, self.channels))
+                if colorspace == 'rgb24':
+                        self._pix = self._pix[:,:,::-1]
+                # frame chunk header, reused for every frame
+                self._frame_head = np.fromstring(b'00db' + \
+                                struct.pack('<I', self.frame_bytes), dtype=np.uint8)
+                # write a placeholder header, which close() fills in
+                self._f = open(filename, 'wb')
+                self._f.write(self._header())
+
+        def _header(self):
+                """
+                Build the AVI header for the frames written so far.
+                """
+                avih = struct.pack('<14I', 1000000 // max(self.rate, 1), \
+                                self.frame_bytes * self.rate, 0, 0x10, \
+                                self.frame_count, 0, 1, self.frame_bytes, \
+                                self.cols, self.rows, 0, 0, 0, 0)
+                strh = struct.pack('<4s4sIHH8I4h', b'vids', b'DIB ', 0, 0, 0, \
+                                0, 1, self.rate, 0, self.frame_count, \
+                                self.frame_bytes, 0xFFFFFFFF, 0, \
+                                0, 0, self.cols, self.rows)
+                color_count = 256 if (self.channels == 1) else 0
+                strf = struct.pack('<IiiHHIIiiII', 40, self.cols, self.rows, 1, \
+                                8 * self.channels, 0, self.frame_bytes, 0, 0, \
+                                color_count, 0)
+                if self.channels == 1:
+                        # gray palette, as (B,G,R,0) quads
+                        palette = np.zeros((256, 4), dtype=np.uint8)
+                        palette[:,0:3] = np.arange(256)[:,np.newaxis]
+                        strf = strf + palette.tostring()
+                strl = _list_chunk(b'strl', _chunk(b'strh', strh) + \
+                                _chunk(b'strf', strf))
+                hdrl = _list_chunk(b'hdrl', _chunk(b'avih', avih) + strl)
+                movi_size = 4 + self.frame_count * (8 + self.frame_bytes)
+                riff_size = 4 + len(hdrl) + 8 + movi_size + \
+                                8 + (16 * self.frame_count)
+                return b'RIFF' + struct.pack('<I', riff_size) + b'AVI ' + \
+                                hdrl + b'LIST' + struct.pack('<I', movi_size) + b'movi'
+
         def __call__(self, frame) :
                 assert frame.shape[0:2][::-1] == self.size
-                # frame.tofile(self.p.stdin) # should be faster but it is indeed slower
-                self.p.stdin.write(frame.tostring())
+                if (self.frame_count + 1) * (self.frame_bytes + 24) >= 2**32 - 2**20:
+                        raise ValueError('Too many frames for a plain .avi file')
+                self._pix[...] = frame.reshape((self.rows, self.cols, self.channels))
+                self._frame_head.tofile(self._f)
+                self._buf.tofile(self._f)
+                self.frame_count += 1
+
         def close(self) :
-                self.p.stdin.close()
-                self.p.terminate()
- 
+                # write the index, then fill in the header
+                index = np.zeros((self.frame_count, 4), dtype='<u4')
+                index[:,0] = struct.unpack('<I', b'00db')[0]
+                index[:,1] = 0x10
+                index[:,2] = 4 + (8 + self.frame_bytes) * np.arange(self.frame_count)
+                index[:,3] = self.frame_bytes
+                self._f.write(b'idx1' + struct.pack('<I', index.nbytes))
+                index.tofile(self._f)
+                self._f.seek(0)
+                self._f.write(self._header())
+                self._f.close()
+
+class FrameStore(object) :
+        """
+        FrameStore: write numpy arrays to a .npy file of frames
+        ------------------------------------------------------------------------
+
+        Frames are appended to a uint8 array with shape
+        (frames, rows, columns, channels), whose .npy header gets its final
+        frame count when the store is closed. The result can be read back
+        with np.load(filename, mmap_mode='r'), without decoding anything.
+
+        Parameters:
+        ----------------
+        filename        string  The path/name of the output file
+
+        size            tuple   The row/column dimensions of the frames
+
+        colorspace      string  The color space of the frames, which just
+                                determines the number of channels
+        """
+        # fixed header size, so the header can be rewritten in place
+        HEADER_LEN = 128
+
+        def __init__( self, filename='frames.npy', size=(512,512), colorspace='y8'):
+                if not (colorspace in COLORSPACE_CHANNELS):
+                        raise ValueError('Unsupported colorspace "%s"' %colorspace)
+                self.frame_shape = (int(size[0]), int(size[1]), \
+                                COLORSPACE_CHANNELS[colorspace])
+                self.frame_count = 0
+                self._buf = np.zeros(self.frame_shape, dtype=np.uint8)
+                self._f = open(filename, 'wb')
+                self._f.write(self._header())
+
+        def _header(self):
+                """
+                Build the .npy header for the frames written so far.
+                """
+                shape = (int(self.frame_count),) + self.frame_shape
+                hdict = "{'descr': '|u1', 'fortran_order': False, 'shape': %s, }" %repr(shape)
+                hdict = hdict.ljust(self.HEADER_LEN - 11) + '\n'
+                return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(hdict)) + \
+                                hdict.encode('latin1')
+
+        def __call__(self, frame) :
+                frame = frame.reshape(self.frame_shape)
+                if (frame.dtype == np.uint8) and frame.flags['C_CONTIGUOUS']:
+                        frame.tofile(self._f)
+                else:
+                        self._buf[...] = frame
+                        self._buf.tofile(self._f)
+                self.frame_count += 1
+
+        def close(self) :
+                self._f.seek(0)
+                self._f.write(self._header())
+                self._f.close()
+
+def write_chain_video(sample_lists, filename, img_shape, tile_shape=None, \
+                      rate=10, tile_spacing=(1,1)):
+        """
+        Write a video in which frame i shows the tiled samples from step i of
+        a set of chains. sample_lists is a list with one (chain_count, obs_dim)
+        array of [0...1] samples per step, like the "data samples" returned by
+        GIPair.sample_from_chain(). Filenames ending in .npy get a FrameStore
+        rather than a VideoSink.
+        """
+        from utils import tile_raster_images
+        chain_count = sample_lists[0].shape[0]
+        if tile_shape is None:
+                tile_cols = int(np.ceil(np.sqrt(chain_count)))
+                tile_rows = int(np.ceil(chain_count / float(tile_cols)))
+                tile_shape = (tile_rows, tile_cols)
+        frame = tile_raster_images(sample_lists[0], img_shape=img_shape, \
+                        tile_shape=tile_shape, tile_spacing=tile_spacing, \
+                        scale=False, output_pixel_vals=True)
+        if filename.endswith('.npy'):
+                vsnk = FrameStore(filename, size=frame.shape, colorspace='y8')
+        else:
+                vsnk = VideoSink(filename, size=frame.shape, rate=rate, colorspace='y8')
+        for Xs in sample_lists:
+                # tile each step into the same frame buffer
+                frame = tile_raster_images(Xs, img_shape=img_shape, \
+                                tile_shape=tile_shape, tile_spacing=tile_spacing, \
+                                scale=False, output_pixel_vals=True, out=frame)
+                vsnk(frame)
+        vsnk.close()
+        return
+
 class VideoSource(object):
         """
         VideoSource: create numpy arrays from frames in a movie file
@@ -347,4 +499,10 @@ if __name__ == "__main__":
         vsnk = VideoSink('test_gray.avi',size=frames.shape[1:3],colorspace='y8')
         for frame in frames:
                 vsnk(frame)
-        vsnk.close()
\ No newline at end of file
+        vsnk.close()
+        # test frame store...
+        fstore = FrameStore('test_gray.npy',size=frames.shape[1:3],colorspace='y8')
+        for frame in frames:
+                fstore(frame)
+        fstore.close()
+        assert np.all(np.load('test_gray.npy',mmap_mode='r') == frames)
\ No newline at end of file
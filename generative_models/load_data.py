@@ -4,6 +4,10 @@ import cPickle
 import gzip
 import os
 import sys
+import json
+import hashlib
+import shutil
+import tempfile
 
 import theano
 import theano.tensor as T
@@ -28,6 +32,125 @@ def _shared_dataset(data_xy):
     # (``shared_y`` does exactly that).
     return shared_x, shared_y
 
+###############################################
+# CACHE DATASETS AS MEMORY-MAPPABLE NPY FILES #
+###############################################
+
+# root dir for dataset caches, if they shouldn't go next to the source files
+# (e.g. when the data dir is read-only). cache_root args override this.
+CACHE_ROOT = os.environ.get('GM_DATA_CACHE', '')
+
+def _default_cache_dir(src_file, cache_root=None):
+    """
+    Get the directory for cached arrays derived from the file src_file. This
+    is next to src_file, unless a cache_root (or GM_DATA_CACHE) is given.
+    """
+    if cache_root is None:
+        cache_root = CACHE_ROOT
+    if cache_root == '':
+        return src_file + ".npcache"
+    # tag the name with the source path, so same-named files don't collide
+    src_path = os.path.abspath(src_file)
+    src_tag = hashlib.md5(src_path).hexdigest()[0:8]
+    return os.path.join(cache_root, "{0:s}.{1:s}.npcache".format( \
+            os.path.basename(src_path), src_tag))
+
+def _source_info(src_files):
+    """
+    Describe the source files for a cache, so it can be checked for staleness.
+    """
+    info = {}
+    for f_name in src_files:
+        f_stat = os.stat(f_name)
+        info[os.path.abspath(f_name)] = [f_stat.st_size, int(f_stat.st_mtime)]
+    return info
+
+def write_array_cache(cache_dir, arrays, src_files=None):
+    """
+    Write the arrays in the dict arrays to cache_dir, as one .npy file per
+    array plus a JSON manifest describing them and the files they came from.
+    The cache is built in a temp dir and renamed into place, so concurrent
+    readers never see a partial cache.
+    """
+    if src_files is None:
+        src_files = []
+    parent_dir = os.path.dirname(os.path.abspath(cache_dir))
+    if not os.path.isdir(parent_dir):
+        os.makedirs(parent_dir)
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir, suffix='.tmp')
+    try:
+        # mkdtemp makes dirs that only their owner can read, unlike mkdir
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_dir, (0o777 & ~umask))
+        manifest = {'version': 1, 'sources': _source_info(src_files), \
+                    'arrays': {}}
+        for (name, ary) in arrays.items():
+            ary = np.ascontiguousarray(ary)
+            f_name = "{0:s}.npy".format(name)
+            np.save(os.path.join(tmp_dir, f_name), ary)
+            manifest['arrays'][name] = {'file': f_name, \
+                    'shape': list(ary.shape), 'dtype': str(ary.dtype)}
+        f_handle = open(os.path.join(tmp_dir, 'manifest.json'), 'w')
+        json.dump(manifest, f_handle, indent=1, sort_keys=True)
+        f_handle.close()
+    except:
+        # don't leave partial caches lying around (e.g. on a full disk)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        # someone else wrote the cache first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return
+
+def read_array_cache(cache_dir, src_files=None, mmap_mode='r'):
+    """
+    Load the arrays cached in cache_dir, memory-mapped with mmap_mode. This
+    returns None if there's no cache, or if it's stale w.r.t. src_files.
+    """
+    man_file = os.path.join(cache_dir, 'manifest.json')
+    if not os.path.isfile(man_file):
+        return None
+    f_handle = open(man_file, 'r')
+    manifest = json.load(f_handle)
+    f_handle.close()
+    if not (src_files is None):
+        if manifest['sources'] != _source_info(src_files):
+            return None
+    arrays = {}
+    for (name, info) in manifest['arrays'].items():
+        f_name = os.path.join(cache_dir, info['file'])
+        arrays[str(name)] = np.load(f_name, mmap_mode=mmap_mode)
+    return arrays
+
+def cached_arrays(src_files, build_arrays, cache_dir=None, mmap_mode='r', \
+                  cache_root=None):
+    """
+    Get the arrays built from src_files by build_arrays(), through a cache
+    of memory-mapped .npy files. The first call builds and writes the cache,
+    and later calls just map the files. If the cache can't be written (or
+    read back), this just returns the arrays from build_arrays().
+    """
+    if cache_dir is None:
+        cache_dir = _default_cache_dir(src_files[0], cache_root)
+    arrays = read_array_cache(cache_dir, src_files, mmap_mode=mmap_mode)
+    if arrays is None:
+        print("... building dataset cache in {0:s}".format(cache_dir))
+        arrays = build_arrays()
+        try:
+            write_array_cache(cache_dir, arrays, src_files=src_files)
+            cached = read_array_cache(cache_dir, src_files, mmap_mode=mmap_mode)
+        except (OSError, IOError) as e:
+            print("... couldn't write dataset cache: {0:s}".format(str(e)))
+            cached = None
+        if not (cached is None):
+            arrays = cached
+    return arrays
+
 def load_mnist(path, zero_mean=True):
     mnist = np.load(path)
     train_set_x = mnist['train_data']
@@ -112,8 +235,39 @@ def load_udm_ss(dataset, sup_count, rng, zero_mean=True):
 
     return rval
 
-def load_udm(dataset, as_shared=True, zero_mean=True):
-    """Loads the UdM train/validate/test split of MNIST."""
+def _build_udm_arrays(dataset):
+    """
+    Parse the gzipped UdM MNIST pickle into a dict of float32/int arrays.
+    """
+    f = gzip.open(dataset, 'rb')
+    train_set, valid_set, test_set = cPickle.load(f)
+    f.close()
+    #train_set, valid_set, test_set format: tuple(input, target)
+    #input is an np.ndarray of 2 dimensions (a matrix)
+    #witch row's correspond to an example. target is a
+    #np.ndarray of 1 dimensions (vector)) that have the same length as
+    #the number of rows in the input. It should give the target
+    #target to the example with the same index in the input.
+    arrays = {}
+    for (tag, data_set) in [('tr', train_set), ('va', valid_set), \
+                            ('te', test_set)]:
+        arrays['X'+tag] = np.asarray(data_set[0]).astype(np.float32)
+        arrays['Y'+tag] = np.asarray(data_set[1])
+    # keep the training set mean around, for cheap zero-meaning
+    arrays['obs_mean'] = np.mean(arrays['Xtr'], axis=0, keepdims=True)
+    return arrays
+
+def load_udm(dataset, as_shared=True, zero_mean=True, use_cache=True, \
+             cache_root=None):
+    """
+    Loads the UdM train/validate/test split of MNIST.
+
+    When use_cache is True, the first call converts the pickle into a cache
+    of .npy files next to it (or in cache_root, or $GM_DATA_CACHE), and later
+    calls memory-map those files. With
+    as_shared=False and zero_mean=False, the returned arrays are read-only
+    memmaps into the cache.
+    """
 
     #############
     # LOAD DATA #
@@ -130,23 +284,16 @@ def load_udm(dataset, as_shared=True, zero_mean=True):
     print '... loading data'
 
     # Load the dataset
-    f = gzip.open(dataset, 'rb')
-    train_set, valid_set, test_set = cPickle.load(f)
-    f.close()
-    #train_set, valid_set, test_set format: tuple(input, target)
-    #input is an np.ndarray of 2 dimensions (a matrix)
-    #witch row's correspond to an example. target is a
-    #np.ndarray of 1 dimensions (vector)) that have the same length as
-    #the number of rows in the input. It should give the target
-    #target to the example with the same index in the input.
-    train_set = [v for v in train_set]
-    valid_set = [v for v in valid_set]
-    test_set = [v for v in test_set]
-    train_set[0] = np.asarray(train_set[0]).astype(np.float32)
-    valid_set[0] = np.asarray(valid_set[0]).astype(np.float32)
-    test_set[0] = np.asarray(test_set[0]).astype(np.float32)
+    build_arrays = lambda: _build_udm_arrays(dataset)
+    if use_cache:
+        arrays = cached_arrays([dataset], build_arrays, cache_root=cache_root)
+    else:
+        arrays = build_arrays()
+    train_set = [arrays['Xtr'], arrays['Ytr']]
+    valid_set = [arrays['Xva'], arrays['Yva']]
+    test_set = [arrays['Xte'], arrays['Yte']]
     if zero_mean:
-        obs_mean = np.mean(train_set[0], axis=0, keepdims=True)
+        obs_mean = arrays['obs_mean']
         train_set[0] = train_set[0] - obs_mean
         valid_set[0] = valid_set[0] - obs_mean
         test_set[0] = test_set[0] - obs_mean
@@ -163,54 +310,107 @@ def load_udm(dataset, as_shared=True, zero_mean=True):
             (test_set_x, test_set_y)]
     return rval
 
-def load_svhn(tr_file, te_file, ex_file=None, ex_count=None):
+def _read_svhn_pickle(f_name):
+    """
+    Get the raw image array and labels from the SVHN pickle f_name. Images
+    are indexed by the last axis of the image array.
+    """
+    pickle_file = open(f_name)
+    data_dict = cPickle.load(pickle_file)
+    pickle_file.close()
+    return [data_dict['X'], data_dict['y']]
+
+def _svhn_rows(X, idx=None, dtype=None, chunk_size=10000):
+    """
+    Convert SVHN images into a matrix with one vectorized image per row. X is
+    either a (32, 32, 3, N) color array (which gets vectorized channel-major),
+    a (32, 32, N) grayscale array, or an already vectorized (N, D) matrix.
+
+    Only the images in idx are converted, if it's given. The conversion works
+    on chunk_size images at a time, so temporaries stay small.
+    """
+    if X.ndim == 2:
+        obs_axis = 0
+        to_rows = lambda Xb: Xb
+    elif X.ndim == 3:
+        obs_axis = 2
+        to_rows = lambda Xb: Xb.transpose(2, 0, 1).reshape((Xb.shape[2], -1))
+    else:
+        obs_axis = 3
+        to_rows = lambda Xb: Xb.transpose(3, 2, 0, 1).reshape((Xb.shape[3], -1))
+    obs_dim = int(np.prod(X.shape)) // X.shape[obs_axis]
+    if dtype is None:
+        dtype = X.dtype
+    if idx is None:
+        row_count = X.shape[obs_axis]
+    else:
+        idx = np.asarray(idx)
+        row_count = idx.shape[0]
+    X_vec = np.zeros((row_count, obs_dim), dtype=dtype)
+    for start in range(0, row_count, chunk_size):
+        end = min(start + chunk_size, row_count)
+        if idx is None:
+            block = [slice(None)] * X.ndim
+            block[obs_axis] = slice(start, end)
+            X_vec[start:end] = to_rows(X[tuple(block)])
+        else:
+            # gather each block in sorted order, so memmapped sources get
+            # read front to back, then put the rows back in idx order
+            order = np.argsort(idx[start:end])
+            block_idx = idx[start:end][order]
+            X_vec[start + order] = to_rows(X.take(block_idx, axis=obs_axis))
+    return X_vec
+
+def _build_svhn_arrays(f_name):
+    """
+    Get the vectorized images and labels from the SVHN pickle f_name. The
+    images keep their stored dtype (usually uint8), which keeps the cache
+    small, and get cast to floatX after selection.
+    """
+    X, y = _read_svhn_pickle(f_name)
+    return {'X': _svhn_rows(X), 'Y': np.asarray(y).astype(np.int32)}
+
+def _load_svhn_file(f_name, use_cache, select=None, cache_root=None):
+    """
+    Get the vectorized images (as floatX) and labels for one SVHN pickle,
+    through the dataset cache if desired. If select is given, select(N) gives
+    the indices of the images to keep, and only those get cast to floatX.
+    """
+    if use_cache:
+        data = cached_arrays([f_name], lambda: _build_svhn_arrays(f_name), \
+                             cache_root=cache_root)
+        X, Y = data['X'], data['Y']
+        obs_count = X.shape[0]
+    else:
+        X, Y = _read_svhn_pickle(f_name)
+        obs_count = X.shape[-1]
+    idx = None if (select is None) else select(obs_count)
+    X = _svhn_rows(X, idx=idx, dtype=theano.config.floatX)
+    Y = np.asarray(Y).astype(np.int32)
+    if not (idx is None):
+        Y = Y.take(idx, axis=0)
+    return [X, Y]
+
+def load_svhn(tr_file, te_file, ex_file=None, ex_count=None, use_cache=True, \
+              cache_root=None):
     """
     Loads the full SVHN train/test sets and an additional number of randomly
     selected examples from the "extra set".
     """
     # load the training set as a numpy arrays
-    pickle_file = open(tr_file)
-    data_dict = cPickle.load(pickle_file)
-    Xtr = data_dict['X'].astype(theano.config.floatX)
-    Ytr = data_dict['y'].astype(np.int32) + 1
-    Xtr_vec = np.zeros((Xtr.shape[3], 32*32*3)).astype(theano.config.floatX)
-    for i in range(Xtr.shape[3]):
-        c_pix = 32*32
-        for c in range(3):
-            Xtr_vec[i,c*c_pix:((c+1)*c_pix)] = \
-                    Xtr[:,:,c,i].reshape((32*32,))
-    Xtr = Xtr_vec
-    pickle_file.close()
+    Xtr, Ytr = _load_svhn_file(tr_file, use_cache, cache_root=cache_root)
+    Ytr = Ytr + 1
     # load the test set as numpy arrays
-    pickle_file = open(te_file)
-    data_dict = cPickle.load(pickle_file)
-    Xte = data_dict['X'].astype(theano.config.floatX)
-    Yte = data_dict['y'].astype(np.int32) + 1
-    Xte_vec = np.zeros((Xte.shape[3], 32*32*3)).astype(theano.config.floatX)
-    for i in range(Xte.shape[3]):
-        c_pix = 32*32
-        for c in range(3):
-            Xte_vec[i,c*c_pix:((c+1)*c_pix)] = \
-                    Xte[:,:,c,i].reshape((32*32,))
-    Xte = Xte_vec
-    pickle_file.close()
+    Xte, Yte = _load_svhn_file(te_file, use_cache, cache_root=cache_root)
+    Yte = Yte + 1
     if ex_file is None:
         Xex = None
     else:
         # load the extra digit examples and only keep a random subset
-        pickle_file = open(ex_file)
-        data_dict = cPickle.load(pickle_file)
-        ex_full_size = data_dict['X'].shape[3]
-        idx = npr.randint(low=0, high=ex_full_size, size=(ex_count))
-        Xex = data_dict['X'].take(idx, axis=3).astype(theano.config.floatX)
-        Xex_vec = np.zeros((Xex.shape[3], 32*32*3)).astype(theano.config.floatX)
-        for i in range(Xex.shape[3]):
-            c_pix = 32*32
-            for c in range(3):
-                Xex_vec[i,c*c_pix:((c+1)*c_pix)] = \
-                        Xex[:,:,c,i].reshape((32*32,))
-        Xex = Xex_vec
-        pickle_file.close()
+        select = lambda ex_full_size: \
+                npr.randint(low=0, high=ex_full_size, size=(ex_count))
+        Xex, Yex = _load_svhn_file(ex_file, use_cache, select=select, \
+                                   cache_root=cache_root)
 
     # package data up for easy returnage
     data_dict = {'Xtr': Xtr, 'Ytr': Ytr, \
@@ -218,37 +418,17 @@ def load_svhn(tr_file, te_file, ex_file=None, ex_count=None):
                  'Xex': Xex}
     return data_dict
 
-def load_svhn_gray(tr_file, te_file, ex_file=None, ex_count=None):
+def load_svhn_gray(tr_file, te_file, ex_file=None, ex_count=None, \
+                   use_cache=True, cache_root=None):
     """
     Load pickle files with grayscale versions of the SVHN data.
     """
     # load the training set as a numpy arrays
-    pickle_file = open(tr_file)
-    data_dict = cPickle.load(pickle_file)
-    Xtr = data_dict['X']
+    Xtr, Ytr = _load_svhn_file(tr_file, use_cache, cache_root=cache_root)
     print("Xtr.shape: {0:s}".format(str(Xtr.shape)))
-    Ytr = data_dict['y'].astype(np.int32)
-    Xtr_vec = np.zeros((Xtr.shape[2], 32*32), dtype=theano.config.floatX)
-    for i in range(Xtr.shape[2]):
-        c_pix = 32*32
-        Xtr_vec[i,:] = Xtr[:,:,i].reshape((32*32,)).astype(theano.config.floatX)
-    del Xtr
-    Xtr = Xtr_vec
-    pickle_file.close()
-
     # load the test set as numpy arrays
-    pickle_file = open(te_file)
-    data_dict = cPickle.load(pickle_file)
-    pickle_file.close()
-    Xte = data_dict['X']
+    Xte, Yte = _load_svhn_file(te_file, use_cache, cache_root=cache_root)
     print("Xte.shape: {0:s}".format(str(Xte.shape)))
-    Yte = data_dict['y'].astype(np.int32)
-    Xte_vec = np.zeros((Xte.shape[2], 32*32), dtype=theano.config.floatX)
-    for i in range(Xte.shape[2]):
-        c_pix = 32*32
-        Xte_vec[i,:] = Xte[:,:,i].reshape((32*32,)).astype(theano.config.floatX)
-    del Xte
-    Xte = Xte_vec
 
     # process extra data as desired
     if ex_file is None:
@@ -257,18 +437,10 @@ def load_svhn_gray(tr_file, te_file, ex_file=None, ex_count=None):
         if ex_count is None:
             ex_count = 100000000
         # load the extra digit examples and only keep a subset
-        pickle_file = open(ex_file)
-        data_dict = cPickle.load(pickle_file)
-        pickle_file.close()
-        Xex = data_dict['X']
+        select = lambda ex_full_size: np.arange(min(ex_count, ex_full_size))
+        Xex, Yex = _load_svhn_file(ex_file, use_cache, select=select, \
+                                   cache_root=cache_root)
         print("Xex.shape: {0:s}".format(str(Xex.shape)))
-        max_idx = min(ex_count, Xex.shape[2])
-        Xex_vec = np.zeros((max_idx, 32*32)).astype(theano.config.floatX)
-        for i in range(max_idx):
-            c_pix = 32*32
-            Xex_vec[i,:] = Xex[:,:,i].reshape((32*32,)).astype(theano.config.floatX)
-        del Xex
-        Xex = Xex_vec
 
     # package data up for easy returnage
     data_dict = {'Xtr': Xtr, 'Ytr': Ytr, \
@@ -285,7 +457,18 @@ def load_svhn_all_gray_zca(all_file):
     data_dict = cPickle.load(pickle_file)
     return data_dict
 
-def load_tfd(tfd_pkl_name='', which_set='', fold=0):
+def _build_tfd_arrays(tfd_pkl_name):
+    """
+    Get the arrays from the pickled TFD dict that load_tfd needs.
+    """
+    data = cPickle.load(open(tfd_pkl_name))
+    arrays = {}
+    for key in ['images', 'folds', 'labs_ex', 'labs_id']:
+        arrays[key] = np.asarray(data[key])
+    return arrays
+
+def load_tfd(tfd_pkl_name='', which_set='', fold=0, use_cache=True, \
+             cache_root=None):
     """
     Load TFD dataset, stored as pickled dict rather than a .mat file.
     """
@@ -296,7 +479,11 @@ def load_tfd(tfd_pkl_name='', which_set='', fold=0):
                     'valid': 2,
                     'test': 3}
     assert(which_set in set_type_map)
-    data = cPickle.load(open(tfd_pkl_name))
+    if use_cache:
+        data = cached_arrays([tfd_pkl_name], \
+                lambda: _build_tfd_arrays(tfd_pkl_name), cache_root=cache_root)
+    else:
+        data = _build_tfd_arrays(tfd_pkl_name)
 
     # get indices of images in the requested set
     set_indices = np.zeros((data['folds'][:,0].shape[0],))
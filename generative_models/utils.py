@@ -46,10 +46,64 @@ def scale_to_unit_interval(ndar, eps=1e-8):
     ndar *= 1.0 / (ndar.max() + eps)
     return ndar
 
+def _tile_grid_view(out, img_shape, tile_shape, tile_spacing):
+    """
+    Get a (tile rows, img rows, tile cols, img cols) view of the 2d array out,
+    in which each [i,:,j,:] is the spot for the image in tile (i, j).
+    """
+    H, W = img_shape
+    Hs, Ws = tile_spacing
+    s0, s1 = out.strides
+    return np.lib.stride_tricks.as_strided(out, \
+            shape=(tile_shape[0], H, tile_shape[1], W), \
+            strides=(s0 * (H + Hs), s0, s1 * (W + Ws), s1))
+
+def _tile_channel(X, img_shape, tile_shape, tile_spacing, scale, \
+                  pixel_scale, out):
+    """
+    Tile the images in the rows of X into the 2d array out, all at once.
+
+    scale can be 'tile' (or True) to scale each image into [0...1], 'global'
+    to scale all images into [0...1] together, or False to leave them as-is.
+    """
+    H, W = img_shape
+    tile_count = tile_shape[0] * tile_shape[1]
+    img_count = min(X.shape[0], tile_count)
+    imgs = X[0:img_count]
+    if (scale is True) or (scale == 'tile'):
+        # same as scale_to_unit_interval, for each image
+        imgs = imgs - imgs.min(axis=1)[:,np.newaxis]
+        imgs *= (1.0 / (imgs.max(axis=1) + 1e-8))[:,np.newaxis]
+    elif scale == 'global':
+        imgs = imgs - imgs.min()
+        imgs *= (1.0 / (imgs.max() + 1e-8))
+    if pixel_scale != 1:
+        imgs = imgs * pixel_scale
+    imgs = imgs.reshape((img_count, H, W))
+    # write full rows of tiles at once, then whatever's left over
+    grid = _tile_grid_view(out, img_shape, tile_shape, tile_spacing)
+    grid = grid.transpose(0, 2, 1, 3)
+    full_rows = img_count // tile_shape[1]
+    extra = img_count - (full_rows * tile_shape[1])
+    grid[0:full_rows] = imgs[0:(full_rows * tile_shape[1])].reshape( \
+            (full_rows, tile_shape[1], H, W))
+    if full_rows < tile_shape[0]:
+        grid[full_rows,0:extra] = imgs[(full_rows * tile_shape[1]):]
+        grid[full_rows,extra:] = 0
+        grid[(full_rows+1):] = 0
+    # zero the spacing between tiles, in case out is a reused buffer
+    Hs, Ws = tile_spacing
+    for i in range(1, tile_shape[0]):
+        out[(i * (H + Hs) - Hs):(i * (H + Hs))] = 0
+    for j in range(1, tile_shape[1]):
+        out[:,(j * (W + Ws) - Ws):(j * (W + Ws))] = 0
+    return out
+
 def tile_raster_images(X, img_shape=None, tile_shape=None, tile_spacing=(0, 0),
                         scale=True,
                         output_pixel_vals=True,
-                        colorImg=False):
+                        colorImg=False,
+                        out=None):
     """
     Transform an array with one flattened image per row, into an array in
     which images are reshaped and layed out like tiles on a floor.
@@ -57,6 +111,11 @@ def tile_raster_images(X, img_shape=None, tile_shape=None, tile_spacing=(0, 0),
     This function is useful for visualizing datasets whose rows are images,
     and also columns of matrices for transforming those rows
     (such as the first layer of a neural net).
+
+    scale can be True/'tile' (scale each image into [0...1]), 'global' (scale
+    all images into [0...1] together) or False. If out is given, and has the
+    right shape and dtype, the tiled images are written into it rather than
+    into a newly allocated array, e.g. when drawing many video frames.
     """
     X = X * 1.0 # converts ints to floats
     
@@ -78,14 +137,18 @@ def tile_raster_images(X, img_shape=None, tile_shape=None, tile_spacing=(0, 0),
     #                tile_spacing[1]
     out_shape = [(ishp + tsp) * tshp - tsp for ishp, tshp, tsp
                         in zip(img_shape, tile_shape, tile_spacing)]
+    pixel_scale = 255 if output_pixel_vals else 1
 
     if isinstance(X, tuple):
         assert len(X) == 4
         # Create an output np ndarray to store the image
-        if output_pixel_vals:
-            out_array = np.zeros((out_shape[0], out_shape[1], 4), dtype='uint8')
-        else:
-            out_array = np.zeros((out_shape[0], out_shape[1], 4), dtype=X.dtype)
+        # take the dtype from the first channel that isn't None
+        x_dtypes = [c.dtype for c in X if not (c is None)] + [np.float64]
+        out_dtype = 'uint8' if output_pixel_vals else x_dtypes[0]
+        out_array = out
+        if (out_array is None) or (out_array.shape != tuple(out_shape + [4])) \
+                or (out_array.dtype != out_dtype):
+            out_array = np.zeros((out_shape[0], out_shape[1], 4), dtype=out_dtype)
 
         #colors default to 0, alpha defaults to 1 (opaque)
         if output_pixel_vals:
@@ -93,51 +156,30 @@ def tile_raster_images(X, img_shape=None, tile_shape=None, tile_spacing=(0, 0),
         else:
             channel_defaults = [0., 0., 0., 1.]
 
-        
         for i in xrange(4):
             if X[i] is None:
-                # if channel is None, fill it with zeros of the correct
-                # dtype
-                out_array[:, :, i] = np.zeros(out_shape,
-                        dtype='uint8' if output_pixel_vals else out_array.dtype
-                        ) + channel_defaults[i]
+                # if channel is None, fill it with the channel's default
+                out_array[:, :, i] = channel_defaults[i]
                 if i < 3:
                     print('WHY AM I HERE (utils.py line 101)?')
             else:
-                # use a recurrent call to compute the channel and store it
-                # in the output
                 xi = X[i]
                 if scale:
                     # shift and scale this channel to be in [0...1]
                     xi = (X[i] - X[i].min()) / (X[i].max() - X[i].min())
-                out_array[:, :, i] = tile_raster_images(xi, img_shape, tile_shape, tile_spacing, False, output_pixel_vals) 
+                _tile_channel(xi, img_shape, tile_shape, tile_spacing, \
+                        False, pixel_scale, out_array[:, :, i])
         return out_array
 
     else:
         # if we are dealing with only one channel
-        H, W = img_shape
-        Hs, Ws = tile_spacing
-
-        # generate a matrix to store the output
-        out_array = np.zeros(out_shape, dtype='uint8' if output_pixel_vals else X.dtype)
-        for tile_row in xrange(tile_shape[0]):
-            for tile_col in xrange(tile_shape[1]):
-                if tile_row * tile_shape[1] + tile_col < X.shape[0]:
-                    if scale:
-                        # if we should scale values to be between 0 and 1
-                        # do this by calling the `scale_to_unit_interval`
-                        # function
-                        tmp = X[tile_row * tile_shape[1] + tile_col].reshape(img_shape)
-                        this_img = scale_to_unit_interval(tmp)
-                    else:
-                        this_img = X[tile_row * tile_shape[1] + tile_col].reshape(img_shape)
-                    # add the slice to the corresponding position in the
-                    # output array
-                    out_array[
-                        tile_row * (H+Hs): tile_row * (H + Hs) + H,
-                        tile_col * (W+Ws): tile_col * (W + Ws) + W
-                        ] \
-                        = this_img * (255 if output_pixel_vals else 1)
+        out_dtype = 'uint8' if output_pixel_vals else X.dtype
+        out_array = out
+        if (out_array is None) or (out_array.shape != tuple(out_shape)) \
+                or (out_array.dtype != out_dtype):
+            out_array = np.zeros(out_shape, dtype=out_dtype)
+        _tile_channel(X, img_shape, tile_shape, tile_spacing, scale, \
+                pixel_scale, out_array)
         return out_array
 
 def visualize(EN, proto_key, layer_num, file_name):
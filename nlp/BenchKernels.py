@@ -0,0 +1,104 @@
+'''
+Micro-benchmark for the NSL/HSM kernels in NumbaFuncs: the original loops,
+the fused (vectorizable) loops and the gather-then-GEMM versions, over a range
+of embedding dims. For each one, this prints the throughput in (row, key)
+pairs per second, and the largest difference from the original loop's output.
+'''
+from __future__ import absolute_import
+
+import sys
+import numpy as np
+import numpy.random as npr
+from timeit import default_timer as timer
+
+import NumbaFuncs as nf
+
+KEY_COUNT = 50000
+BATCH_SIZE = 1000
+CODE_LEN = 20
+REPEATS = 10
+
+def hsm_batch(vec_dim):
+    # keys are Zipf-distributed, and a few codes end early (like hsm codes)
+    code_keys = np.minimum(npr.zipf(1.3, size=(BATCH_SIZE, CODE_LEN)) - 1, \
+                           KEY_COUNT - 1).astype(np.uint32)
+    code_ends = npr.randint(CODE_LEN // 2, CODE_LEN + 1, size=(BATCH_SIZE,))
+    for i in range(BATCH_SIZE):
+        code_keys[i,code_ends[i]:] = 1234567
+    code_signs = np.sign(npr.randn(BATCH_SIZE, CODE_LEN)).astype(np.float32)
+    X = npr.randn(BATCH_SIZE, vec_dim).astype(np.float32)
+    W = 0.1 * npr.randn(KEY_COUNT, vec_dim).astype(np.float32)
+    b = np.zeros((KEY_COUNT,), dtype=np.float32)
+    pair_count = np.sum(code_keys < 1234567)
+    return [X, code_keys, code_signs, W, b], pair_count
+
+def time_hsm(func, batch):
+    X, code_keys, code_signs, W, b = batch
+    dLdX = np.zeros(X.shape, dtype=np.float32)
+    dLdW = np.zeros(W.shape, dtype=np.float32)
+    dLdb = np.zeros(b.shape, dtype=np.float32)
+    L = np.zeros(code_keys.shape, dtype=np.float32)
+    func(X, code_keys, code_signs, W, b, dLdX, dLdW, dLdb, L) # warm up/jit
+    t0 = timer()
+    for i in range(REPEATS):
+        func(X, code_keys, code_signs, W, b, dLdX, dLdW, dLdb, L)
+    t = (timer() - t0) / REPEATS
+    return t, [dLdX, dLdW, L]
+
+def time_nsl(ff_func, bp_func, batch):
+    X, code_keys, code_signs, W, b = batch
+    table_idx = np.minimum(code_keys, KEY_COUNT - 1).astype(np.int32)
+    Y = np.zeros(table_idx.shape, dtype=np.float32)
+    dLdY = code_signs
+    dLdX = np.zeros(X.shape, dtype=np.float32)
+    dW = np.zeros(W.shape, dtype=np.float32)
+    db = np.zeros(b.shape, dtype=np.float32)
+    ff_func(table_idx, X, W, b, Y)
+    bp_func(table_idx, X, W, dLdY, dLdX, dW, db)
+    t0 = timer()
+    for i in range(REPEATS):
+        ff_func(table_idx, X, W, b, Y)
+        bp_func(table_idx, X, W, dLdY, dLdX, dW, db)
+    t = (timer() - t0) / REPEATS
+    return t, [Y, dLdX, dW]
+
+def max_diff(arrays, ref_arrays):
+    return max([np.max(np.abs(a - r)) / (np.max(np.abs(r)) + 1e-8) \
+                for (a, r) in zip(arrays, ref_arrays)])
+
+def bench(vec_dims):
+    hsm_funcs = [('loop', nf.hsm_ff_bp), ('fused', nf.hsm_ff_bp_fused), \
+                 ('gemm', nf.hsm_ff_bp_gemm)]
+    nsl_funcs = [('loop', nf.nsl_ff, nf.nsl_bp), \
+                 ('fused', nf.nsl_ff_fused, nf.nsl_bp_fused), \
+                 ('gemm', nf.nsl_ff_gemm, nf.nsl_bp_gemm)]
+    print("{0:>7s} {1:>7s} {2:>14s} {3:>10s} {4:>14s} {5:>10s}".format( \
+            'vec_dim', 'kernel', 'hsm pairs/s', 'hsm diff', 'nsl pairs/s', \
+            'nsl diff'))
+    for vec_dim in vec_dims:
+        batch, pair_count = hsm_batch(vec_dim)
+        nsl_pairs = BATCH_SIZE * CODE_LEN
+        hsm_ref = None
+        nsl_ref = None
+        for (hsm_f, nsl_f) in zip(hsm_funcs, nsl_funcs):
+            t_hsm, hsm_out = time_hsm(hsm_f[1], batch)
+            t_nsl, nsl_out = time_nsl(nsl_f[1], nsl_f[2], batch)
+            if hsm_ref is None:
+                hsm_ref = hsm_out
+                nsl_ref = nsl_out
+            print("{0:7d} {1:>7s} {2:14.0f} {3:10.2e} {4:14.0f} {5:10.2e}".format( \
+                    vec_dim, hsm_f[0], pair_count / t_hsm, \
+                    max_diff(hsm_out, hsm_ref), nsl_pairs / t_nsl, \
+                    max_diff(nsl_out, nsl_ref)))
+    return
+
+if __name__ == '__main__':
+    vec_dims = [50, 100, 200, 300, 400, 600]
+    if len(sys.argv) > 1:
+        vec_dims = [int(a) for a in sys.argv[1:]]
+    bench(vec_dims)
+
+
+##############
+# EYE BUFFER #
+##############
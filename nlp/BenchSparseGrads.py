@@ -0,0 +1,95 @@
+'''
+Compare the conflict-free gradient accumulation in KernelPool (sparse_ff_bp
+and sorted_lut_bp) with the "Hogwild" multithreaded kernels, for a range of
+thread counts. For each one, this prints the time per batch and the largest
+error in the accumulated gradients, relative to a single-threaded run (which
+can't lose any updates). Keys are Zipf-distributed, like word keys, so the
+frequent keys repeat a lot within each batch.
+'''
+from __future__ import absolute_import
+
+import sys
+import numpy as np
+import numpy.random as npr
+from timeit import default_timer as timer
+
+from CythonFuncs import nsl_ff_bp_pyx, lut_bp_pyx
+from KernelPool import KernelPool, sparse_ff_bp, sorted_lut_bp
+
+KEY_COUNT = 50000
+VEC_DIM = 300
+BATCH_SIZE = 2000
+NEG_COUNT = 10
+REPEATS = 10
+
+def zipf_keys(shape):
+    keys = npr.zipf(1.3, size=shape) - 1
+    return np.minimum(keys, KEY_COUNT - 1).astype(np.uint32)
+
+def nsl_batch():
+    pn_keys = zipf_keys((BATCH_SIZE, NEG_COUNT + 1))
+    pn_sign = -1.0 * np.ones(pn_keys.shape, dtype=np.float32)
+    pn_sign[:,0] = 1.0
+    X = npr.randn(BATCH_SIZE, VEC_DIM).astype(np.float32)
+    W = 0.1 * npr.randn(KEY_COUNT, VEC_DIM).astype(np.float32)
+    b = np.zeros((KEY_COUNT,), dtype=np.float32)
+    return [pn_keys, pn_sign, X, W, b]
+
+def run_nsl(pool, batch, safe):
+    pn_keys, pn_sign, X, W, b = batch
+    dX = np.zeros(X.shape, dtype=np.float32)
+    dW = np.zeros(W.shape, dtype=np.float32)
+    db = np.zeros(b.shape, dtype=np.float32)
+    L = np.zeros(pn_keys.shape, dtype=np.float32)
+    t0 = timer()
+    for i in range(REPEATS):
+        if safe:
+            sparse_ff_bp(nsl_ff_bp_pyx, pn_keys, pn_sign, X, W, b, \
+                         dX, dW, db, L, 1, pool=pool)
+        else:
+            pool.run(nsl_ff_bp_pyx, (pn_keys, pn_sign, X, W, b, \
+                                     dX, dW, db, L, 1))
+    t = (timer() - t0) / REPEATS
+    return t, dW
+
+def run_lut(pool, row_idx, dLdY, safe):
+    dW = np.zeros((KEY_COUNT, VEC_DIM), dtype=np.float32)
+    t0 = timer()
+    for i in range(REPEATS):
+        if safe:
+            sorted_lut_bp(row_idx, dLdY, dW)
+        else:
+            pool.run(lut_bp_pyx, (row_idx, dLdY, dW))
+    t = (timer() - t0) / REPEATS
+    return t, dW
+
+def bench(thread_counts):
+    batch = nsl_batch()
+    row_idx = zipf_keys((BATCH_SIZE,))
+    dLdY = npr.randn(BATCH_SIZE, VEC_DIM).astype(np.float32)
+    ref_pool = KernelPool(1)
+    t, nsl_ref = run_nsl(ref_pool, batch, False)
+    t, lut_ref = run_lut(ref_pool, row_idx, dLdY, False)
+    print("{0:>7s} {1:>8s} {2:>12s} {3:>12s} {4:>12s} {5:>12s}".format( \
+            'threads', 'mode', 'nsl (ms)', 'nsl err', 'lut (ms)', 'lut err'))
+    for thread_count in thread_counts:
+        pool = KernelPool(thread_count)
+        for safe in [False, True]:
+            t_nsl, dW_nsl = run_nsl(pool, batch, safe)
+            t_lut, dW_lut = run_lut(pool, row_idx, dLdY, safe)
+            print("{0:7d} {1:>8s} {2:12.3f} {3:12.6f} {4:12.3f} {5:12.6f}".format( \
+                    thread_count, ('sparse' if safe else 'hogwild'), \
+                    1000.0*t_nsl, np.max(np.abs(dW_nsl - nsl_ref)), \
+                    1000.0*t_lut, np.max(np.abs(dW_lut - lut_ref))))
+    return
+
+if __name__ == '__main__':
+    thread_counts = [1, 2, 4, 8, 16, 32]
+    if len(sys.argv) > 1:
+        thread_counts = [int(a) for a in sys.argv[1:]]
+    bench(thread_counts)
+
+
+##############
+# EYE BUFFER #
+##############
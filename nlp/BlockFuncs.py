@@ -0,0 +1,95 @@
+from __future__ import absolute_import
+
+import numpy as np
+
+########################################################
+# GATHER-THEN-GEMM VERSIONS OF THE NSL/HSM FF/BP LOOPS #
+########################################################
+#
+# The loop kernels do one dot product and two axpys per (row, key) pair. Here
+# the rows of a batch are taken in blocks, the W rows for the keys used in a
+# block are gathered into a dense matrix Wu, and the work for all pairs in the
+# block is done with three dense products (via BLAS):
+#
+#   Y = X.Wu'     -- outputs for every (row, key) in the block
+#   dX += S.Wu    -- S holds the gradient for each used (row, key), else 0
+#   dWu = S'.X    -- added into dW once per key, so no conflicts
+#
+# This computes outputs for some pairs that aren't needed, so it's best when
+# keys repeat a lot within a block (e.g. top-level HSM codes, frequent words).
+# block_rows bounds the size of Y and S to (block_rows x keys per block).
+
+# keys at or above this mark the end of a code in HSMLayer, and are skipped
+MAX_HSM_KEY = 12345678
+
+def _block_keys(keys, max_key):
+    """Get unique valid keys in a block, and the index of each key in them."""
+    valid = (keys < max_key)
+    uniq_keys, inv_idx = np.unique(keys[valid], return_inverse=True)
+    loc_keys = np.zeros(keys.shape, dtype=np.int64)
+    loc_keys[valid] = inv_idx
+    return valid, uniq_keys, loc_keys
+
+def _scatter_block(vals, loc_keys, key_count):
+    """Sum vals into a dense (rows x key_count) matrix, at columns loc_keys."""
+    row_count = vals.shape[0]
+    flat_idx = (np.arange(row_count)[:,np.newaxis] * key_count) + loc_keys
+    S = np.bincount(flat_idx.ravel(), weights=vals.ravel(), \
+                    minlength=(row_count * key_count))
+    return S.reshape((row_count, key_count)).astype(np.float32)
+
+def block_ff_bp(pn_keys, pn_sign, X, W, b, dX, dW, db, L, do_grad, \
+                block_rows=256, max_key=MAX_HSM_KEY):
+    """Gather-then-GEMM version of nsl_ff_bp (also used for hsm_ff_bp).
+
+    Args and results are as for nsl_ff_bp_pyx in CythonFuncsPyx.pyx, minus
+    the sp_idx arg. Entries of L for skipped keys are left untouched.
+    """
+    for s_idx in range(0, pn_keys.shape[0], block_rows):
+        e_idx = min(s_idx + block_rows, pn_keys.shape[0])
+        valid, uniq_keys, loc_keys = _block_keys(pn_keys[s_idx:e_idx], max_key)
+        if uniq_keys.shape[0] == 0:
+            continue
+        rows = np.arange(e_idx - s_idx)[:,np.newaxis]
+        Wu = W.take(uniq_keys, axis=0)
+        Xb = X[s_idx:e_idx]
+        Y = np.dot(Xb, Wu.T)
+        y = Y[rows, loc_keys] + b.take(uniq_keys)[loc_keys]
+        neg_label = -1.0 * pn_sign[s_idx:e_idx]
+        Lb = L[s_idx:e_idx]
+        Lb[valid] = np.logaddexp(0.0, (neg_label * y))[valid]
+        if (do_grad == 1):
+            g = neg_label / (1.0 + np.exp(-1.0 * neg_label * y))
+            g[np.logical_not(valid)] = 0.0
+            S = _scatter_block(g, loc_keys, uniq_keys.shape[0])
+            dX[s_idx:e_idx] += np.dot(S, Wu)
+            dW[uniq_keys] += np.dot(S.T, Xb)
+            db[uniq_keys] += np.sum(S, axis=0)
+    return 1
+
+def block_ff(table_idx, X, W, b, Y, block_rows=256):
+    """Gather-then-GEMM version of nsl_ff in NumbaFuncs (minus sp_idx)."""
+    for s_idx in range(0, table_idx.shape[0], block_rows):
+        e_idx = min(s_idx + block_rows, table_idx.shape[0])
+        valid, uniq_keys, loc_keys = _block_keys(table_idx[s_idx:e_idx], \
+                                                 W.shape[0])
+        rows = np.arange(e_idx - s_idx)[:,np.newaxis]
+        Yu = np.dot(X[s_idx:e_idx], W.take(uniq_keys, axis=0).T)
+        Y[s_idx:e_idx] = Yu[rows, loc_keys] + b.take(uniq_keys)[loc_keys]
+    return 1
+
+def block_bp(table_idx, X, W, dLdY, dLdX, dW, db, block_rows=256):
+    """Gather-then-GEMM version of nsl_bp in NumbaFuncs (minus sp_idx)."""
+    for s_idx in range(0, table_idx.shape[0], block_rows):
+        e_idx = min(s_idx + block_rows, table_idx.shape[0])
+        valid, uniq_keys, loc_keys = _block_keys(table_idx[s_idx:e_idx], \
+                                                 W.shape[0])
+        S = _scatter_block(dLdY[s_idx:e_idx], loc_keys, uniq_keys.shape[0])
+        dLdX[s_idx:e_idx] += np.dot(S, W.take(uniq_keys, axis=0))
+        dW[uniq_keys] += np.dot(S.T, X[s_idx:e_idx])
+        db[uniq_keys] += np.sum(S, axis=0)
+    return 1
+
+##############
+# EYE BUFFER #
+##############
@@ -148,9 +148,9 @@ def build_vocab(sentences, min_count=5, compute_hs_tree=True, \
     #   unk_word: the textish representation that stands in for words that
     #             aren't included in the "trained" vocabulary
     #
-    #   ns_table: a large list of word LUT keys such that sampling keys
-    #             uniformly at random from the list samples the keys nearly in
-    #             proportion to the frequency of their corresponding words
+    #   ns_table: cumulative distribution over word LUT keys, for drawing
+    #             keys in proportion to (the frequency of their words)**0.75
+    #             with _draw_from_cdf() (this is what NegSampler expects)
     #
     #   hs_tree: dict containing containing three items: 'keys_to_code_keys',
     #            'keys_to_code_signs', and 'max_code_key'.
@@ -201,31 +201,34 @@ def _precalc_downsampling(w2v, down_sample=0.0):
         v.sample_prob = min(prob, 1.0)
     return
 
-def _make_table(w2v, k2w, w2k, table_size=20000000, power=0.75):
+def _make_cdf(weights):
     """
-    Create a table using stored vocabulary word counts for drawing random words
-    in parts of training based on 'negative sampling'.
+    Get the cumulative distribution for drawing indices in proportion to the
+    given weights. This takes O(len(weights)) memory, unlike a table with
+    each index repeated in proportion to its weight.
+    """
+    cdf = np.cumsum(np.asarray(weights, dtype=np.float64))
+    return cdf / cdf[-1]
+
+def _draw_from_cdf(cdf, size):
+    """
+    Draw indices from the distribution given by cdf (see _make_cdf()).
+    """
+    idx = np.searchsorted(cdf, npr.random_sample(size), side='right')
+    return np.minimum(idx, (cdf.size - 1)).astype(np.uint32)
+
+def _make_table(w2v, k2w, w2k, power=0.75):
+    """
+    Create the distribution for drawing random words in parts of training
+    based on 'negative sampling', using stored vocabulary word counts.
 
     Called from `build_vocab()`.
     """
-    # table (= list of words) of noise distribution for negative sampling
-    vocab_size = len(k2w)
-    table = np.zeros((table_size,), dtype=np.uint32)
-
-    # compute sum of all power (Z in paper)
-    power_sum = float(sum([w2v[word].count**power for word in w2v]))
-    # go through the whole table and fill it up with the word indexes proportional to a word's count**power
-    widx = 0
-    # normalize count^0.75 by Z
-    d1 = w2v[k2w[widx]].count**power / power_sum
-    for tidx in xrange(table_size):
-        table[tidx] = widx
-        if ((float(tidx) / table_size) > d1):
-            widx += 1
-            d1 += w2v[k2w[widx]].count**power / power_sum
-        if widx >= vocab_size:
-            widx = vocab_size - 1
-    return table.astype(np.uint32)
+    # noise distribution for negative sampling: key k gets drawn in proportion
+    # to count**power for its word
+    counts = np.asarray([w2v[k2w[k]].count for k in xrange(len(k2w))], \
+                        dtype=np.float64)
+    return _make_cdf(counts**power)
 
 
 def _create_binary_tree(w2v):
@@ -361,28 +364,17 @@ class PhraseSampler:
         self.phrase_list = phrase_list
         self.phrase_table = self._make_table(self.phrase_list)
         self.max_phrase_key = min(len(self.phrase_list), max_phrase_key)
-        self.pt_size = self.phrase_table.size
+        # upper bound for the random ints used by fast_*_sample
+        self.rand_high = 20000000
         return
 
-    def _make_table(self, p_list, table_size=20000000):
+    def _make_table(self, p_list):
         """
-        Create a table for quickly drawing phrase indices in proportion to
+        Create the distribution for drawing phrase indices in proportion to
         the length of each phrase.
         """
-        phrase_count = len(p_list)
-        phrase_lens = np.asarray([p.size for p in p_list]).astype(np.float64)
-        len_sum = np.sum(phrase_lens)
-        table = np.zeros((table_size,), dtype=np.uint32)
-        widx = 0
-        d1 = phrase_lens[0] / len_sum
-        for tidx in xrange(table_size):
-            table[tidx] = widx
-            if ((float(tidx) / table_size) > d1):
-                widx += 1
-                d1 += phrase_lens[widx] / len_sum
-            if widx >= phrase_count:
-                widx = phrase_count - 1
-        return table.astype(np.uint32)
+        phrase_lens = np.asarray([p.size for p in p_list], dtype=np.float64)
+        return _make_cdf(phrase_lens)
 
     def sample_pairs(self, sample_count):
         """Draw a sample."""
@@ -392,16 +384,16 @@ class PhraseSampler:
         # we will use a "precomputed" table of random ints, to save overhead
         # on calls through numpy.random. the location of the next fresh random
         # int in rand_pool is given by ri[0]
-        rand_pool = npr.randint(0, high=self.pt_size, \
+        rand_pool = npr.randint(0, high=self.rand_high, \
                 size=(10*sample_count,)).astype(np.uint32)
         ri = np.asarray([0]).astype(np.uint32) # index into rand_pool
         repeats = 5
         while not ((sample_count % repeats) == 0):
             repeats -= 1
+        # draw the source phrase for each group of repeats all at once
+        draw_keys = _draw_from_cdf(self.phrase_table, (sample_count // repeats))
         for i in range(0, sample_count, repeats):
-            pt_idx = rand_pool[ri[0]]
-            ri[0] = ri[0] + 1
-            phrase_keys[i:(i+repeats)] = self.phrase_table[pt_idx]
+            phrase_keys[i:(i+repeats)] = draw_keys[i // repeats]
             fast_pair_sample(self.phrase_list[phrase_keys[i]], self.max_window, \
                              i, repeats, anc_keys, pos_keys, rand_pool, ri)
         anc_keys = anc_keys.astype(np.uint32)
@@ -417,16 +409,16 @@ class PhraseSampler:
         # we will use a "precomputed" table of random ints, to save overhead
         # on calls through numpy.random. the location of the next fresh random
         # int in rand_pool is given by ri[0]
-        rand_pool = npr.randint(0, high=self.pt_size, \
+        rand_pool = npr.randint(0, high=self.rand_high, \
                 size=(10*sample_count,)).astype(np.uint32)
         ri = np.asarray([0]).astype(np.uint32) # index into rand_pool
         repeats = 5
         while not ((sample_count % repeats) == 0):
             repeats -= 1
+        # draw the source phrase for each group of repeats all at once
+        draw_keys = _draw_from_cdf(self.phrase_table, (sample_count // repeats))
         for i in range(0, sample_count, repeats):
-            pt_idx = rand_pool[ri[0]]
-            ri[0] = ri[0] + 1
-            phrase_keys[i:(i+repeats)] = self.phrase_table[pt_idx]
+            phrase_keys[i:(i+repeats)] = draw_keys[i // repeats]
             fast_seq_sample(self.phrase_list[phrase_keys[i]], gram_n, pad_key, \
                     i, repeats, key_seqs, rand_pool, ri)
         key_seqs = key_seqs.astype(np.uint32)
@@ -440,18 +432,13 @@ class NegSampler:
     def __init__(self, neg_table=None, neg_count=10):
         # phrase_list contains the phrases to sample from 
         self.neg_table = neg_table
-        self.neg_table_size = self.neg_table.size
         self.neg_count = neg_count
         return
 
     def sample(self, sample_count, neg_count=0):
         if (neg_count == 0):
             neg_count = self.neg_count
-        neg_keys = np.zeros((sample_count, neg_count), dtype=np.uint32)
-        neg_idx = npr.randint(0, high=self.neg_table_size, size=neg_keys.shape)
-        for i in range(neg_keys.shape[1]):
-            neg_keys[:,i] = self.neg_table[neg_idx[:,i]]
-        neg_keys = neg_keys.astype(np.uint32)
+        neg_keys = _draw_from_cdf(self.neg_table, (sample_count, neg_count))
         return neg_keys
 
 
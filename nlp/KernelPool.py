@@ -0,0 +1,212 @@
+from __future__ import absolute_import
+
+import os
+import threading
+import Queue
+import numpy as np
+
+######################################
+# PERSISTENT THREAD POOL FOR KERNELS #
+######################################
+
+def default_thread_count():
+    """Get the number of threads to split kernel calls over.
+
+    This is taken from the NLP_THREADS environment variable if it's set, and
+    is 4 otherwise. More threads make lost updates in the "Hogwild" kernels
+    more likely, so raising it should go with NLP_SAFE_GRADS=1.
+    """
+    env_count = os.environ.get('NLP_THREADS', '')
+    if env_count.strip() != '':
+        return max(1, int(env_count))
+    return 4
+
+class KernelPool:
+    """Persistent pool of worker threads for running multithreaded kernels.
+
+    The kernels split their work by the rows of their first argument, and
+    the index array for each chunk of rows gets cached, so repeated calls with
+    the same batch size just re-use the same (contiguous) index slices. The
+    calling thread always runs the last chunk itself, so a pool for n threads
+    keeps n-1 workers. Kernels are expected to release the GIL.
+    """
+    def __init__(self, thread_count=None):
+        if thread_count is None:
+            thread_count = default_thread_count()
+        self.thread_count = max(1, thread_count)
+        self.workers = []
+        self.jobs = []
+        self.done = Queue.Queue()
+        self.call_lock = threading.Lock()
+        self.idx_cache = {}
+        self.chunk_cache = {}
+        for i in range(self.thread_count - 1):
+            jobs = Queue.Queue()
+            worker = threading.Thread(target=self._work, args=(jobs,))
+            worker.daemon = True
+            worker.start()
+            self.jobs.append(jobs)
+            self.workers.append(worker)
+        return
+
+    def _work(self, jobs):
+        """Main loop for the worker threads."""
+        while True:
+            inner_func, args = jobs.get()
+            try:
+                inner_func(*args)
+                self.done.put(None)
+            except Exception as e:
+                self.done.put(e)
+        return
+
+    def chunks(self, length, numthreads, idx_dtype=np.uint32):
+        """Get (cached) index arrays splitting range(length) into chunks."""
+        key = (length, numthreads, np.dtype(idx_dtype).str)
+        if not (key in self.chunk_cache):
+            if len(self.chunk_cache) > 256:
+                self.chunk_cache = {}
+            sp_idx = self.idx_cache.get(idx_dtype)
+            if (sp_idx is None) or (sp_idx.shape[0] < length):
+                sp_idx = np.arange(0, length).astype(idx_dtype)
+                self.idx_cache[idx_dtype] = sp_idx
+                self.chunk_cache = {}
+            chunklen = (length + (numthreads-1)) // numthreads
+            self.chunk_cache[key] = [sp_idx[i*chunklen:min((i+1)*chunklen, length)] \
+                                     for i in range(numthreads)]
+        return self.chunk_cache[key]
+
+    def run(self, inner_func, args, numthreads=None, idx_dtype=np.uint32):
+        """Run inner_func(sp_idx, *args) over the rows of args[0].
+
+        The rows are split over at most numthreads threads (default: the
+        whole pool). Batches with fewer rows than threads, and pools with a
+        single thread, are run directly in the calling thread.
+        """
+        length = len(args[0])
+        if numthreads is None:
+            numthreads = self.thread_count
+        numthreads = max(1, min(numthreads, self.thread_count, length))
+        if numthreads == 1:
+            sp_idx = self.chunks(length, 1, idx_dtype)[0]
+            inner_func(*((sp_idx,) + args))
+            return 1
+        chunks = self.chunks(length, numthreads, idx_dtype)
+        return self.run_chunks(inner_func, [(c,) + args for c in chunks])
+
+    def run_chunks(self, inner_func, chunk_args):
+        """Run inner_func(*chunk_args[i]) for each i, one call per thread.
+
+        This is for kernels that need some per-thread arguments, e.g. their
+        own gradient buffers. There can't be more chunks than threads.
+        """
+        assert(len(chunk_args) <= self.thread_count)
+        if len(chunk_args) == 1:
+            inner_func(*chunk_args[0])
+            return 1
+        self.call_lock.acquire()
+        try:
+            # hand all but the last chunk of work to the workers
+            for i in range(len(chunk_args) - 1):
+                self.jobs[i].put((inner_func, chunk_args[i]))
+            # give the last chunk of work to the calling thread
+            err = None
+            try:
+                inner_func(*chunk_args[-1])
+            except Exception as e:
+                err = e
+            for i in range(len(chunk_args) - 1):
+                result = self.done.get()
+                if err is None:
+                    err = result
+            if not (err is None):
+                raise err
+        finally:
+            self.call_lock.release()
+        return 1
+
+# shared pool, for all of the kernels in this process
+_POOL = None
+
+def get_pool():
+    """Get the pool shared by all kernels, starting it if needed."""
+    global _POOL
+    if _POOL is None:
+        _POOL = KernelPool()
+    return _POOL
+
+def make_multithread(inner_func, numthreads=None, idx_dtype=np.uint32):
+    """Wrap inner_func(sp_idx, *args) to run over the shared kernel pool."""
+    def func(*args):
+        return get_pool().run(inner_func, args, numthreads=numthreads, \
+                              idx_dtype=idx_dtype)
+    return func
+
+###############################################
+# CONFLICT-FREE SPARSE GRADIENT ACCUMULATION #
+###############################################
+
+# keys at or above this mark the end of a code in HSMLayer, and are skipped by
+# the nsl_ff_bp kernel (this must match MAX_HSM_KEY in CythonFuncsPyx.pyx)
+MAX_HSM_KEY = 12345678
+
+def sorted_lut_bp(row_idx, dLdY, dW):
+    """Add each row of dLdY to the row of dW given by row_idx.
+
+    Rows of dLdY that go to the same row of dW are summed first (by sorting
+    and segmenting the keys), so each row of dW gets a single update and no
+    updates get lost to repeated keys, unlike the multithreaded lut_bp.
+    """
+    row_idx = np.asarray(row_idx).ravel()
+    if row_idx.shape[0] == 0:
+        return 1
+    order = np.argsort(row_idx, kind='mergesort')
+    keys = row_idx[order]
+    starts = np.flatnonzero(np.concatenate(([True], (keys[1:] != keys[:-1]))))
+    dW[keys[starts]] += np.add.reduceat(dLdY[order], starts, axis=0)
+    return 1
+
+def sparse_ff_bp(inner_func, pn_keys, pn_sign, X, W, b, dX, dW, db, L, \
+                 do_grad, pool=None):
+    """Conflict-free version of nsl_ff_bp/hsm_ff_bp for the kernel inner_func.
+
+    The keys touched by this batch are compacted to 0...n-1, and each thread
+    accumulates into its own compact gradient buffers, which get summed in a
+    fixed order and added into dW/db afterwards. Rows of dX and L belong to a
+    single observation, so threads can write those directly.
+    """
+    if pool is None:
+        pool = get_pool()
+    if do_grad == 0:
+        # without gradients, the kernel only writes its own rows of L
+        return pool.run(inner_func, (pn_keys, pn_sign, X, W, b, dX, dW, \
+                                     db, L, do_grad))
+    length = pn_keys.shape[0]
+    numthreads = max(1, min(pool.thread_count, length))
+    chunks = pool.chunks(length, numthreads)
+    # compact the touched keys, leaving the end-of-code keys alone
+    valid = (pn_keys < MAX_HSM_KEY)
+    uniq_keys, loc_idx = np.unique(pn_keys[valid], return_inverse=True)
+    loc_keys = pn_keys.copy()
+    loc_keys[valid] = loc_idx
+    W_loc = W.take(uniq_keys, axis=0)
+    b_loc = b.take(uniq_keys)
+    dW_loc = np.zeros((numthreads, uniq_keys.shape[0], W.shape[1]), dtype=dW.dtype)
+    db_loc = np.zeros((numthreads, uniq_keys.shape[0]), dtype=db.dtype)
+    chunk_args = [(chunks[i], loc_keys, pn_sign, X, W_loc, b_loc, dX, \
+                   dW_loc[i], db_loc[i], L, do_grad) for i in range(numthreads)]
+    pool.run_chunks(inner_func, chunk_args)
+    # uniq_keys has no repeats, so these updates can't collide
+    dW[uniq_keys] += dW_loc.sum(axis=0)
+    db[uniq_keys] += db_loc.sum(axis=0)
+    return 1
+
+def make_sparse_ff_bp(inner_func):
+    """Wrap an nsl_ff_bp style kernel to use sparse_ff_bp."""
+    def func(*args):
+        return sparse_ff_bp(inner_func, *args)
+    return func
+
+##############
+# EYE BUFFER #
+##############
@@ -1,27 +1,35 @@
 from __future__ import absolute_import
 
 # Imports of public stuff
+import os
 import numpy as np
 import numpy.random as npr
 import numexpr as ne
 
 # Imports of my stuff
 from HelperFuncs import randn, ones, zeros
+from SparseParams import SparseParams
 from CythonFuncs import w2v_ff_bp, nsl_ff_bp, lut_bp, \
-                        ag_update_2d, ag_update_1d, hsm_ff_bp
+                        ag_update_2d, ag_update_1d, hsm_ff_bp, \
+                        nsl_ff_bp_safe, hsm_ff_bp_safe, lut_bp_safe
 
 # UH OH, GLOBAL PARAMS (TODO: GET RID OF THESE!)
 ADA_EPS = 1e-3
 MAX_HSM_KEY = 12345678
+# default for the layers' safe_grads flag. when set, gradients for repeated
+# keys in a batch get summed without races between threads (slower, but no
+# updates are lost, which matters at high thread counts).
+SAFE_GRADS = (os.environ.get('NLP_SAFE_GRADS', '0') == '1')
 
 ###########################
 # NEGATIVE SAMPLING LAYER #
 ###########################
 
 class NSLayer:
-    def __init__(self, in_dim=0, max_out_key=0):
+    def __init__(self, in_dim=0, max_out_key=0, safe_grads=SAFE_GRADS):
         # Record and initialize layer parameters
         self.dim_input = in_dim
+        self.safe_grads = safe_grads
         self.key_count = max_out_key + 1 # assume 0 is a key
         self.params = {}
         self.params['W'] = 0.01 * randn((self.key_count, in_dim))
@@ -32,13 +40,13 @@ class NSLayer:
         self.moms = {}
         self.moms['W'] = zeros((self.key_count, in_dim))
         self.moms['b'] = zeros((self.key_count,))
+        self.sparse = SparseParams(self, ['W', 'b'], self.key_count)
         # Set temp vars to use in feedforward/backprop
         self.X = []
         self.Y = []
         self.dLdX = []
         self.dLdY = []
         self.samp_keys = []
-        self.grad_idx = []
         return
 
     def init_params(self, w_scale=0.01, b_scale=0.0):
@@ -47,10 +55,17 @@ class NSLayer:
         self.grads['W'] = zeros((self.key_count, self.dim_input))
         self.params['b'] = zeros((self.key_count,))
         self.grads['b'] = zeros((self.key_count,))
+        self.sparse.reset_decay()
+        return
+
+    def flush_params(self):
+        """Apply any deferred l2 decay, before reading the full params."""
+        self.sparse.flush()
         return
 
     def clip_params(self, max_norm=5.0):
         """Bound L2 (row-wise) norm of W by max_norm."""
+        self.sparse.flush()
         M = self.params['W']
         m_scales = max_norm / np.sqrt(np.sum(M**2.0,axis=1) + 1e-5)
         mask = (m_scales < 1.0)
@@ -84,46 +99,36 @@ class NSLayer:
         # do feedforward and backprop all in one go
         L = zeros(samp_keys.shape)
         dLdX = zeros(X.shape)
-        nsl_ff_bp(samp_keys, samp_sign, X, self.params['W'], self.params['b'], \
-                  dLdX, self.grads['W'], self.grads['b'], L, do_grad)
+        self.sparse.refresh(samp_keys)
+        ff_bp = nsl_ff_bp_safe if self.safe_grads else nsl_ff_bp
+        ff_bp(samp_keys, samp_sign, X, self.params['W'], self.params['b'], \
+              dLdX, self.grads['W'], self.grads['b'], L, do_grad)
         # derp dorp
         L = np.sum(L)
         if do_grad:
-            if len(self.grad_idx) == 0:
-                self.grad_idx = np.unique(samp_keys)
-            else:
-                self.grad_idx = np.unique(np.concatenate( \
-                        (self.grad_idx, np.unique(samp_keys)) ))
+            self.sparse.touch(samp_keys)
         return [dLdX, L]
 
     def l2_regularize(self, lam_l2=1e-5):
-        """Add gradients for l2 regularization. And compute loss."""
-        self.params['W'] -= lam_l2 * self.params['W']
-        self.params['b'] -= lam_l2 * self.params['b']
+        """Apply l2 regularization (lazily, see SparseParams)."""
+        self.sparse.l2_decay('W', lam_l2)
+        self.sparse.l2_decay('b', lam_l2)
         return 1
 
     def apply_grad(self, learn_rate=1e-2):
         """Apply the current accumulated gradients, with adagrad."""
-        nz_idx = self.grad_idx[self.grad_idx < self.key_count]
-        ag_update_2d(nz_idx, self.params['W'], self.grads['W'], \
-                     self.moms['W'], learn_rate)
-        ag_update_1d(nz_idx, self.params['b'], self.grads['b'], \
-                     self.moms['b'], learn_rate)
-        self.grad_idx = []
+        self.sparse.apply_grad({'W': learn_rate, 'b': learn_rate})
         return
 
     def reset_moms(self, ada_init=1e-3):
         """Reset the gradient accumulators for this layer."""
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
-        self.moms['b'] = (0.0 * self.moms['b']) + ada_init
+        self.sparse.reset_moms(ada_init)
         return
 
     def reset_grads_and_moms(self, ada_init=1e-3):
         """Reset the gradient accumulators for this layer."""
-        self.grads['W'] = (0.0 * self.grads['W'])
-        self.grads['b'] = (0.0 * self.grads['b'])
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
-        self.moms['b'] = (0.0 * self.moms['b']) + ada_init
+        self.sparse.reset_grads()
+        self.sparse.reset_moms(ada_init)
         return
 
     def _cleanup(self):
@@ -140,9 +145,10 @@ class NSLayer:
 #################################################
 
 class HSMLayer:
-    def __init__(self, in_dim=0, max_hs_key=0):
+    def __init__(self, in_dim=0, max_hs_key=0, safe_grads=SAFE_GRADS):
         # Record and initialize some layer parameters
         self.dim_input = in_dim
+        self.safe_grads = safe_grads
         self.key_count = max_hs_key + 1 # assume 0 is a key
         self.params = {}
         self.params['W'] = 0.01 * randn((self.key_count, in_dim))
@@ -153,12 +159,12 @@ class HSMLayer:
         self.moms = {}
         self.moms['W'] = zeros((self.key_count, in_dim))
         self.moms['b'] = zeros((self.key_count,))
+        self.sparse = SparseParams(self, ['W', 'b'], self.key_count)
         # Set temp vars to use in feedforward/backprop
         self.X = []
         self.Y = []
         self.dLdX = []
         self.dLdY = []
-        self.grad_idx = []
         return
 
     def init_params(self, w_scale=0.01, b_scale=0.0):
@@ -167,10 +173,17 @@ class HSMLayer:
         self.grads['W'] = zeros((self.key_count, self.dim_input))
         self.params['b'] = zeros((self.key_count,))
         self.grads['b'] = zeros((self.key_count,))
+        self.sparse.reset_decay()
+        return
+
+    def flush_params(self):
+        """Apply any deferred l2 decay, before reading the full params."""
+        self.sparse.flush()
         return
 
     def clip_params(self, max_norm=5.0):
         """Bound L2 (row-wise) norm of W by max_norm."""
+        self.sparse.flush()
         M = self.params['W']
         m_scales = max_norm / np.sqrt(np.sum(M**2.0,axis=1) + 1e-5)
         mask = (m_scales < 1.0)
@@ -200,48 +213,38 @@ class HSMLayer:
         # do feedforward and backprop all in one go
         dLdX = zeros(X.shape)
         L_cy = zeros(code_keys.shape)
-        hsm_ff_bp(code_keys, code_signs, X, self.params['W'], self.params['b'], \
-                  dLdX, self.grads['W'], self.grads['b'], L_cy, do_grad)
+        self.sparse.refresh(code_keys)
+        ff_bp = hsm_ff_bp_safe if self.safe_grads else hsm_ff_bp
+        ff_bp(code_keys, code_signs, X, self.params['W'], self.params['b'], \
+              dLdX, self.grads['W'], self.grads['b'], L_cy, do_grad)
         L_cy_sum = np.sum(L_cy)
         L_cy_pre = L_cy_sum
         # Derp dorp
         L = L_cy_sum
         if do_grad:
-            if len(self.grad_idx) == 0:
-                self.grad_idx = np.unique(code_keys)
-            else:
-                self.grad_idx = np.unique(np.concatenate( \
-                        (self.grad_idx, np.unique(code_keys)) ))
+            self.sparse.touch(code_keys)
         return [dLdX, L]
 
     def l2_regularize(self, lam_l2=1e-5):
-        """Add gradients for l2 regularization. And compute loss."""
-        self.params['W'] -= lam_l2 * self.params['W']
-        self.params['b'] -= lam_l2 * self.params['b']
+        """Apply l2 regularization (lazily, see SparseParams)."""
+        self.sparse.l2_decay('W', lam_l2)
+        self.sparse.l2_decay('b', lam_l2)
         return 1
 
     def apply_grad(self, learn_rate=1e-2):
         """Apply the current accumulated gradients, with adagrad."""
-        nz_idx = self.grad_idx[self.grad_idx < self.key_count]
-        ag_update_2d(nz_idx, self.params['W'], self.grads['W'], \
-                     self.moms['W'], learn_rate)
-        ag_update_1d(nz_idx, self.params['b'], self.grads['b'], \
-                     self.moms['b'], learn_rate)
-        self.grad_idx = []
+        self.sparse.apply_grad({'W': learn_rate, 'b': learn_rate})
         return
 
     def reset_moms(self, ada_init=1e-3):
         """Reset the gradient accumulators for this layer."""
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
-        self.moms['b'] = (0.0 * self.moms['b']) + ada_init
+        self.sparse.reset_moms(ada_init)
         return
 
     def reset_grads_and_moms(self, ada_init=1e-3):
         """Reset the gradient accumulators for this layer."""
-        self.grads['W'] = (0.0 * self.grads['W'])
-        self.grads['b'] = (0.0 * self.grads['b'])
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
-        self.moms['b'] = (0.0 * self.moms['b']) + ada_init
+        self.sparse.reset_grads()
+        self.sparse.reset_moms(ada_init)
         return
 
     def _cleanup(self):
@@ -257,16 +260,17 @@ class HSMLayer:
 #######################
 
 class LUTLayer:
-    def __init__(self, max_key, embed_dim, n_gram=1):
+    def __init__(self, max_key, embed_dim, n_gram=1, safe_grads=SAFE_GRADS):
         # Set stuff for managing this type of layer
         self.key_count = max_key + 1 # add 1 to accommodate 0 indexing
+        self.safe_grads = safe_grads
         self.params = {}
         self.params['W'] = 0.01 * randn((self.key_count, embed_dim))
         self.grads = {}
         self.grads['W'] = zeros(self.params['W'].shape)
         self.moms = {}
         self.moms['W'] = zeros(self.params['W'].shape)
-        self.grad_idx = set()
+        self.sparse = SparseParams(self, ['W'], self.key_count)
         self.embed_dim = embed_dim
         self.n_gram = n_gram
         self.X = []
@@ -277,10 +281,17 @@ class LUTLayer:
         """Randomly initialize the weights in this layer."""
         self.params['W'] = w_scale * randn((self.key_count, self.embed_dim))
         self.grads['W'] = zeros((self.key_count, self.embed_dim))
+        self.sparse.reset_decay()
+        return
+
+    def flush_params(self):
+        """Apply any deferred l2 decay, before reading the full params."""
+        self.sparse.flush()
         return
 
     def clip_params(self, max_norm=5.0):
         """Bound L2 (row-wise) norm of W by max_norm."""
+        self.sparse.flush()
         M = self.params['W']
         m_scales = max_norm / np.sqrt(np.sum(M**2.0,axis=1) + 1e-5)
         mask = (m_scales < 1.0)
@@ -299,6 +310,7 @@ class LUTLayer:
         self._cleanup()
         # Record the incoming list of row indices to extract
         self.X = X.astype(np.uint32)
+        self.sparse.refresh(self.X)
         # Use look-up table to generate the desired sequences
         if (self.n_gram == 1):
             self.Y = self.params['W'].take(self.X, axis=0)
@@ -314,39 +326,37 @@ class LUTLayer:
         """Backprop through this layer.
         """
         assert(np.max(self.X) < self.key_count)
-        self.grad_idx.update(self.X.ravel())
+        self.sparse.touch(self.X)
         # Add the gradients to the gradient accumulator
+        bp = lut_bp_safe if self.safe_grads else lut_bp
         if (self.n_gram == 1):
-            lut_bp(self.X, dLdY, self.grads['W'])
+            bp(self.X, dLdY, self.grads['W'])
         else:
             # Backprop for each of the predictor words
             dLdY_chunks = np.hsplit(dLdY, self.n_gram)
             for i in range(self.n_gram):
-                lut_bp(self.X[:,i], dLdY_chunks[i], self.grads['W'])
+                bp(self.X[:,i], dLdY_chunks[i], self.grads['W'])
         return 1
 
     def l2_regularize(self, lam_l2=1e-5):
-        """Add gradients for l2 regularization. And compute loss."""
-        self.params['W'] -= lam_l2 * self.params['W']
+        """Apply l2 regularization (lazily, see SparseParams)."""
+        self.sparse.l2_decay('W', lam_l2)
         return 1
 
     def apply_grad(self, learn_rate=1e-2):
         """Apply the current accumulated gradients, with adagrad."""
-        nz_idx = np.asarray([i for i in self.grad_idx]).astype(np.uint32)
-        ag_update_2d(nz_idx, self.params['W'], self.grads['W'], \
-                     self.moms['W'], learn_rate)
-        self.grad_idx = set()
+        self.sparse.apply_grad({'W': learn_rate})
         return
 
     def reset_moms(self, ada_init=1e-3):
         """Reset the gradient accumulators for this layer."""
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
+        self.sparse.reset_moms(ada_init)
         return
 
     def reset_grads_and_moms(self, ada_init=1e-3):
         """Reset the gradient accumulators for this layer."""
-        self.grads['W'] = (0.0 * self.grads['W'])
-        self.moms['W'] = (0.0 * self.moms['W']) + ada_init
+        self.sparse.reset_grads()
+        self.sparse.reset_moms(ada_init)
         return
 
     def _cleanup(self):
@@ -360,9 +370,11 @@ class LUTLayer:
 ##########################
 
 class CMLayer:
-    def __init__(self, max_key=0, source_dim=0, bias_dim=0, do_rescale=False):
+    def __init__(self, max_key=0, source_dim=0, bias_dim=0, do_rescale=False, \
+                 safe_grads=SAFE_GRADS):
         # Set stuff for managing this type of layer
         self.key_count = max_key + 1 # add 1 to accommodate 0 indexing
+        self.safe_grads = safe_grads
         self.source_dim = source_dim
         self.bias_dim = bias_dim
         self.do_rescale = do_rescale # set to True for magical fun
@@ -375,7 +387,7 @@ class CMLayer:
         self.moms = {}
         self.moms['Wm'] = zeros(self.params['Wm'].shape)
         self.moms['Wb'] = zeros(self.params['Wb'].shape)
-        self.grad_idx = set()
+        self.sparse = SparseParams(self, ['Wm', 'Wb'], self.key_count)
         # Set common stuff for all types layers
         self.X = []
         self.C = []
@@ -395,10 +407,17 @@ class CMLayer:
         else:
             self.params['Wb'] = w_scale * randn((self.key_count, self.bias_dim))
             self.grads['Wb'] = zeros(self.params['Wb'].shape)
+        self.sparse.reset_decay([param])
+        return
+
+    def flush_params(self):
+        """Apply any deferred l2 decay, before reading the full params."""
+        self.sparse.flush()
         return
 
     def clip_params(self, Wm_norm=5.0, Wb_norm=5.0):
         """Bound L2 (row-wise) norm of Wm and Wb by max_norm."""
+        self.sparse.flush()
         for (param, max_norm) in zip(['Wm','Wb'],[Wm_norm, Wb_norm]):
             M = self.params[param]
             m_scales = max_norm / np.sqrt(np.sum(M**2.0,axis=1) + 1e-5)
@@ -410,6 +429,7 @@ class CMLayer:
 
     def norm_info(self, param_name='Wm'):
         """Diagnostic info about norms of W's rows."""
+        self.sparse.flush()
         M = self.params[param_name]
         row_norms = np.sqrt(np.sum(M**2.0, axis=1))
         men_n = np.mean(row_norms)
@@ -428,6 +448,7 @@ class CMLayer:
         # Record the incoming list of row indices to extract
         self.X = X
         self.C = C.astype(np.uint32)
+        self.sparse.refresh(self.C)
         # Extract the relevant bias parameter rows
         Wb = self.params['Wb'].take(C, axis=0)
         if (self.bias_dim < 5):
@@ -457,7 +478,7 @@ class CMLayer:
         """
         # Add the gradients to the gradient accumulators
         assert (np.max(self.C) < self.key_count)
-        self.grad_idx.update(self.C.ravel())
+        self.sparse.touch(self.C)
         self.dLdY = dLdY
         dLdYb, dLdYw = np.hsplit(dLdY, [self.bias_dim])
         dLdYb = dLdYb.copy() # copy, because hsplit leaves the new arrays in
@@ -465,50 +486,44 @@ class CMLayer:
                              # not good for the BLAS calls used by the Cython
                              # version of lut_bp, which expect input arrays
                              # that are in contiguous memory
+        bp = lut_bp_safe if self.safe_grads else lut_bp
         if self.do_rescale:
             dLdW = (self.Wm_sig / self.Wm_exp) * self.X * dLdYw
-            lut_bp(self.C, dLdW, self.grads['Wm'])
-        lut_bp(self.C, dLdYb, self.grads['Wb'])
+            bp(self.C, dLdW, self.grads['Wm'])
+        bp(self.C, dLdYb, self.grads['Wb'])
         dLdX = self.Wm_sig * dLdYw
         return dLdX
 
     def apply_grad(self, learn_rate=1e-2):
         """Apply the current accumulated gradients, with adagrad."""
-        nz_idx = np.asarray([i for i in self.grad_idx]).astype(np.uint32)
+        learn_rates = {}
         # Information from the word LUT should not pass through this
         # layer when source_dim < 5. In this case, we assume that we
         # will do prediction using only the context-adaptive biases.
         if self.do_rescale:
-            m_rate = learn_rate if (self.source_dim >= 5) else 0.0
-            ag_update_2d(nz_idx, self.params['Wm'], self.grads['Wm'], \
-                         self.moms['Wm'], m_rate)
+            learn_rates['Wm'] = learn_rate if (self.source_dim >= 5) else 0.0
         # No context-adaptive bias term should be applied if self.bias_dim
         # is < 5. I.e. only information coming up from the word LUT, and
         # possibly rescaled by this layer, should be used in prediction.
-        b_rate = learn_rate if (self.bias_dim >= 5) else 0.0
-        ag_update_2d(nz_idx, self.params['Wb'], self.grads['Wb'], \
-                     self.moms['Wb'], b_rate)
-        self.grad_idx = set()
+        learn_rates['Wb'] = learn_rate if (self.bias_dim >= 5) else 0.0
+        self.sparse.apply_grad(learn_rates)
         return
 
     def l2_regularize(self, lam_Wm=1e-5, lam_Wb=1e-5):
-        """Add gradients for l2 regularization."""
-        self.params['Wm'] -= lam_Wm * self.params['Wm']
-        self.params['Wb'] -= lam_Wb * self.params['Wb']
+        """Apply l2 regularization (lazily, see SparseParams)."""
+        self.sparse.l2_decay('Wm', lam_Wm)
+        self.sparse.l2_decay('Wb', lam_Wb)
         return 1
 
     def reset_moms(self, ada_init=1e-3):
         """Reset the gradient accumulators for this layer."""
-        self.moms['Wm'] = (0.0 * self.moms['Wm']) + ada_init
-        self.moms['Wb'] = (0.0 * self.moms['Wb']) + ada_init
+        self.sparse.reset_moms(ada_init)
         return
 
     def reset_grads_and_moms(self, ada_init=1e-3):
         """Reset the gradient accumulators for this layer."""
-        self.grads['Wm'] = (0.0 * self.grads['Wm'])
-        self.grads['Wb'] = (0.0 * self.grads['Wb'])
-        self.moms['Wm'] = (0.0 * self.moms['Wm']) + ada_init
-        self.moms['Wb'] = (0.0 * self.moms['Wb']) + ada_init
+        self.sparse.reset_grads()
+        self.sparse.reset_moms(ada_init)
         return
 
     def _cleanup(self):
@@ -235,6 +235,7 @@ class PVModel:
         self.word_layer.reset_grads_and_moms()
         self.context_layer.reset_grads_and_moms()
         self.class_layer.reset_grads_and_moms()
+        new_context_layer.flush_params()
         return new_context_layer
 
 ####################################
@@ -480,6 +481,7 @@ class CAModel:
         self.word_layer.reset_grads_and_moms()
         self.context_layer.reset_grads_and_moms()
         self.class_layer.reset_grads_and_moms()
+        new_context_layer.flush_params()
         return new_context_layer
 
 
@@ -654,6 +656,7 @@ def test_cam_model():
         cam.train(pos_sampler, neg_sampler, 200, 10001, train_ctx=True, \
                   train_lut=True, train_cls=True, learn_rate=learn_rate)
         learn_rate = learn_rate * decay_rate
+        cam.word_layer.flush_params()
         [s_keys, n_keys, s_words, n_words] = some_nearest_words( k2w, 10, \
                   W1=cam.word_layer.params['W'], W2=None)
         for w in range(10):
@@ -697,6 +700,7 @@ def test_pv_model():
     for i in range(5):
         pvm.train(ngram_sampler, hsm_code_keys, hsm_code_signs, 300, 10001, \
                 train_ctx=True, train_lut=True, train_cls=True, learn_rate=1e-3)
+        pvm.word_layer.flush_params()
         [s_keys, n_keys, s_words, n_words] = some_nearest_words( k2w, 10, \
                 W1=pvm.word_layer.params['W'], W2=None)
         for w in range(10):
@@ -2,11 +2,12 @@ from __future__ import absolute_import
 
 import numpy as np
 import numpy.random as npr
-import threading
 import numba
 from math import exp, log, sqrt
 from numba import jit, void, i4, f4, u4
 from ctypes import pythonapi, c_void_p
+from KernelPool import default_thread_count, make_multithread as make_mt
+from BlockFuncs import block_ff_bp, block_ff, block_bp
 
 ADA_EPS = 0.001
 
@@ -14,7 +15,7 @@ ADA_EPS = 0.001
 # MULTITHREADING HELPER-FUNC AND DEFNS #
 ########################################
 
-THREAD_NUM = 4
+THREAD_NUM = default_thread_count()
 
 savethread = pythonapi.PyEval_SaveThread
 savethread.argtypes = []
@@ -25,32 +26,8 @@ restorethread.argtypes = [c_void_p]
 restorethread.restype = None
 
 def make_multithread(inner_func, numthreads):
-    def func_mt(*args):
-        length = len(args[0])
-        sp_idx = np.arange(0,length).astype(np.int32)
-        chunklen = (length + (numthreads-1)) // numthreads
-        chunkargs = [(sp_idx[i*chunklen:(i+1)*chunklen],)+args for i in range(numthreads)]
-        # Start a thread for all but the last chunk of work
-        threads = [threading.Thread(target=inner_func, args=cargs)
-                   for cargs in chunkargs[:-1]]
-        for thread in threads:
-            thread.start()
-        # Give the last chunk of work to the main thread
-        inner_func(*chunkargs[-1])
-        for thread in threads:
-            thread.join()
-        return 1
-    def func_st(*args):
-        length = len(args[0])
-        sp_idx = np.arange(0,length).astype(np.int32)
-        sp_args = (sp_idx,) + args
-        inner_fun(*sp_args)
-    func = None
-    if numthreads == 1:
-        func = func_st
-    else:
-        func = func_mt
-    return func_mt
+    # the numba kernels take their chunk indices as int32
+    return make_mt(inner_func, numthreads, idx_dtype=np.int32)
 
 ##############################
 # NUMBA FUNCTION DEFINITIONS #
@@ -210,6 +187,129 @@ fn_sig_6 = void(i4[:], f4[:,:], u4[:,:], f4[:,:], f4[:,:], f4[:], f4[:,:], f4[:,
 hsm_ff_bp_st = jit(fn_sig_6, nopython=True)(hsm_ff_bp_sp)
 hsm_ff_bp = make_multithread(hsm_ff_bp_st, THREAD_NUM)
 
+###########################################
+# FUSED (SIMD-FRIENDLY) AND GEMM VARIANTS #
+###########################################
+#
+# The *_fused kernels do the same work as the loops above, but declare their
+# matrices as C-contiguous (f4[:,::1] rather than f4[:,:]) and work on row
+# views, so numba knows the inner loops run over unit-stride memory and LLVM
+# can vectorize them. The dot products use four partial sums, which breaks the
+# serial dependency on a single accumulator. The *_gemm versions batch all of
+# the (row, key) pairs in blocks of rows into dense products via BLAS (see
+# BlockFuncs.py), and aren't split over threads since BLAS does that itself.
+
+def nsl_ff_fused_sp(sp_idx, table_idx, X, W, b, Y):
+    """Feedforward for NSLayer, with fused/vectorizable inner loops."""
+    threadstate = savethread()
+    rows = sp_idx.shape[0]
+    cols = table_idx.shape[1]
+    vec_dim = X.shape[1]
+    vec_end = vec_dim - (vec_dim % 4)
+    for spi in range(rows):
+        i = sp_idx[spi]
+        x = X[i]
+        for j in range(cols):
+            idx = table_idx[i,j]
+            w = W[idx]
+            y0 = 0.0
+            y1 = 0.0
+            y2 = 0.0
+            y3 = 0.0
+            for k in range(0, vec_end, 4):
+                y0 += x[k] * w[k]
+                y1 += x[k+1] * w[k+1]
+                y2 += x[k+2] * w[k+2]
+                y3 += x[k+3] * w[k+3]
+            for k in range(vec_end, vec_dim):
+                y0 += x[k] * w[k]
+            Y[i,j] = b[idx] + ((y0 + y1) + (y2 + y3))
+    restorethread(threadstate)
+    return
+fn_sig_7 = void(i4[:], i4[:,::1], f4[:,::1], f4[:,::1], f4[::1], f4[:,::1])
+nsl_ff_fused_st = jit(fn_sig_7, nopython=True)(nsl_ff_fused_sp)
+nsl_ff_fused = make_multithread(nsl_ff_fused_st, THREAD_NUM)
+
+def nsl_bp_fused_sp(sp_idx, table_idx, X, W, dLdY, dLdX, dW, db):
+    """Backprop for NSLayer, with fused/vectorizable inner loops."""
+    threadstate = savethread()
+    rows = sp_idx.shape[0]
+    cols = dLdY.shape[1]
+    vec_dim = X.shape[1]
+    for spi in range(rows):
+        i = sp_idx[spi]
+        x = X[i]
+        dx = dLdX[i]
+        for j in range(cols):
+            dldy = dLdY[i,j]
+            idx = table_idx[i,j]
+            w = W[idx]
+            dw = dW[idx]
+            db[idx] += dldy
+            for k in range(vec_dim):
+                dw[k] += dldy * x[k]
+                dx[k] += dldy * w[k]
+    restorethread(threadstate)
+    return
+fn_sig_8 = void(i4[:], i4[:,::1], f4[:,::1], f4[:,::1], f4[:,::1], f4[:,::1], f4[:,::1], f4[::1])
+nsl_bp_fused_st = jit(fn_sig_8, nopython=True)(nsl_bp_fused_sp)
+nsl_bp_fused = make_multithread(nsl_bp_fused_st, THREAD_NUM)
+
+def hsm_ff_bp_fused_sp(sp_idx, X, code_keys, code_signs, W, b, dLdX, dLdW, dLdb, L):
+    """Feedforward and backprop for HSMLayer, with fused/vectorizable loops."""
+    threadstate = savethread()
+    obs_count = sp_idx.shape[0]
+    code_len = code_keys.shape[1]
+    vec_dim = X.shape[1]
+    vec_end = vec_dim - (vec_dim % 4)
+    for spi in range(obs_count):
+        i = sp_idx[spi]
+        x = X[i]
+        dx = dLdX[i]
+        for j in range(code_len):
+            code_key = code_keys[i,j]
+            if code_key < 1234567:
+                w = W[code_key]
+                dw = dLdW[code_key]
+                y0 = 0.0
+                y1 = 0.0
+                y2 = 0.0
+                y3 = 0.0
+                for k in range(0, vec_end, 4):
+                    y0 += x[k] * w[k]
+                    y1 += x[k+1] * w[k+1]
+                    y2 += x[k+2] * w[k+2]
+                    y3 += x[k+3] * w[k+3]
+                for k in range(vec_end, vec_dim):
+                    y0 += x[k] * w[k]
+                y = b[code_key] + ((y0 + y1) + (y2 + y3))
+                neg_label = -1.0 * code_signs[i,j]
+                exp_y = exp(neg_label * y)
+                L[i,j] = log(1.0 + exp_y)
+                g = neg_label * (exp_y / (1.0 + exp_y))
+                dLdb[code_key] += g
+                for k in range(vec_dim):
+                    dx[k] += g * w[k]
+                    dw[k] += g * x[k]
+    restorethread(threadstate)
+    return
+fn_sig_9 = void(i4[:], f4[:,::1], u4[:,::1], f4[:,::1], f4[:,::1], f4[::1], f4[:,::1], f4[:,::1], f4[::1], f4[:,::1])
+hsm_ff_bp_fused_st = jit(fn_sig_9, nopython=True)(hsm_ff_bp_fused_sp)
+hsm_ff_bp_fused = make_multithread(hsm_ff_bp_fused_st, THREAD_NUM)
+
+def nsl_ff_gemm(table_idx, X, W, b, Y):
+    """Gather-then-GEMM version of nsl_ff."""
+    return block_ff(table_idx, X, W, b, Y)
+
+def nsl_bp_gemm(table_idx, X, W, dLdY, dLdX, dW, db):
+    """Gather-then-GEMM version of nsl_bp."""
+    return block_bp(table_idx, X, W, dLdY, dLdX, dW, db)
+
+def hsm_ff_bp_gemm(X, code_keys, code_signs, W, b, dLdX, dLdW, dLdb, L):
+    """Gather-then-GEMM version of hsm_ff_bp."""
+    return block_ff_bp(code_keys, code_signs, X, W, b, dLdX, dLdW, dLdb, L, \
+                       1, max_key=1234567)
+
 ##############
 # EYE BUFFER #
 ##############
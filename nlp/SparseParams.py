@@ -0,0 +1,160 @@
+from __future__ import absolute_import
+
+import numpy as np
+
+from CythonFuncs import ag_update_2d, ag_update_1d
+
+#############################################
+# ROW-SPARSE PARAMS WITH LAZY DECAY / RESET #
+#############################################
+
+class SparseParams:
+    """Bookkeeping for row-indexed params that get sparse adagrad updates.
+
+    This handles a group of params in some layer that are indexed by the
+    same keys (e.g. W and b in an NSLayer), so that per-batch work scales
+    with the number of rows a batch touches, rather than the key count:
+
+      1. Touched rows are marked with a per-row step stamp and appended to a
+         compact list, so apply_grad only visits those rows.
+      2. L2 decay is deferred. Each param keeps the total log-decay applied
+         so far, and each row records how much of it it has seen. A row gets
+         caught up when it's next used (refresh()) or on flush().
+      3. Resetting the adagrad moms just bumps an epoch counter, and rows
+         get reset to ada_init when they're next updated.
+
+    The params/grads/moms dicts are looked up in the owning layer on each
+    use, since layers replace their arrays wholesale (e.g. in init_params).
+    """
+    def __init__(self, layer, names, row_count):
+        self.layer = layer
+        self.names = list(names)
+        self.row_count = row_count
+        # touched rows since the last apply_grad/reset_grads
+        self.step = 1
+        self.touch_stamp = np.zeros((row_count,), dtype=np.int64)
+        self.touched = np.zeros((row_count,), dtype=np.uint32)
+        self.touch_count = 0
+        # lazy l2 decay
+        self.log_decay = {}
+        self.row_decay = {}
+        for name in self.names:
+            self.log_decay[name] = 0.0
+            self.row_decay[name] = np.zeros((row_count,), dtype=np.float64)
+        # lazy adagrad mom resets
+        self.mom_epoch = 0
+        self.mom_stamp = np.zeros((row_count,), dtype=np.int64)
+        self.ada_init = 0.0
+        return
+
+    def _valid(self, keys):
+        """Get the keys in keys that index actual rows, as a flat array."""
+        keys = np.asarray(keys).ravel()
+        return keys[keys < self.row_count]
+
+    def touch(self, keys):
+        """Mark the rows in keys as having gradients to apply."""
+        keys = self._valid(keys)
+        new_rows = np.unique(keys[self.touch_stamp[keys] != self.step])
+        self.touch_stamp[new_rows] = self.step
+        end_idx = self.touch_count + new_rows.shape[0]
+        self.touched[self.touch_count:end_idx] = new_rows
+        self.touch_count = end_idx
+        return
+
+    def touched_rows(self):
+        """Get the (unique) rows touched since the last apply/reset."""
+        return self.touched[0:self.touch_count]
+
+    def _clear_touched(self):
+        self.step += 1
+        self.touch_count = 0
+        return
+
+    def refresh(self, keys):
+        """Apply any pending l2 decay to the rows in keys."""
+        keys = self._valid(keys)
+        for name in self.names:
+            row_decay = self.row_decay[name]
+            stale = keys[row_decay[keys] != self.log_decay[name]]
+            if stale.shape[0] == 0:
+                continue
+            scale = np.exp(self.log_decay[name] - row_decay[stale])
+            P = self.layer.params[name]
+            if P.ndim == 1:
+                P[stale] = P[stale] * scale
+            else:
+                P[stale] = P[stale] * scale[:,np.newaxis]
+            row_decay[stale] = self.log_decay[name]
+        return
+
+    def flush(self):
+        """Apply all pending l2 decay, e.g. before reading the full params."""
+        for name in self.names:
+            row_decay = self.row_decay[name]
+            if np.all(row_decay == self.log_decay[name]):
+                continue
+            scale = np.exp(self.log_decay[name] - row_decay)
+            P = self.layer.params[name]
+            if P.ndim == 1:
+                P *= scale.astype(P.dtype)
+            else:
+                P *= scale.astype(P.dtype)[:,np.newaxis]
+            row_decay[:] = self.log_decay[name]
+        return
+
+    def reset_decay(self, names=None):
+        """Forget pending decay for the given params, e.g. after re-init."""
+        if names is None:
+            names = self.names
+        for name in names:
+            self.row_decay[name][:] = self.log_decay[name]
+        return
+
+    def l2_decay(self, name, lam_l2):
+        """Scale the param called name by (1 - lam_l2), lazily."""
+        self.log_decay[name] += np.log(1.0 - lam_l2)
+        return
+
+    def reset_moms(self, ada_init=1e-3):
+        """Reset all adagrad moms to ada_init, lazily."""
+        self.mom_epoch += 1
+        self.ada_init = ada_init
+        return
+
+    def reset_grads(self):
+        """Zero the gradients on all touched rows."""
+        rows = self.touched_rows()
+        for name in self.names:
+            self.layer.grads[name][rows] = 0.0
+        self._clear_touched()
+        return
+
+    def apply_grad(self, learn_rates):
+        """Apply adagrad updates to the touched rows.
+
+        learn_rates maps param names to learning rates. Params not in it get
+        no update (and keep their gradients).
+        """
+        rows = self.touched_rows()
+        self.refresh(rows)
+        # catch up rows whose moms were reset since they were last updated
+        stale = rows[self.mom_stamp[rows] != self.mom_epoch]
+        self.mom_stamp[stale] = self.mom_epoch
+        for name in self.names:
+            self.layer.moms[name][stale] = self.ada_init
+            if not (name in learn_rates):
+                continue
+            P = self.layer.params[name]
+            if P.ndim == 1:
+                ag_update_1d(rows, P, self.layer.grads[name], \
+                             self.layer.moms[name], learn_rates[name])
+            else:
+                ag_update_2d(rows, P, self.layer.grads[name], \
+                             self.layer.moms[name], learn_rates[name])
+        self._clear_touched()
+        return
+
+##############
+# EYE BUFFER #
+##############